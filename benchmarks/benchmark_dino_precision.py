@@ -0,0 +1,58 @@
+"""
+Benchmark: DINOFeatureExtractor precision modes
+
+Times feature extraction for each precision mode and reports the cosine
+similarity of its features against fp32.
+
+Usage:
+    python benchmarks/benchmark_dino_precision.py [batch_size]
+"""
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from dino_extractor import DINOFeatureExtractor, PRECISIONS
+
+
+def timed(extractor, images, repeats=3):
+    """Best-of-N wall time of one batched extraction, in seconds"""
+    best = float("inf")
+    features = None
+    for _ in range(repeats):
+        if extractor.device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        features = extractor.extract_features_batch(images, batch_size=len(images))
+        if extractor.device.type == "cuda":
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best, features.cpu()
+
+
+def main():
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    images = torch.rand(batch_size, 512, 512, 3)
+    
+    print(f"Extracting DINOv2 features for {batch_size} images (torch threads: {torch.get_num_threads()})")
+    print(f"{'precision':<10} {'device':<7} {'time':>9} {'cosine (mean/min)':>20}")
+    
+    reference = None
+    for precision in PRECISIONS:
+        extractor = DINOFeatureExtractor(precision=precision)
+        timed(extractor, images[:1], repeats=1)  # warm-up
+        elapsed, features = timed(extractor, images)
+        if reference is None:
+            reference = features
+        similarity = torch.nn.functional.cosine_similarity(features, reference, dim=-1)
+        print(f"{precision:<10} {extractor.device.type:<7} {elapsed * 1000:>7.1f}ms "
+              f"{similarity.mean():>10.5f}/{similarity.min():.5f}")
+        del extractor
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmark: cost of importing nodes.py at ComfyUI startup
+
+Runs `python -X importtime` on `import nodes` in a fresh interpreter, with
+torch, numpy and PIL imported first since ComfyUI has loaded them already,
+and reports the node's own cumulative import time and its slowest imports.
+
+Usage:
+    python benchmarks/benchmark_import_time.py [--max-ms N]
+
+With --max-ms the script exits with status 1 if importing nodes.py takes
+longer than N milliseconds, or if a deferred heavy dependency gets imported.
+"""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+# Imported by ComfyUI before custom nodes are loaded
+PRELOADED = "import torch, numpy, PIL.Image"
+
+# Must not be imported until a DINO Upscale node runs
+DEFERRED = ("cv2", "transformers", "comfy.sample")
+
+
+def import_times():
+    """Return [(module, self_us, cumulative_us)] for the imports of nodes.py"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"{PRELOADED}\nimport nodes"],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        if not self_us.isdigit():
+            continue  # header row
+        entries.append((name, int(self_us), int(cumulative_us)))
+    # Everything after the last preloaded module belongs to nodes.py
+    start = 0
+    for i, (name, _, _) in enumerate(entries):
+        if name == "PIL.Image":
+            start = i + 1
+    return entries[start:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--max-ms", type=float, default=None,
+                        help="Fail if importing nodes.py takes longer than this")
+    args = parser.parse_args()
+    
+    entries = import_times()
+    total_ms = next(cumulative for name, _, cumulative in entries if name == "nodes") / 1000
+    names = {name for name, _, _ in entries}
+    deferred = [module for module in DEFERRED if module in names]
+    
+    print(f"import nodes: {total_ms:.1f}ms (after {PRELOADED[len('import '):]})")
+    print("Slowest imports (self time):")
+    for name, self_us, cumulative_us in sorted(entries, key=lambda e: -e[1])[:10]:
+        print(f"  {self_us / 1000:>7.1f}ms  {cumulative_us / 1000:>7.1f}ms  {name}")
+    if deferred:
+        print(f"Deferred modules imported at startup: {', '.join(deferred)}")
+    
+    if args.max_ms is not None and (total_ms > args.max_ms or deferred):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
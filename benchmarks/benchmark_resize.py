@@ -0,0 +1,76 @@
+"""
+Benchmark: cv2 vs torch resize for the pre-diffusion upscale
+
+Times cv2.resize on CPU against src/resize.py on CPU and, if available, on
+the CUDA / MPS device, and reports the max difference from cv2.
+
+Usage:
+    python benchmarks/benchmark_resize.py [width height scale]
+"""
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import torch
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from resize import resize_image
+
+
+MODES = [
+    ("lanczos4", cv2.INTER_LANCZOS4),
+    ("bicubic", cv2.INTER_CUBIC),
+    ("bilinear", cv2.INTER_LINEAR),
+]
+
+
+def timed(fn, device, repeats=3):
+    """Best-of-N wall time of fn() in seconds, synchronising the device"""
+    best = float("inf")
+    result = None
+    for _ in range(repeats):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        result = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    width, height, scale = 1024, 1024, 4.0
+    if len(sys.argv) == 4:
+        width, height, scale = int(sys.argv[1]), int(sys.argv[2]), float(sys.argv[3])
+    size = (int(width * scale), int(height * scale))
+    
+    image = torch.rand(height, width, 3)
+    devices = [torch.device("cpu")]
+    if torch.cuda.is_available():
+        devices.append(torch.device("cuda"))
+    elif torch.backends.mps.is_available():
+        devices.append(torch.device("mps"))
+    
+    print(f"Resizing {width}x{height} -> {size[0]}x{size[1]} "
+          f"(torch threads: {torch.get_num_threads()}, cv2 threads: {cv2.getNumThreads()})")
+    print(f"{'mode':<10} {'backend':<14} {'time':>9} {'max diff':>10}")
+    
+    for mode, flag in MODES:
+        image_np = image.numpy()
+        cv2_time, reference = timed(lambda: cv2.resize(image_np, size, interpolation=flag), devices[0])
+        reference = torch.from_numpy(reference)
+        print(f"{mode:<10} {'cv2 (cpu)':<14} {cv2_time * 1000:>7.1f}ms {'-':>10}")
+        
+        for device in devices:
+            source = image.to(device)
+            elapsed, result = timed(lambda: resize_image(source, size, mode, antialias=False), device)
+            diff = (result.cpu() - reference).abs().max().item()
+            print(f"{mode:<10} {'torch (' + device.type + ')':<14} {elapsed * 1000:>7.1f}ms {diff:>10.2e}")
+
+
+if __name__ == "__main__":
+    main()
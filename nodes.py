@@ -3,6 +3,8 @@ DINO Upscale ComfyUI Node
 
 Semantic-aware image upscaling using DINOv2 features and diffusion models.
 """
+import functools
+import importlib
 import os
 import sys
 import torch
@@ -12,23 +14,30 @@ current_dir = os.path.dirname(os.path.realpath(__file__))
 if current_dir not in sys.path:
     sys.path.insert(0, current_dir)
 
-# Import utils - try relative first, then absolute
-try:
-    from .utils import comfyui_to_pil, pil_to_comfyui
-except ImportError:
-    from utils import comfyui_to_pil, pil_to_comfyui
-
-# Import our existing upscaler components
+# Import our existing upscaler components. Only lightweight modules are
+# imported here; the upscaler (cv2), DINO extractor (transformers) and sampler
+# (comfy.sample) are imported on first use so ComfyUI starts quickly
 try:
     # Try relative import first (when installed as package)
-    from .src.dino_extractor import DINOFeatureExtractor
-    from .src.upscaler import BasicUpscaler
-    from .src.comfyui_sampler import ComfyUISamplerWrapper
+    from .src.tile_planner import TileGrid
+    from .src.tile_cache import TileCache
+    from .src.feature_cache import FeatureCache
+    from .src.model_registry import registry as model_registry
 except ImportError:
     # Fall back to absolute import (when loaded by ComfyUI)
-    from src.dino_extractor import DINOFeatureExtractor
-    from src.upscaler import BasicUpscaler
-    from src.comfyui_sampler import ComfyUISamplerWrapper
+    from src.tile_planner import TileGrid
+    from src.tile_cache import TileCache
+    from src.feature_cache import FeatureCache
+    from src.model_registry import registry as model_registry
+
+
+def _import_src(module):
+    """Import a module from src/ on first use"""
+    try:
+        return importlib.import_module(".src." + module, __package__)
+    except (ImportError, TypeError):
+        # TypeError: not loaded as a package, so there is no relative import
+        return importlib.import_module("src." + module)
 
 
 class DINOUpscale:
@@ -45,8 +54,18 @@ class DINOUpscale:
     def __init__(self):
         """Initialize node (models loaded lazily on first use)"""
         self.dino_extractor = None
+        self.dino_key = None  # Key of the shared extractor in model_registry
         self.comfyui_sampler = None
         self.upscaler = None
+        self.tile_cache = None
+    
+    def __del__(self):
+        """Release the shared DINO model when ComfyUI drops this node"""
+        try:
+            if self.dino_key is not None:
+                model_registry.release(self.dino_key)
+        except Exception:
+            pass
     
     @classmethod
     def INPUT_TYPES(cls):
@@ -136,6 +155,65 @@ class DINOUpscale:
                     "default": "high quality, detailed, sharp",
                     "multiline": True
                 }),
+                "tile_batch_size": ("INT", {
+                    "default": 1,
+                    "min": 1,
+                    "max": 64,
+                    "step": 1
+                }),
+                "output_path": ("STRING", {
+                    "default": ""
+                }),
+                "tiling_mode": (["pixel", "latent", "joint"], {
+                    "default": "pixel"
+                }),
+                "tile_overlap": ("INT", {
+                    "default": 64,
+                    "min": 0,
+                    "max": 512,
+                    "step": 8
+                }),
+                "detail_threshold": ("FLOAT", {
+                    "default": 0.0,
+                    "min": 0.0,
+                    "max": 1.0,
+                    "step": 0.001
+                }),
+                "flat_tile_steps": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 100
+                }),
+                "cache_dir": ("STRING", {
+                    "default": ""
+                }),
+                "cache_size_gb": ("FLOAT", {
+                    "default": 4.0,
+                    "min": 0.1,
+                    "max": 1024.0,
+                    "step": 0.1
+                }),
+                "job_dir": ("STRING", {
+                    "default": ""
+                }),
+                "resize_device": (["auto", "cpu"], {
+                    "default": "auto"
+                }),
+                "dino_precision": (["fp32", "fp16", "bf16", "int8"], {
+                    "default": "fp32"
+                }),
+                "dino_resolution": ("INT", {
+                    "default": 0,
+                    "min": 0,
+                    "max": 2044,
+                    "step": 14
+                }),
+                "dino_offload_after": ("INT", {
+                    "default": 300,
+                    "min": 0,
+                    "max": 86400,
+                    "step": 30
+                }),
             }
         }
     
@@ -144,7 +222,8 @@ class DINOUpscale:
     FUNCTION = "upscale"
     CATEGORY = "image/upscaling"
     
-    def _initialize_models(self, scale_factor, dino_enabled, model=None, vae=None, clip=None):
+    def _initialize_models(self, scale_factor, dino_enabled, model=None, vae=None, clip=None,
+                           dino_precision="fp32"):
         """Lazy initialization of models on first use"""
         # Require external model - no more FLUX fallback
         if model is None or vae is None:
@@ -157,6 +236,7 @@ class DINOUpscale:
         # Use external model (ComfyUI native)
         if self.comfyui_sampler is None:
             print("[DINO Upscale] Using external model from workflow...")
+            ComfyUISamplerWrapper = _import_src("comfyui_sampler").ComfyUISamplerWrapper
             self.comfyui_sampler = ComfyUISamplerWrapper(
                 model=model,
                 vae=vae,
@@ -169,6 +249,7 @@ class DINOUpscale:
             
         if self.upscaler is None:
             print("[DINO Upscale] Initializing upscaler...")
+            BasicUpscaler = _import_src("upscaler").BasicUpscaler
             self.upscaler = BasicUpscaler(
                 comfyui_sampler=self.comfyui_sampler,
                 scale_factor=scale_factor,
@@ -176,15 +257,75 @@ class DINOUpscale:
             )
             print("[DINO Upscale] ✓ Upscaler initialized")
         
-        if dino_enabled and self.dino_extractor is None:
-            print("[DINO Upscale] Loading DINOv2 model...")
-            print("[DINO Upscale] (Downloads ~350MB from HuggingFace on first use)")
-            self.dino_extractor = DINOFeatureExtractor()
+        if dino_enabled and not self.comfyui_sampler.conditions_on_dino:
+            # Features would be extracted and then ignored, so don't load DINOv2 at all
+            print("[DINO Upscale] DINO guidance is not used by the sampler yet; skipping DINOv2")
+            return
+        
+        dino_key = ("facebook/dinov2-base", dino_precision)
+        if dino_enabled and self.dino_key != dino_key:
+            # One DINOv2 instance per model and precision, shared by every node
+            if self.dino_key is not None:
+                model_registry.release(self.dino_key)
+            self.dino_extractor = model_registry.acquire(
+                dino_key, lambda: self._load_dino(dino_key, dino_precision)
+            )
+            self.dino_key = dino_key
             self.upscaler.dino_extractor = self.dino_extractor
-            print("[DINO Upscale] ✓ DINOv2 model loaded")
     
-    def _estimate_tiles(self, h, w, scale_factor, tile_size):
-        """Estimate number of tiles for progress bar"""
+    def _load_dino(self, dino_key, dino_precision):
+        """Load a new DINOv2 extractor (called by the registry on first use)"""
+        print(f"[DINO Upscale] Loading DINOv2 model ({dino_precision})...")
+        print("[DINO Upscale] (Downloads ~350MB from HuggingFace on first use)")
+        DINOFeatureExtractor = _import_src("dino_extractor").DINOFeatureExtractor
+        # Forwards go through the registry, so it never offloads the model mid-forward
+        # and knows when a forward has moved it back to the GPU. Its FeatureCache is the
+        # one DINO feature cache, shared by every node using this extractor
+        extractor = DINOFeatureExtractor(feature_cache=FeatureCache(), precision=dino_precision,
+                                         usage=functools.partial(model_registry.use, dino_key))
+        print("[DINO Upscale] ✓ DINOv2 model loaded")
+        return extractor
+    
+    def _resize_device(self, resize_device):
+        """Device for the initial resize; None keeps it on the CPU (cv2)"""
+        if resize_device != "auto":
+            return None
+        try:
+            import comfy.model_management
+            device = comfy.model_management.get_torch_device()
+        except ImportError:
+            return None
+        return device if device.type != "cpu" else None
+    
+    def _resolve_user_path(self, path):
+        """Resolve relative paths against ComfyUI's user directory"""
+        if not path or os.path.isabs(path):
+            return path
+        try:
+            import folder_paths
+            return os.path.join(folder_paths.get_user_directory(), path)
+        except (ImportError, AttributeError):
+            return os.path.abspath(path)
+    
+    def _get_tile_cache(self, cache_dir, cache_size_gb):
+        """Return the TileCache for cache_dir (reused across runs), or None if unset"""
+        if not cache_dir:
+            return None
+        cache_dir = self._resolve_user_path(cache_dir)
+        
+        if self.tile_cache is None or self.tile_cache.directory != cache_dir:
+            print(f"[DINO Upscale] Caching sampled tiles in {cache_dir}")
+            self.tile_cache = TileCache(cache_dir)
+        self.tile_cache.max_bytes = int(cache_size_gb * 1024 ** 3)
+        return self.tile_cache
+    
+    def _estimate_tiles(self, h, w, scale_factor, tile_size, overlap=64, ratio=None):
+        """
+        Number of tiles for the progress bar
+        
+        Uses the same TileGrid plan as the upscaler. With a VAE downscale
+        ratio the grid is planned in latent cells, as in latent/joint mode.
+        """
         # Calculate output dimensions
         target_h = int(h * scale_factor)
         target_w = int(w * scale_factor)
@@ -193,24 +334,25 @@ class DINOUpscale:
         if target_h <= tile_size and target_w <= tile_size:
             return 1
         
-        # Calculate overlap and stride for tile generation
-        overlap = 64
-        stride = tile_size - overlap
-        
-        # Calculate grid dimensions on OUTPUT image
-        tiles_y = (target_h + stride - 1) // stride
-        tiles_x = (target_w + stride - 1) // stride
+        if ratio:
+            latent_tile = max(1, tile_size // ratio)
+            return len(TileGrid(-(-target_w // ratio), -(-target_h // ratio),
+                                latent_tile, overlap // ratio, align=1))
         
-        return tiles_y * tiles_x
+        return len(TileGrid(target_w, target_h, tile_size, overlap))
     
     def upscale(self, image, scale_factor, denoise, tile_size, sampler_name, scheduler,
                 steps, dino_enabled, dino_strength, seed, 
-                model=None, vae=None, clip=None, prompt="high quality, detailed, sharp"):
+                model=None, vae=None, clip=None, prompt="high quality, detailed, sharp",
+                tile_batch_size=1, output_path="", tiling_mode="pixel", tile_overlap=64,
+                detail_threshold=0.0, flat_tile_steps=0, cache_dir="", cache_size_gb=4.0,
+                job_dir="", resize_device="auto", dino_precision="fp32", dino_offload_after=300,
+                dino_resolution=0):
         """
         Main upscaling function
         
         Args:
-            image: ComfyUI image tensor [B, H, W, C]
+            image: ComfyUI image tensor [B, H, W, C]; every image is upscaled
             scale_factor: Upscaling factor (1.0-4.0)
             denoise: Denoising strength for img2img (0.0-1.0)
             tile_size: Output tile size (512-2048)
@@ -223,6 +365,33 @@ class DINOUpscale:
             model: External MODEL from workflow (REQUIRED)
             vae: External VAE from workflow (REQUIRED)
             prompt: Text prompt for guidance
+            tile_batch_size: Number of same-sized tiles sampled together in one batch
+            output_path: If set, stream the full result to this PNG file and
+                         return a downsampled preview (for very large outputs)
+            tiling_mode: "pixel" (VAE encode/decode per tile), "latent"
+                         (encode once, blend latent tiles, decode once) or
+                         "joint" (latent tiles denoised together, blended every step)
+            tile_overlap: Overlap between neighbouring tiles in pixels
+            detail_threshold: Tiles with a detail score below this are flat
+                              (0 disables the detail pre-pass)
+            flat_tile_steps: Steps for flat tiles; 0 keeps their Lanczos result
+            cache_dir: If set, sampled tiles are cached in this directory and
+                       reused when the same tile is sampled with the same settings
+            cache_size_gb: Size cap of the tile cache
+            job_dir: If set, finished tiles are checkpointed here so an
+                     interrupted run resumes when re-queued
+            resize_device: "auto" runs the initial Lanczos resize on ComfyUI's
+                           compute device; "cpu" uses cv2 on the CPU
+            dino_precision: DINOv2 inference precision: "fp32", "fp16"/"bf16"
+                            autocast, or "int8" dynamic quantisation (CPU).
+                            No effect until the sampler conditions on DINO
+            dino_resolution: If non-zero, DINO sees each image (and tile) at this
+                             longer side with its own aspect ratio instead of
+                             a 224px center crop. No effect until the sampler
+                             conditions on DINO
+            dino_offload_after: Seconds without use before the shared DINOv2
+                                model is moved off the GPU (0 = never). No
+                                effect until the sampler conditions on DINO
             
         Returns:
             Tuple of (upscaled_image_tensor,)
@@ -237,16 +406,25 @@ class DINOUpscale:
                 has_progress = False
                 ProgressBar = None
             
+            # Neighbouring tiles must advance, so the overlap stays below the tile size
+            if tile_overlap > tile_size - 8:
+                print(f"[DINO Upscale] tile_overlap {tile_overlap} is too large for tile_size {tile_size}; "
+                      f"using {tile_size - 8}")
+                tile_overlap = tile_size - 8
+            
             # Initialize models if needed
-            self._initialize_models(scale_factor, dino_enabled, model, vae, clip)
+            self._initialize_models(scale_factor, dino_enabled, model, vae, clip, dino_precision)
             
             # Update scale factor (in case it changed since initialization)
             if self.upscaler is not None:
                 self.upscaler.scale_factor = scale_factor
+                self.upscaler.resize_device = self._resize_device(resize_device)
+                self.upscaler.dino_resolution = dino_resolution or None
             
-            # Estimate number of tiles for progress bar
+            # Estimate number of tiles for progress bar (every image uses the same grid)
             h, w = image.shape[1:3]
-            num_tiles = self._estimate_tiles(h, w, scale_factor, tile_size)
+            ratio = self.comfyui_sampler.downscale_ratio if tiling_mode != "pixel" else None
+            num_tiles = self._estimate_tiles(h, w, scale_factor, tile_size, tile_overlap, ratio) * image.shape[0]
             
             # Create progress bar (also handles stop button)
             pbar = ProgressBar(num_tiles) if has_progress else None
@@ -271,22 +449,35 @@ class DINOUpscale:
                     # Don't crash on preview errors
                     pass
             
-            # Convert ComfyUI tensor to PIL (process first image in batch)
-            print(f"[DINO Upscale] Processing image {image.shape}")
-            pil_image = comfyui_to_pil(image, batch_index=0)
+            # Keep the ComfyUI tensor as-is (the whole batch is upscaled)
+            print(f"[DINO Upscale] Processing image batch {image.shape}")
+            image_tensor = image
             
-            # Extract DINO features if enabled
+            # The sampler does not condition on DINO features yet, so none are
+            # extracted per image (see ComfyUISamplerWrapper.conditions_on_dino)
             dino_features = None
-            if dino_enabled and self.dino_extractor is not None:
-                print("[DINO Upscale] Extracting DINO features...")
-                dino_features = self.dino_extractor.extract_features(pil_image)
-                print(f"[DINO Upscale] ✓ Extracted {dino_features.shape[0]} patch features")
+            
+            # Streaming output: relative paths go to ComfyUI's output directory
+            if output_path:
+                if not os.path.isabs(output_path):
+                    try:
+                        import folder_paths
+                        output_path = os.path.join(folder_paths.get_output_directory(), output_path)
+                    except ImportError:
+                        output_path = os.path.abspath(output_path)
+                print(f"[DINO Upscale] Streaming result to {output_path}")
+            
+            # Tile cache and job checkpoints: relative paths go to ComfyUI's user directory
+            self.upscaler.tile_cache = self._get_tile_cache(cache_dir, cache_size_gb)
+            # Once per-tile DINO work is done, make room for the diffusion model if VRAM is short
+            self.upscaler.dino_done_callback = model_registry.check_memory
+            job_dir = self._resolve_user_path(job_dir)
             
             # Upscale using our existing code with progress and preview callbacks
             print(f"[DINO Upscale] Upscaling {scale_factor}x with denoise={denoise}, tile_size={tile_size}")
             print(f"[DINO Upscale] Sampler: {sampler_name}, Scheduler: {scheduler}")
-            result_pil = self.upscaler.upscale(
-                pil_image,
+            result_tensor = self.upscaler.upscale(
+                image_tensor,
                 dino_features=dino_features,
                 use_diffusion=True,
                 prompt=prompt,
@@ -295,15 +486,19 @@ class DINOUpscale:
                 seed=seed,
                 dino_conditioning_strength=dino_strength,
                 tile_size=tile_size,
+                tile_batch_size=tile_batch_size,
+                tiling_mode=tiling_mode,
+                tile_overlap=tile_overlap,
+                detail_threshold=detail_threshold,
+                flat_tile_steps=flat_tile_steps,
                 sampler_name=sampler_name,
                 scheduler=scheduler,
+                output_path=output_path or None,
+                job_dir=job_dir or None,
                 progress_callback=lambda: pbar.update(1) if pbar else None,
                 preview_callback=preview_callback
             )
             
-            # Convert result back to ComfyUI tensor
-            result_tensor = pil_to_comfyui(result_pil)
-            
             print(f"[DINO Upscale] ✓ Complete! Output: {result_tensor.shape}")
             
             return (result_tensor,)
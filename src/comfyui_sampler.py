@@ -1,9 +1,93 @@
 """
 ComfyUI native sampler wrapper for model-agnostic upscaling
 """
+import threading
+import weakref
+from collections import OrderedDict
+
 import torch
-import comfy.sample
-import comfy.utils
+
+try:
+    from .tile_cache import module_fingerprint, value_fingerprint
+except ImportError:
+    from tile_cache import module_fingerprint, value_fingerprint
+
+
+class ConditioningCache:
+    """
+    LRU of encoded prompt conditioning, keyed by CLIP identity and prompt
+    
+    Every tile of every run encodes the same prompts with the same CLIP, so
+    each pair is encoded once and shared. CLIP objects are held weakly: a
+    new object that happens to reuse a freed one's id() is not mistaken for
+    it. Without CLIP, the empty conditioning is cached the same way.
+    """
+    
+    def __init__(self, max_entries=32):
+        """
+        Args:
+            max_entries: Encoded prompts kept (least recently used dropped first)
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, clip, prompt):
+        """
+        Return the conditioning of prompt, encoding it with clip on a miss
+        
+        Args:
+            clip: ComfyUI CLIP object, or None for empty conditioning
+            prompt: Prompt text (ignored without clip)
+        
+        Returns:
+            ComfyUI conditioning list; shared, so treat it as read-only
+        """
+        key = (id(clip), prompt) if clip is not None else (None, None)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0]() is clip):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        
+        if clip is None:
+            # Empty conditioning without pooled_output for models that don't need it
+            # For FLUX/SDXL models, this will fail - they need CLIP
+            conditioning = [[torch.zeros((1, 77, 768)), {}]]
+            clip_ref = None
+        else:
+            tokens = clip.tokenize(prompt)
+            conditioning = clip.encode_from_tokens_scheduled(tokens)
+            try:
+                clip_ref = weakref.ref(clip)
+            except TypeError:
+                # Not weakly referenceable: identity cannot be checked, so don't cache
+                return conditioning
+        
+        with self._lock:
+            self._entries[key] = (clip_ref, conditioning)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return conditioning
+    
+    def clear(self):
+        """Drop every cached conditioning"""
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self):
+        """Hits, misses and entries since the cache was created"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+# Shared by every wrapper in the process, so prompts are encoded once across nodes and runs
+conditioning_cache = ConditioningCache()
 
 
 class ComfyUISamplerWrapper:
@@ -14,6 +98,15 @@ class ComfyUISamplerWrapper:
     that works with any diffusion model supported by ComfyUI.
     """
     
+    # Longest side, in latent cells, of the latent decoded for previews
+    MAX_PREVIEW_LATENT = 128
+    
+    # Sampling does not condition on dino_features yet, so callers skip extracting them
+    conditions_on_dino = False
+    
+    # Sampler names containing these draw fresh noise at every step
+    STOCHASTIC_SAMPLER_MARKERS = ("ancestral", "sde", "ddpm", "lcm", "restart", "seeds_", "sa_solver")
+    
     def __init__(self, model, vae, clip=None):
         """
         Initialize with ComfyUI MODEL and VAE
@@ -26,6 +119,7 @@ class ComfyUISamplerWrapper:
         self.model = model
         self.vae = vae
         self.clip = clip
+        self._fingerprint = None
         
     def encode_image(self, image_tensor):
         """
@@ -86,6 +180,62 @@ class ComfyUISamplerWrapper:
         
         return pixels
     
+    def fingerprint(self):
+        """
+        Identity of the MODEL (with its patches, e.g. LoRAs), VAE and CLIP
+        
+        Stable across restarts, so it can key persistent caches. Recomputed
+        only when one of the objects or the model's patches change.
+        """
+        patches = getattr(self.model, "patches_uuid", None)
+        state = (id(self.model), patches, id(self.vae), id(self.clip))
+        if self._fingerprint is None or self._fingerprint[0] != state:
+            parts = [
+                module_fingerprint(getattr(self.model, "model", None)),
+                value_fingerprint(getattr(self.model, "patches", None)),
+                module_fingerprint(getattr(self.vae, "first_stage_model", None)),
+                module_fingerprint(getattr(self.clip, "cond_stage_model", None)),
+                value_fingerprint(getattr(getattr(self.clip, "patcher", None), "patches", None)),
+            ]
+            self._fingerprint = (state, "-".join(parts))
+        return self._fingerprint[1]
+    
+    @property
+    def downscale_ratio(self):
+        """Pixels per latent cell along each axis (8 for SD/SDXL/FLUX VAEs)"""
+        ratio = getattr(self.vae, "downscale_ratio", 8)
+        return ratio if isinstance(ratio, int) else 8
+    
+    def encode_image_tiled(self, image_tensor, tile_size=512, overlap=64):
+        """
+        Encode a large image to latent space with ComfyUI's tiled VAE encode
+        
+        Args:
+            image_tensor: Image tensor in ComfyUI format [B, H, W, C]
+            tile_size: VAE tile size in pixels
+            overlap: VAE tile overlap in pixels
+            
+        Returns:
+            Latent tensor [B, C, H//8, W//8]
+        """
+        pixels = image_tensor if image_tensor.is_contiguous() else image_tensor.contiguous()
+        return self.vae.encode_tiled(pixels, tile_x=tile_size, tile_y=tile_size, overlap=overlap)
+    
+    def decode_latent_tiled(self, latent, tile_size=64, overlap=16):
+        """
+        Decode a large latent with ComfyUI's tiled VAE decode
+        
+        Args:
+            latent: Latent tensor [B, C, H//8, W//8]
+            tile_size: VAE tile size in latent cells
+            overlap: VAE tile overlap in latent cells
+            
+        Returns:
+            Image tensor in ComfyUI format [B, H, W, C]
+        """
+        pixels = self.vae.decode_tiled(latent, tile_x=tile_size, tile_y=tile_size, overlap=overlap)
+        return pixels.contiguous().clamp(0.0, 1.0)
+    
     def upscale(
         self,
         image,
@@ -125,20 +275,126 @@ class ComfyUISamplerWrapper:
         Returns:
             Upscaled PIL Image
         """
+        return self.upscale_batch(
+            [image],
+            seeds=[seed],
+            scale_factor=scale_factor,
+            denoise=denoise,
+            steps=steps,
+            cfg=cfg,
+            sampler_name=sampler_name,
+            scheduler=scheduler,
+            positive_conditioning=positive_conditioning,
+            negative_conditioning=negative_conditioning,
+            positive_prompt=positive_prompt,
+            negative_prompt=negative_prompt,
+            dino_features=dino_features,
+            preview_callback=preview_callback
+        )[0]
+    
+    def upscale_batch(
+        self,
+        images,
+        seeds,
+        scale_factor=1.0,
+        denoise=0.4,
+        steps=20,
+        cfg=7.0,
+        sampler_name="euler",
+        scheduler="normal",
+        positive_conditioning=None,
+        negative_conditioning=None,
+        positive_prompt=None,
+        negative_prompt=None,
+        dino_features=None,
+        preview_callback=None
+    ):
+        """
+        Upscale several same-sized images in a single sampler call
+        
+        Args:
+            images: List of PIL Images or numpy arrays, all the same size
+            seeds: One random seed per image
+            (remaining arguments as in sample_tensors)
+            
+        Returns:
+            List of upscaled PIL Images, in the same order as images
+        """
         from PIL import Image
         import numpy as np
         
-        # Convert input to tensor
-        if isinstance(image, Image.Image):
-            image = np.array(image)
+        # Convert inputs to a single [B, H, W, C] tensor
+        image_tensor = torch.cat([self._to_image_tensor(image) for image in images], dim=0)
         
-        if isinstance(image, np.ndarray):
-            # Convert numpy to tensor [H, W, C] -> [B, H, W, C]
-            image_tensor = torch.from_numpy(image).float() / 255.0
-            if image_tensor.ndim == 3:
-                image_tensor = image_tensor.unsqueeze(0)
-        else:
-            image_tensor = image
+        result_images = self.sample_tensors(
+            image_tensor,
+            seeds,
+            scale_factor=scale_factor,
+            denoise=denoise,
+            steps=steps,
+            cfg=cfg,
+            sampler_name=sampler_name,
+            scheduler=scheduler,
+            positive_conditioning=positive_conditioning,
+            negative_conditioning=negative_conditioning,
+            positive_prompt=positive_prompt,
+            negative_prompt=negative_prompt,
+            dino_features=dino_features,
+            preview_callback=preview_callback
+        )
+        
+        # Convert to PIL
+        result_np = (result_images.cpu().numpy() * 255).astype(np.uint8)
+        return [Image.fromarray(result_np[i]) for i in range(result_np.shape[0])]
+    
+    def sample_tensors(
+        self,
+        image_tensor,
+        seeds,
+        scale_factor=1.0,
+        denoise=0.4,
+        steps=20,
+        cfg=7.0,
+        sampler_name="euler",
+        scheduler="normal",
+        positive_conditioning=None,
+        negative_conditioning=None,
+        positive_prompt=None,
+        negative_prompt=None,
+        dino_features=None,
+        preview_callback=None
+    ):
+        """
+        Refine a batch of images given as a ComfyUI tensor, returning a tensor
+        
+        The whole batch goes through one VAE encode, one comfy.sample.sample
+        call and one VAE decode. Noise is generated per sample from its own
+        seed, so every image's result matches what upscale() would produce
+        with that seed. Samplers that add noise at every step (ancestral,
+        SDE, ...) draw it from a single generator for the whole batch, so
+        for those each image gets its own sample call.
+        
+        Args:
+            image_tensor: Image tensor in ComfyUI format [B, H, W, C], 0.0-1.0
+            seeds: One random seed per image in the batch
+            scale_factor: Upscaling factor
+            denoise: Denoising strength (0.0-1.0)
+            steps: Number of sampling steps
+            cfg: CFG scale
+            sampler_name: Sampler algorithm
+            scheduler: Noise schedule
+            positive_conditioning: Positive CONDITIONING from CLIP (if provided directly)
+            negative_conditioning: Negative CONDITIONING from CLIP (if provided directly)
+            positive_prompt: Text prompt to encode (if CLIP available)
+            negative_prompt: Negative text prompt to encode (if CLIP available)
+            dino_features: Optional DINO features (not yet used)
+            preview_callback: Optional callback for preview images (receives decoded image tensor)
+            
+        Returns:
+            Image tensor in ComfyUI format [B, H, W, C], float32, 0.0-1.0
+        """
+        if image_tensor.shape[0] != len(seeds):
+            raise ValueError(f"Expected one seed per image, got {len(seeds)} seeds for {image_tensor.shape[0]} images")
         
         # Encode to latent
         latent_dict = self.encode_image(image_tensor)
@@ -149,58 +405,108 @@ class ComfyUISamplerWrapper:
         new_h = int(h * scale_factor)
         new_w = int(w * scale_factor)
         
-        upscaled_latent = torch.nn.functional.interpolate(
-            latent,
-            size=(new_h, new_w),
-            mode='bicubic',
-            align_corners=False
+        if (new_h, new_w) != (h, w):
+            upscaled_latent = torch.nn.functional.interpolate(
+                latent,
+                size=(new_h, new_w),
+                mode='bicubic',
+                align_corners=False
+            )
+        else:
+            upscaled_latent = latent
+        
+        samples = self.sample_latents(
+            upscaled_latent,
+            seeds,
+            denoise=denoise,
+            steps=steps,
+            cfg=cfg,
+            sampler_name=sampler_name,
+            scheduler=scheduler,
+            positive_conditioning=positive_conditioning,
+            negative_conditioning=negative_conditioning,
+            positive_prompt=positive_prompt,
+            negative_prompt=negative_prompt,
+            dino_features=dino_features,
+            preview_callback=preview_callback
         )
         
-        # Prepare latent dict for sampling
-        latent_dict = {"samples": upscaled_latent}
+        # Decode back to image
+        return self.decode_latent(samples).clamp(0.0, 1.0)
+    
+    def sample_latents(
+        self,
+        latent,
+        seeds,
+        denoise=0.4,
+        steps=20,
+        cfg=7.0,
+        sampler_name="euler",
+        scheduler="normal",
+        positive_conditioning=None,
+        negative_conditioning=None,
+        positive_prompt=None,
+        negative_prompt=None,
+        dino_features=None,
+        preview_callback=None,
+        model_wrapper=None,
+        step_callback=None
+    ):
+        """
+        Run img2img sampling on a batch of latents, without VAE encode/decode
         
-        # Prepare conditioning
-        if positive_conditioning is None:
-            # Try to encode prompt if CLIP is available
-            if self.clip is not None and positive_prompt is not None:
-                tokens = self.clip.tokenize(positive_prompt)
-                positive_conditioning = self.clip.encode_from_tokens_scheduled(tokens)
-            else:
-                # Create empty conditioning without pooled_output for models that don't need it
-                # For FLUX/SDXL models, this will fail - they need CLIP
-                positive_conditioning = [[torch.zeros((1, 77, 768)), {}]]
-                
-        if negative_conditioning is None:
-            # Try to encode negative prompt if CLIP is available
-            if self.clip is not None and negative_prompt is not None:
-                tokens = self.clip.tokenize(negative_prompt)
-                negative_conditioning = self.clip.encode_from_tokens_scheduled(tokens)
-            else:
-                # Create empty conditioning
-                negative_conditioning = [[torch.zeros((1, 77, 768)), {}]]
-        
-        # Create preview callback wrapper if preview requested
-        sampler_callback = None
-        if preview_callback is not None:
-            def sampler_callback_wrapper(step, x0, x, total_steps):
-                """Decode latent and emit preview (ComfyUI callback signature)"""
-                try:
-                    # Decode predicted denoised latent (x0) to image
-                    decoded_image = self.decode_latent(x0)
-                    # Call user's preview callback with decoded image
-                    preview_callback(decoded_image)
-                except Exception as e:
-                    # Don't crash sampling if preview fails
-                    print(f"[ComfyUI Sampler] Preview callback error: {e}")
+        Args:
+            latent: Latent tensor [B, C, H//8, W//8]
+            seeds: One random seed per latent in the batch
+            model_wrapper: Optional model function wrapper (e.g. JointTileDenoiser)
+                           installed on a clone of the model for this call only
+            step_callback: Optional callback receiving (step, total_steps)
+            (remaining arguments as in sample_tensors)
             
-            sampler_callback = sampler_callback_wrapper
+        Returns:
+            Sampled latent tensor [B, C, H//8, W//8]
+        """
+        if len(seeds) > 1 and self.is_stochastic_sampler(sampler_name):
+            # These samplers draw their per-step noise for the whole batch from
+            # one generator seeded with seeds[0], so a latent's result would
+            # depend on its batch mates; sample each latent on its own instead
+            return self._sample_latents_one_by_one(
+                latent, seeds, dino_features=dino_features, step_callback=step_callback,
+                denoise=denoise, steps=steps, cfg=cfg, sampler_name=sampler_name,
+                scheduler=scheduler, positive_conditioning=positive_conditioning,
+                negative_conditioning=negative_conditioning, positive_prompt=positive_prompt,
+                negative_prompt=negative_prompt, preview_callback=preview_callback,
+                model_wrapper=model_wrapper
+            )
         
-        # Sample using ComfyUI's native sampler
-        batch_inds = latent_dict.get("batch_index", None)
-        noise = comfy.sample.prepare_noise(upscaled_latent, seed, batch_inds)
+        import comfy.sample  # deferred so importing this module stays cheap
+        
+        if latent.shape[0] != len(seeds):
+            raise ValueError(f"Expected one seed per latent, got {len(seeds)} seeds for {latent.shape[0]} latents")
+        
+        positive_conditioning, negative_conditioning = self._prepare_conditioning(
+            positive_conditioning, negative_conditioning, positive_prompt, negative_prompt
+        )
         
-        samples = comfy.sample.sample(
-            self.model,
+        sampler_callback = self._make_sampler_callback(preview_callback, step_callback)
+        
+        model = self.model
+        if model_wrapper is not None:
+            # Patch a clone so the workflow's MODEL is left untouched
+            model = self.model.clone()
+            if hasattr(model_wrapper, "inner_wrapper"):
+                model_wrapper.inner_wrapper = model.model_options.get("model_function_wrapper")
+            model.set_model_unet_function_wrapper(model_wrapper)
+        
+        # Per-sample noise: each latent gets the noise its own seed would produce alone
+        noise = torch.cat([
+            comfy.sample.prepare_noise(latent[i:i + 1], seed, None)
+            for i, seed in enumerate(seeds)
+        ], dim=0)
+        
+        # Sample using ComfyUI's native sampler
+        return comfy.sample.sample(
+            model,
             noise,
             steps,
             cfg,
@@ -208,7 +514,7 @@ class ComfyUISamplerWrapper:
             scheduler,
             positive_conditioning,
             negative_conditioning,
-            upscaled_latent,
+            latent,
             denoise=denoise,
             disable_noise=False,
             start_step=None,
@@ -217,14 +523,96 @@ class ComfyUISamplerWrapper:
             noise_mask=None,
             callback=sampler_callback,
             disable_pbar=False,
-            seed=seed
+            seed=seeds[0]
         )
+    
+    @classmethod
+    def is_stochastic_sampler(cls, sampler_name):
+        """Whether a sampler adds fresh noise at every step (ancestral, SDE, ...)"""
+        return sampler_name.endswith("_a") or any(
+            marker in sampler_name for marker in cls.STOCHASTIC_SAMPLER_MARKERS
+        )
+    
+    def _sample_latents_one_by_one(self, latent, seeds, dino_features=None, step_callback=None,
+                                   **kwargs):
+        """sample_latents() on each latent separately, with steps reported across all of them"""
+        results = []
+        for i, seed in enumerate(seeds):
+            callback = None
+            if step_callback is not None:
+                def callback(step, total_steps, i=i):
+                    step_callback(i * total_steps + step, len(seeds) * total_steps)
+            results.append(self.sample_latents(
+                latent[i:i + 1], [seed],
+                dino_features=dino_features[i:i + 1] if dino_features is not None else None,
+                step_callback=callback, **kwargs
+            ))
+        return torch.cat(results, dim=0)
+    
+    def _to_image_tensor(self, image):
+        """Convert a PIL Image, numpy array or tensor to ComfyUI format [B, H, W, C]"""
+        from PIL import Image
+        import numpy as np
         
-        # Decode back to image
-        result_image = self.decode_latent(samples)
+        if isinstance(image, Image.Image):
+            image = np.array(image)
         
-        # Convert to PIL
-        result_np = (result_image[0].cpu().numpy() * 255).astype(np.uint8)
-        result_pil = Image.fromarray(result_np)
+        if isinstance(image, np.ndarray):
+            # Convert numpy to tensor [H, W, C] -> [B, H, W, C]
+            image_tensor = torch.from_numpy(image).float() / 255.0
+        else:
+            image_tensor = image
+        
+        if image_tensor.ndim == 3:
+            image_tensor = image_tensor.unsqueeze(0)
+        
+        return image_tensor
+    
+    def _prepare_conditioning(self, positive_conditioning, negative_conditioning,
+                              positive_prompt, negative_prompt):
+        """Encode prompts with CLIP (memoised), or fall back to empty conditioning"""
+        if positive_conditioning is None:
+            # Encode prompt if CLIP is available
+            if self.clip is not None and positive_prompt is not None:
+                positive_conditioning = conditioning_cache.get(self.clip, positive_prompt)
+            else:
+                positive_conditioning = conditioning_cache.get(None, None)
+                
+        if negative_conditioning is None:
+            # Encode negative prompt if CLIP is available
+            if self.clip is not None and negative_prompt is not None:
+                negative_conditioning = conditioning_cache.get(self.clip, negative_prompt)
+            else:
+                negative_conditioning = conditioning_cache.get(None, None)
+        
+        return positive_conditioning, negative_conditioning
+    
+    def _make_sampler_callback(self, preview_callback, step_callback=None):
+        """Wrap preview and step callbacks in ComfyUI's sampler callback signature"""
+        if preview_callback is None and step_callback is None:
+            return None
+        
+        def sampler_callback_wrapper(step, x0, x, total_steps):
+            """Decode latent and emit preview (ComfyUI callback signature)"""
+            if step_callback is not None:
+                step_callback(step, total_steps)
+            if preview_callback is None:
+                return
+            try:
+                # The preview shows one image, so only the first latent of a batch is decoded
+                x0 = x0[:1]
+                # Previews are shown at most 512px, so shrink large latents before decoding
+                longest = max(x0.shape[-2:])
+                if longest > self.MAX_PREVIEW_LATENT:
+                    x0 = torch.nn.functional.interpolate(
+                        x0, scale_factor=self.MAX_PREVIEW_LATENT / longest, mode='bilinear'
+                    )
+                # Decode predicted denoised latent (x0) to image
+                decoded_image = self.decode_latent(x0)
+                # Call user's preview callback with decoded image
+                preview_callback(decoded_image)
+            except Exception as e:
+                # Don't crash sampling if preview fails
+                print(f"[ComfyUI Sampler] Preview callback error: {e}")
         
-        return result_pil
+        return sampler_callback_wrapper
@@ -2,18 +2,24 @@
 DINO conditioning adapter for FLUX diffusion
 Projects DINO embeddings into FLUX latent space for semantic guidance
 """
+import weakref
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from typing import Optional, Tuple
 
+POOLING_METHODS = ("avg", "kmeans", "topk")
+
 
 class DINOConditioningAdapter:
     def __init__(
         self,
         dino_dim: int = 768,
         flux_dim: int = 4096,
-        device: Optional[str] = None
+        device: Optional[str] = None,
+        projection_cache_size: int = 64
     ):
         """
         Initialize DINO conditioning adapter
@@ -22,6 +28,8 @@ class DINOConditioningAdapter:
             dino_dim: DINO feature dimension (768 for dinov2-base)
             flux_dim: FLUX cross-attention dimension (4096 for FLUX.1)
             device: Target device (cuda/cpu), auto-detected if None
+            projection_cache_size: Projections memoised by align_and_project
+                                   (0 = no memoisation)
         """
         self.dino_dim = dino_dim
         self.flux_dim = flux_dim
@@ -35,6 +43,13 @@ class DINOConditioningAdapter:
         nn.init.zeros_(self.projection.bias)
         
         self.projection.eval()
+        
+        # DINO tokens produced by the last prepare_conditioning_embeddings call
+        self.last_sequence_length = None
+        
+        # LRU of align_and_project results: key -> (weakref to features, projected)
+        self.projection_cache_size = projection_cache_size
+        self._projection_cache = OrderedDict()
     
     def project_features(
         self,
@@ -64,31 +79,51 @@ class DINOConditioningAdapter:
             
             return projected
     
+    @staticmethod
+    def _grid_shape(num_patches: int, source_shape: Optional[Tuple[int, int]]) -> Tuple[int, int]:
+        """Patch grid (grid_h, grid_w) of num_patches flat features"""
+        if source_shape is not None:
+            source_h, source_w = source_shape
+            if source_h * source_w != num_patches:
+                raise ValueError(f"DINO grid {source_h}x{source_w} does not match {num_patches} patches")
+            return source_h, source_w
+        
+        # Infer source grid dimensions from number of patches
+        side = int(num_patches ** 0.5)
+        
+        # Validate square grid
+        if side * side != num_patches:
+            raise ValueError(f"DINO features must form square grid, got {num_patches} patches "
+                             f"(pass source_shape for rectangular grids)")
+        return side, side
+    
     def align_spatial_dimensions(
         self,
         dino_features: torch.Tensor,
         target_shape: Tuple[int, int],
-        mode: str = "bilinear"
+        mode: str = "bilinear",
+        source_shape: Optional[Tuple[int, int]] = None
     ) -> torch.Tensor:
         """
         Align DINO patch features to target spatial dimensions
         
         Args:
-            dino_features: DINO features (num_patches, feature_dim)
+            dino_features: DINO features (num_patches, feature_dim), or a
+                           patch grid (grid_h, grid_w, feature_dim)
             target_shape: Target (height, width) in patches
             mode: Interpolation mode (bilinear, nearest, bicubic)
+            source_shape: (grid_h, grid_w) of flat features, e.g. from
+                          extract_features_native; a square grid is assumed
+                          if omitted
             
         Returns:
             Spatially aligned features (target_h*target_w, feature_dim)
         """
-        # Infer source grid dimensions from number of patches
-        num_patches = dino_features.shape[0]
-        source_h = source_w = int(num_patches ** 0.5)
-        
-        # Validate square grid
-        if source_h * source_w != num_patches:
-            raise ValueError(f"DINO features must form square grid, got {num_patches} patches")
+        if dino_features.dim() == 3:
+            source_shape = tuple(dino_features.shape[:2])
+            dino_features = dino_features.reshape(-1, dino_features.shape[2])
         
+        source_h, source_w = self._grid_shape(dino_features.shape[0], source_shape)
         target_h, target_w = target_shape
         
         # If dimensions match, no interpolation needed
@@ -114,31 +149,227 @@ class DINOConditioningAdapter:
         
         return features_aligned
     
+    def align_and_project(
+        self,
+        dino_features: torch.Tensor,
+        target_shape: Optional[Tuple[int, int]] = None,
+        conditioning_strength: float = 0.5,
+        source_shape: Optional[Tuple[int, int]] = None,
+        mode: str = "bilinear",
+        grid: bool = False
+    ) -> torch.Tensor:
+        """
+        Align and project a batch of DINO feature maps in one pass
+        
+        All maps are interpolated together in DINO space, where it is
+        cheaper, then projected with a single matmul that applies the
+        strength as well. Results are memoised by feature tensor identity
+        (and its in-place version), target shape and strength, so the same
+        features conditioning many tiles are projected once; treat the
+        returned tensor as read-only.
+        
+        Args:
+            dino_features: Flat features (N, num_patches, dino_dim), patch
+                           grids (N, grid_h, grid_w, dino_dim), or a single
+                           map (num_patches, dino_dim)
+            target_shape: Target (height, width) in patches (None = no
+                          alignment)
+            conditioning_strength: Strength of conditioning (0.0-1.0)
+            source_shape: (grid_h, grid_w) of flat features; a square grid
+                          is assumed if omitted
+            mode: Interpolation mode (bilinear, nearest, bicubic)
+            grid: Treat a 3-D input as one patch grid (grid_h, grid_w,
+                  dino_dim) rather than a batch of flat maps
+            
+        Returns:
+            Projected features (N, tokens, flux_dim), or (tokens, flux_dim)
+            for a single map
+        """
+        key = None
+        if self.projection_cache_size:
+            # Inference tensors (all extractor output) have no version counter,
+            # and cannot be modified in place outside inference mode anyway
+            version = None if dino_features.is_inference() else dino_features._version
+            key = (id(dino_features), version, grid,
+                   tuple(target_shape) if target_shape is not None else None,
+                   tuple(source_shape) if source_shape is not None else None,
+                   float(conditioning_strength), mode, self.projection.weight._version)
+            entry = self._projection_cache.get(key)
+            if entry is not None and entry[0]() is dino_features:
+                self._projection_cache.move_to_end(key)
+                return entry[1]
+        
+        single = dino_features.dim() == 2 or (grid and dino_features.dim() == 3)
+        features = dino_features.unsqueeze(0) if single else dino_features
+        if features.dim() == 4:
+            source_shape = tuple(features.shape[1:3])
+            features = features.flatten(1, 2)
+        
+        weight = self.projection.weight
+        with torch.no_grad():
+            features = features.to(device=weight.device, dtype=weight.dtype)
+            batch, num_patches, feature_dim = features.shape
+            
+            if target_shape is not None:
+                source_h, source_w = self._grid_shape(num_patches, source_shape)
+                target_h, target_w = target_shape
+                if (source_h, source_w) != (target_h, target_w):
+                    # (N, P, D) -> (N, D, H, W) is a view; interpolate every map at once
+                    grids = features.transpose(1, 2).unflatten(2, (source_h, source_w))
+                    grids = F.interpolate(grids, size=(target_h, target_w), mode=mode,
+                                          align_corners=False if mode == "bilinear" else None)
+                    features = grids.flatten(2).transpose(1, 2)
+            
+            # strength * (x @ W.T + b) as one matmul over every token of every map
+            tokens = features.reshape(-1, feature_dim)
+            projected = torch.addmm(self.projection.bias, tokens, weight.t(),
+                                    beta=conditioning_strength, alpha=conditioning_strength)
+            projected = projected.reshape(batch, -1, self.flux_dim)
+        
+        if single:
+            projected = projected[0]
+        if key is not None:
+            self._remember_projection(key, dino_features, projected)
+        return projected
+    
+    def _remember_projection(self, key, dino_features, projected):
+        cache = self._projection_cache
+        
+        def forget(ref):
+            # Features freed: their projection can never be looked up again
+            entry = cache.get(key)
+            if entry is not None and entry[0] is ref:
+                del cache[key]
+        
+        cache[key] = (weakref.ref(dino_features, forget), projected)
+        while len(cache) > self.projection_cache_size:
+            cache.popitem(last=False)
+    
+    def pool_tokens(
+        self,
+        dino_features: torch.Tensor,
+        num_tokens: int,
+        method: str = "avg",
+        source_shape: Optional[Tuple[int, int]] = None,
+        iterations: int = 10
+    ) -> torch.Tensor:
+        """
+        Reduce DINO patch features to at most num_tokens tokens
+        
+        "avg" average-pools the patch grid to a coarser grid of the same
+        aspect ratio, "kmeans" returns cluster centroids of the patch
+        features and "topk" keeps the most salient patches (furthest from
+        the mean feature), in grid order.
+        
+        Args:
+            dino_features: DINO features (num_patches, feature_dim), or a
+                           patch grid (grid_h, grid_w, feature_dim)
+            num_tokens: Maximum number of tokens to return
+            method: "avg", "kmeans" or "topk"
+            source_shape: (grid_h, grid_w) of flat features; a square grid
+                          is assumed if omitted
+            iterations: k-means iterations
+            
+        Returns:
+            Pooled features (tokens, feature_dim), tokens <= num_tokens
+        """
+        if method not in POOLING_METHODS:
+            raise ValueError(f"Unknown pooling method '{method}', expected one of {POOLING_METHODS}")
+        if num_tokens < 1:
+            raise ValueError(f"num_tokens must be at least 1, got {num_tokens}")
+        
+        if dino_features.dim() == 3:
+            source_shape = tuple(dino_features.shape[:2])
+            dino_features = dino_features.reshape(-1, dino_features.shape[2])
+        
+        num_patches, feature_dim = dino_features.shape
+        if num_patches <= num_tokens:
+            return dino_features
+        
+        if method == "avg":
+            if source_shape is None:
+                side = int(num_patches ** 0.5)
+                source_shape = (side, side) if side * side == num_patches else None
+            if source_shape is None:
+                # No grid to pool over: pool along the token sequence
+                pooled = F.adaptive_avg_pool1d(dino_features.t().unsqueeze(0).float(), num_tokens)
+                return pooled[0].t().to(dino_features.dtype)
+            
+            # Largest grid with the source's aspect ratio and at most num_tokens cells
+            source_h, source_w = source_shape
+            pool_h = max(1, min(source_h, int((num_tokens * source_h / source_w) ** 0.5)))
+            pool_w = max(1, min(source_w, num_tokens // pool_h))
+            grid = dino_features.reshape(source_h, source_w, feature_dim).permute(2, 0, 1)
+            pooled = F.adaptive_avg_pool2d(grid.unsqueeze(0).float(), (pool_h, pool_w))
+            return pooled[0].permute(1, 2, 0).reshape(-1, feature_dim).to(dino_features.dtype)
+        
+        features = dino_features.float()
+        if method == "topk":
+            saliency = (features - features.mean(dim=0)).norm(dim=1)
+            indices = saliency.topk(num_tokens).indices.sort().values
+            return dino_features[indices]
+        
+        # k-means (Lloyd), seeded with evenly spaced patches so results are deterministic
+        seeds = torch.linspace(0, num_patches - 1, num_tokens, device=features.device).long()
+        centroids = features[seeds].clone()
+        for _ in range(iterations):
+            assignment = torch.cdist(features, centroids).argmin(dim=1)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, features)
+            counts = torch.bincount(assignment, minlength=num_tokens).unsqueeze(1)
+            # Empty clusters keep their previous centroid
+            centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+        return centroids.to(dino_features.dtype)
+    
     def prepare_conditioning_embeddings(
         self,
         dino_features: torch.Tensor,
         text_embeddings: Optional[torch.Tensor] = None,
         target_shape: Optional[Tuple[int, int]] = None,
-        conditioning_strength: float = 0.5
+        conditioning_strength: float = 0.5,
+        source_shape: Optional[Tuple[int, int]] = None,
+        max_tokens: Optional[int] = None,
+        pooling: str = "avg"
     ) -> torch.Tensor:
         """
         Prepare DINO features as conditioning embeddings for FLUX
         
+        The number of DINO tokens produced is stored in last_sequence_length.
+        
         Args:
             dino_features: DINO patch embeddings
             text_embeddings: Optional text embeddings to concatenate
             target_shape: Optional target spatial shape for alignment
             conditioning_strength: Strength of DINO conditioning
+            source_shape: (grid_h, grid_w) of rectangular flat features
+            max_tokens: Pool DINO features to at most this many tokens
+                        before projection (None = one token per patch)
+            pooling: Pooling method for max_tokens (see pool_tokens)
             
         Returns:
             Conditioning embeddings ready for FLUX cross-attention
         """
-        # Spatial alignment if target shape specified
-        if target_shape is not None:
-            dino_features = self.align_spatial_dimensions(dino_features, target_shape)
-        
-        # Project to FLUX space
-        projected = self.project_features(dino_features, conditioning_strength)
+        if max_tokens is None:
+            # Fused, memoised alignment and projection, keyed on the caller's tensor
+            projected = self.align_and_project(dino_features, target_shape,
+                                               conditioning_strength, source_shape,
+                                               grid=dino_features.dim() == 3)
+        else:
+            # Spatial alignment if target shape specified
+            if target_shape is not None:
+                dino_features = self.align_spatial_dimensions(dino_features, target_shape,
+                                                              source_shape=source_shape)
+                source_shape = tuple(target_shape)
+            elif dino_features.dim() == 3:
+                source_shape = tuple(dino_features.shape[:2])
+                dino_features = dino_features.reshape(-1, dino_features.shape[2])
+            
+            # Bound the number of cross-attention tokens before projecting
+            dino_features = self.pool_tokens(dino_features, max_tokens, pooling,
+                                             source_shape=source_shape)
+            
+            # Project to FLUX space
+            projected = self.project_features(dino_features, conditioning_strength)
+        self.last_sequence_length = projected.shape[-2]
         
         # Concatenate with text embeddings if provided
         if text_embeddings is not None:
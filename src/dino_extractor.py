@@ -1,41 +1,334 @@
 """
 DINO feature extractor for semantic embeddings
 """
+import contextlib
+import json
+
 import torch
-from transformers import AutoImageProcessor, AutoModel
+import torch.nn.functional as F
 from PIL import Image
 import numpy as np
 
+try:
+    from .tile_cache import tensor_digest
+    from .feature_pyramid import FeaturePyramid
+except ImportError:
+    from tile_cache import tensor_digest
+    from feature_pyramid import FeaturePyramid
+
+
+# precision -> autocast dtype (None runs in the weights' own dtype)
+PRECISIONS = {
+    "fp32": None,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+    "int8": None,
+}
+
 
 class DINOFeatureExtractor:
-    def __init__(self, model_name="facebook/dinov2-base"):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    def __init__(self, model_name="facebook/dinov2-base", feature_cache=None, precision="fp32",
+                 attn_implementation="sdpa", device_preprocess=True, usage=None):
+        """
+        Args:
+            model_name: HuggingFace DINOv2 model
+            feature_cache: Optional FeatureCache; features of images seen
+                           before are served from it instead of the model
+            precision: "fp32"; "fp16" or "bf16" (autocast, weights stay
+                       fp32); or "int8" (dynamic int8 quantisation of the
+                       Linear layers, CPU only)
+            attn_implementation: Attention kernel ("sdpa" uses
+                                 torch.nn.functional.scaled_dot_product_attention)
+            device_preprocess: Resize and normalise images with torch on the
+                               model's device (see _preprocess) instead of
+                               the HF image processor on the CPU
+            usage: Optional callable returning a context manager entered
+                   around each forward, e.g. functools.partial(registry.use,
+                   key), so the model's owner knows when it is running
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {list(PRECISIONS)}")
+        # transformers is slow to import, so only load it with the model
+        from transformers import AutoImageProcessor, AutoModel
+        
+        # Quantised Linear kernels only run on the CPU
+        use_cuda = torch.cuda.is_available() and precision != "int8"
+        self.device = torch.device("cuda" if use_cuda else "cpu")
+        self.model_name = model_name
+        self.precision = precision
+        self.feature_cache = feature_cache
+        self.device_preprocess = device_preprocess
+        self.usage = usage or contextlib.nullcontext
         self.processor = AutoImageProcessor.from_pretrained(model_name)
-        self.model = AutoModel.from_pretrained(model_name).to(self.device)
-        self.model.eval()
+        try:
+            model = AutoModel.from_pretrained(model_name, attn_implementation=attn_implementation)
+        except (TypeError, ValueError, ImportError):
+            # Older transformers versions without this attention kernel
+            model = AutoModel.from_pretrained(model_name)
+        model.eval()
+        if precision == "int8":
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model.to(self.device)
+        # Cache keys cover the preprocessing as well as the pixels and model
+        config = self.processor.to_dict()
+        self._preprocess_config = json.dumps(config, sort_keys=True, default=str)
+        self._resize_size = dict(config.get("size") or {})
+        self._crop_size = dict(config.get("crop_size") or {}) if config.get("do_center_crop", True) else {}
+        self._mean = torch.tensor(config.get("image_mean", [0.485, 0.456, 0.406]))
+        self._std = torch.tensor(config.get("image_std", [0.229, 0.224, 0.225]))
+    
+    def offload(self):
+        """Move the model to the CPU to free device memory; it moves back on next use"""
+        self.model.to("cpu")
     
-    @torch.no_grad()
+    def _autocast(self):
+        """Autocast context for fp16/bf16 precision, a no-op otherwise"""
+        dtype = PRECISIONS[self.precision]
+        if dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=dtype)
+    
+    @torch.inference_mode()
     def extract_features(self, image):
         """
         Extract patch-level DINO features from an image
         
         Args:
-            image: PIL Image or numpy array
+            image: PIL Image, numpy array, or ComfyUI image tensor [H, W, C] (0.0-1.0)
             
         Returns:
             Tensor of shape (num_patches, feature_dim)
         """
-        if isinstance(image, np.ndarray):
-            image = Image.fromarray(image)
+        return self.extract_features_batch([image])[0]
+    
+    @torch.inference_mode()
+    def extract_features_native(self, image, resolution=518):
+        """
+        Extract DINO features at (close to) native aspect ratio, in one forward
+        
+        The image is resized so its longer side is `resolution` (both sides
+        rounded to whole patches) instead of being cropped to a 224px square.
+        DINOv2 interpolates its position embeddings to the resulting grid.
+        
+        Args:
+            image: PIL Image, numpy array, or ComfyUI image tensor [H, W, C] (0.0-1.0)
+            resolution: Longer side of the model input, in pixels
+            
+        Returns:
+            (features, (grid_h, grid_w)) with features of shape
+            (grid_h * grid_w, feature_dim)
+        """
+        features = self.extract_features_batch([image], grid=True, resolution=resolution)[0]
+        return features.flatten(0, 1), tuple(features.shape[:2])
+    
+    @torch.inference_mode()
+    def extract_features_batch(self, images, batch_size=8, grid=False, resolution=None):
+        """
+        Extract patch-level DINO features from several images at once
+        
+        Args:
+            images: List of images (as in extract_features), or a ComfyUI
+                    image batch tensor [B, H, W, C] (0.0-1.0)
+            batch_size: Maximum images per model forward pass
+            grid: Return each image's features as a patch grid
+            resolution: If set, skip the processor's 224px center crop: every
+                        image is resized to the input size whose longer side
+                        is `resolution` at the first image's aspect ratio
+                        (see extract_features_native)
+            
+        Returns:
+            Tensor of shape (num_images, num_patches, feature_dim), or
+            (num_images, grid_h, grid_w, feature_dim) with grid=True
+        """
+        if self.device_preprocess:
+            images = [self._to_tensor(image) for image in images]
+            sizes = [tuple(image.shape[:2]) for image in images]
+        else:
+            images = [self._to_pil(image) for image in images]
+            sizes = [image.size[::-1] for image in images]
+        
+        # Native mode: one input size for all images, so they batch together
+        native_size = None
+        process_kwargs = {}
+        if resolution and images:
+            native_size = self._native_size(*sizes[0], resolution)
+            process_kwargs = {"do_center_crop": False, "size": dict(zip(("height", "width"), native_size))}
+        
+        # Serve images seen before from the cache; only the rest go through the model
+        feature_cache = self.feature_cache
+        features = [None] * len(images)
+        keys = [None] * len(images)
+        if feature_cache is not None:
+            for i, image in enumerate(images):
+                keys[i] = self._cache_key(image, grid, process_kwargs)
+                features[i] = feature_cache.get(keys[i])
+        misses = [i for i, cached in enumerate(features) if cached is None]
+        
+        for start in range(0, len(misses), batch_size):
+            batch = misses[start:start + batch_size]
+            if self.device_preprocess:
+                pixel_values = self._preprocess([images[i] for i in batch], native_size)
+            else:
+                pixel_values = self.processor(images=[images[i] for i in batch], return_tensors="pt",
+                                              **process_kwargs)["pixel_values"].to(self.device)
+            
+            with self.usage():
+                self.model.to(self.device)  # no-op unless offloaded
+                with self._autocast():
+                    outputs = self.model(pixel_values=pixel_values)
+            # Get patch embeddings (excluding CLS token)
+            patches = outputs.last_hidden_state[:, 1:, :]
+            if grid:
+                patch_size = self.model.config.patch_size
+                grid_h, grid_w = (size // patch_size for size in pixel_values.shape[-2:])
+                patches = patches.reshape(patches.shape[0], grid_h, grid_w, -1)
+            for j, i in enumerate(batch):
+                features[i] = patches[j]
+                if feature_cache is not None:
+                    # Return what later hits will, so results do not depend on the cache state
+                    features[i] = feature_cache.put(keys[i], patches[j])
+        
+        return torch.stack([f.to(self.device, torch.float32) for f in features])
+    
+    def _preprocess(self, images, size=None):
+        """
+        Torch equivalent of the HF image processor, run on the model's device
         
-        inputs = self.processor(images=image, return_tensors="pt")
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        Resizes (bicubic, antialiased) to the processor's shortest edge and
+        center-crops, or resizes straight to `size` in native mode, then
+        normalises with the processor's mean/std and zero-pads to whole
+        patches. Input stays float, so nothing is quantised to uint8.
         
-        outputs = self.model(**inputs)
-        # Get patch embeddings (excluding CLS token)
-        features = outputs.last_hidden_state[:, 1:, :]
+        Args:
+            images: List of [H, W, C] float tensors (0.0-1.0); all must
+                    come out the same size
+            size: Optional (height, width) to resize to instead of
+                  shortest edge + center crop
+            
+        Returns:
+            pixel_values tensor [B, 3, h, w] on self.device
+        """
+        patch_size = self.model.config.patch_size
+        mean = self._mean.to(self.device)[:, None, None]
+        std = self._std.to(self.device)[:, None, None]
+        
+        batch = []
+        for image in images:
+            x = image.to(self.device, torch.float32)
+            x = x.expand(-1, -1, 3) if x.shape[-1] == 1 else x[..., :3]
+            x = x.movedim(-1, 0)[None]
+            
+            height, width = x.shape[-2:]
+            crop = None
+            if size is not None:
+                resize = size
+            elif "shortest_edge" in self._resize_size:
+                # As transformers' get_resize_output_image_size: shorter side to shortest_edge
+                short = self._resize_size["shortest_edge"]
+                if height <= width:
+                    resize = (short, int(short * width / height))
+                else:
+                    resize = (int(short * height / width), short)
+                crop = self._crop_size or None
+            else:
+                resize = (self._resize_size["height"], self._resize_size["width"])
+                crop = self._crop_size or None
+            
+            if tuple(resize) != (height, width):
+                x = F.interpolate(x, size=tuple(resize), mode="bicubic", align_corners=False,
+                                  antialias=True).clamp_(0.0, 1.0)
+            if crop:
+                top = int((x.shape[-2] - crop["height"]) / 2)
+                left = int((x.shape[-1] - crop["width"]) / 2)
+                x = x[..., top:top + crop["height"], left:left + crop["width"]]
+            
+            x = (x - mean) / std
+            x = F.pad(x, (0, -x.shape[-1] % patch_size, 0, -x.shape[-2] % patch_size))
+            batch.append(x)
+        
+        return torch.cat(batch)
+    
+    def _cache_key(self, image, grid, process_kwargs=None):
+        """Feature cache key: image pixels, model and preprocessing config"""
+        if isinstance(image, Image.Image):
+            image = torch.from_numpy(np.asarray(image.convert("RGB")))
+        return tensor_digest(image, model=self.model_name, preprocess=self._preprocess_config,
+                             overrides=process_kwargs or {}, device_preprocess=self.device_preprocess,
+                             precision=self.precision, grid=grid)
+    
+    def _native_size(self, height, width, resolution):
+        """Model input (height, width): longer side `resolution`, whole patches per side"""
+        patch_size = self.model.config.patch_size
+        scale = resolution / max(height, width)
+        return tuple(max(1, round(side * scale / patch_size)) * patch_size for side in (height, width))
+    
+    @torch.inference_mode()
+    def extract_tile_features(self, image, rects, batch_size=8, resolution=None):
+        """
+        Extract a patch grid for every tile of one image
+        
+        All tiles go through the model together, batch_size at a time,
+        rather than in one forward pass each.
+        
+        Args:
+            image: PIL Image, numpy array, or image tensor [H, W, C] (0.0-1.0)
+            rects: (x, y, width, height) of each tile, in image pixels
+            batch_size: Maximum tiles per model forward pass
+            resolution: Optional native-resolution input size (see
+                        extract_features_batch); all tiles share the first
+                        tile's grid
+            
+        Returns:
+            Tensor of shape (num_tiles, grid_h, grid_w, feature_dim)
+        """
+        if isinstance(image, Image.Image):
+            image = np.array(image)
+        crops = [image[y:y + h, x:x + w] for x, y, w, h in rects]
+        return self.extract_features_batch(crops, batch_size=batch_size, grid=True,
+                                           resolution=resolution)
+    
+    @torch.inference_mode()
+    def extract_pyramid(self, image, resolutions=(224, 448, 672)):
+        """
+        Extract a multi-scale feature pyramid of a whole image
+        
+        One native-resolution forward per level (see extract_features_native);
+        the features of any tile are then cropped from the pyramid instead of
+        running the model on every tile.
+        
+        Args:
+            image: PIL Image, numpy array, or image tensor [H, W, C] (0.0-1.0)
+            resolutions: Longer side of the model input for each level
+            
+        Returns:
+            FeaturePyramid over the image
+        """
+        image = self._to_tensor(image) if self.device_preprocess else self._to_pil(image)
+        size = tuple(image.shape[:2]) if isinstance(image, torch.Tensor) else image.size[::-1]
+        levels = [self.extract_features_batch([image], grid=True, resolution=resolution)[0]
+                  for resolution in sorted(resolutions)]
+        return FeaturePyramid(levels, size)
+    
+    def _to_tensor(self, image):
+        """Convert a PIL Image or numpy array to an [H, W, C] float tensor (0.0-1.0)"""
+        if isinstance(image, torch.Tensor):
+            return image
+        if isinstance(image, Image.Image):
+            image = np.asarray(image.convert("RGB"))
+        tensor = torch.from_numpy(np.ascontiguousarray(image))
+        if tensor.dtype == torch.uint8:
+            tensor = tensor.float() / 255.0
+        return tensor if tensor.ndim == 3 else tensor[..., None]
+    
+    def _to_pil(self, image):
+        """Convert a numpy array or [H, W, C] tensor (0.0-1.0) to a PIL Image"""
+        if isinstance(image, torch.Tensor):
+            image = (image.detach().cpu().clamp(0.0, 1.0) * 255.0).round().to(torch.uint8).numpy()
+        
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
         
-        return features.squeeze(0)
+        return image
     
     def get_patch_grid_size(self, image_size):
         """Calculate the patch grid dimensions for an image size"""
@@ -0,0 +1,135 @@
+"""
+Two-level cache of DINO features: in-memory LRU in front of an fp16 disk store
+"""
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class FeatureCache:
+    """
+    Cache of extracted DINO features, keyed by image content
+
+    Recently used features stay in memory (LRU, capped at memory_bytes).
+    With a directory set, features are also written there as .npz files,
+    which survive restarts and are evicted least recently used first once
+    the directory grows past disk_bytes. Both levels store fp16 and return
+    fp32, so a hit gives the same values whichever level serves it.
+    """
+
+    def __init__(self, directory=None, memory_bytes=256 * 1024 ** 2, disk_bytes=1024 ** 3):
+        """
+        Args:
+            directory: Directory for the disk store (None = memory only)
+            memory_bytes: Size cap of the in-memory LRU
+            disk_bytes: Size cap of the disk store
+        """
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        """Return the cached features (fp32 CPU tensor), or None on a miss"""
+        features = self._memory.get(key)
+        if features is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return features.float()
+
+        if self.directory:
+            path = self._path(key)
+            try:
+                with np.load(path) as data:
+                    features = torch.from_numpy(data["features"].astype(np.float16))
+            except (OSError, ValueError, KeyError):
+                features = None
+            if features is not None:
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                self.disk_hits += 1
+                self._remember(key, features)
+                return features.float()
+
+        self.misses += 1
+        return None
+
+    def put(self, key, features):
+        """
+        Store features in memory and, with a directory set, on disk
+
+        Returns:
+            The features as get() will return them (fp16-rounded fp32)
+        """
+        # A new fp16 tensor, so the entry never keeps a larger batch's storage alive
+        features = features.detach().to("cpu", torch.float16, copy=True)
+        self._remember(key, features)
+        if self.directory:
+            self._write(key, features)
+            self._evict_disk()
+        return features.float()
+
+    def _remember(self, key, features):
+        if key in self._memory:
+            self._memory_size -= self._memory.pop(key).nbytes
+        self._memory[key] = features
+        self._memory_size += features.nbytes
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= evicted.nbytes
+
+    def _write(self, key, features):
+        # Written to a temporary file first, so readers never see a partial file
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, features=features.numpy())
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _evict_disk(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".npz"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        # Least recently used first
+        for _, size, path in sorted(entries):
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups served from memory or disk"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        """Hit counts per level, misses and hit rate since the cache was created"""
+        return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits,
+                "misses": self.misses, "hit_rate": self.hit_rate}
@@ -0,0 +1,62 @@
+"""
+Multi-scale DINO feature pyramid, cropped per tile
+"""
+import torch
+import torch.nn.functional as F
+
+
+class FeaturePyramid:
+    """
+    DINO patch grids of one image at several input resolutions
+
+    Every level covers the whole image, so the features of any region can
+    be cropped and resampled from the grids by pixel coordinates, instead
+    of running the model on the region itself.
+    """
+
+    def __init__(self, levels, image_size):
+        """
+        Args:
+            levels: Patch grids [grid_h, grid_w, D], coarsest first
+            image_size: (height, width) of the image in pixels
+        """
+        self.levels = list(levels)
+        self.image_size = image_size
+
+    def grid_size(self, rect):
+        """Patch grid (grid_h, grid_w) the finest level has over rect"""
+        _, _, w, h = rect
+        image_h, image_w = self.image_size
+        grid_h, grid_w = self.levels[-1].shape[:2]
+        return max(1, round(h * grid_h / image_h)), max(1, round(w * grid_w / image_w))
+
+    def crop(self, rect, grid_size=None):
+        """
+        Features of an image region, averaged over all levels
+
+        Each level is bilinearly sampled at the centres of a grid_size grid
+        laid over rect, so regions need not line up with patch boundaries.
+
+        Args:
+            rect: (x, y, width, height) in image pixels
+            grid_size: Output (grid_h, grid_w) (default: see grid_size())
+
+        Returns:
+            Tensor [grid_h, grid_w, D]
+        """
+        x, y, w, h = rect
+        out_h, out_w = grid_size or self.grid_size(rect)
+        image_h, image_w = self.image_size
+        device = self.levels[0].device
+
+        # Sample positions in normalised [-1, 1] image coordinates
+        xs = (x + (torch.arange(out_w, device=device) + 0.5) * w / out_w) / image_w * 2 - 1
+        ys = (y + (torch.arange(out_h, device=device) + 0.5) * h / out_h) / image_h * 2 - 1
+        grid = torch.stack(torch.meshgrid(xs, ys, indexing="xy"), dim=-1)[None]
+
+        result = None
+        for level in self.levels:
+            sampled = F.grid_sample(level.permute(2, 0, 1)[None].float(), grid.float(),
+                                    mode="bilinear", padding_mode="border", align_corners=False)
+            result = sampled if result is None else result + sampled
+        return (result / len(self.levels))[0].permute(1, 2, 0)
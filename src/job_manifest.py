@@ -0,0 +1,89 @@
+"""
+Resumable upscale jobs: per-tile checkpoints on disk
+"""
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+try:
+    from .tile_cache import save_tensor
+except ImportError:
+    from tile_cache import save_tensor
+
+
+class JobManifest:
+    """
+    Checkpoint of an upscale job in progress
+
+    Each job gets a subdirectory of the jobs directory named after its key,
+    holding manifest.json (job key, tile plan and completed tile indices)
+    and one .npy file per completed tile. Opening a job whose manifest has
+    the same key and tile plan resumes it: completed tiles are loaded
+    instead of sampled. A stale or corrupt checkpoint is discarded.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, jobs_dir, job_key, rects):
+        """
+        Args:
+            jobs_dir: Directory holding the checkpoints of all jobs
+            job_key: Hash of everything the job's output depends on
+            rects: (x, y, width, height) of every tile in the plan
+        """
+        job_dir = os.path.join(jobs_dir, "job_" + job_key[:16])
+        self.job_dir = job_dir
+        self.job_key = job_key
+        self.rects = [list(rect) for rect in rects]
+        self.completed = set()
+
+        manifest = self._read_manifest()
+        if manifest and manifest.get("job") == job_key and manifest.get("rects") == self.rects:
+            self.completed = {i for i in manifest.get("completed", [])
+                              if os.path.exists(self._tile_path(i))}
+        elif os.path.isdir(job_dir):
+            # A different job (or a corrupt one) used this directory
+            shutil.rmtree(job_dir)
+
+        os.makedirs(job_dir, exist_ok=True)
+        self._write_manifest()
+
+    @property
+    def resumed(self):
+        """Number of tiles restored from a previous run"""
+        return len(self.completed)
+
+    def _tile_path(self, index):
+        return os.path.join(self.job_dir, f"tile_{index:05d}.npy")
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.job_dir, self.MANIFEST)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self):
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.job_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"job": self.job_key, "rects": self.rects,
+                       "completed": sorted(self.completed)}, f)
+        os.replace(temp_path, os.path.join(self.job_dir, self.MANIFEST))
+
+    def load_tile(self, index):
+        """Return the checkpointed output of a completed tile"""
+        return torch.from_numpy(np.load(self._tile_path(index)))
+
+    def record(self, index, tile):
+        """Checkpoint the output of a finished tile"""
+        save_tensor(self._tile_path(index), tile)
+        self.completed.add(index)
+        self._write_manifest()
+
+    def finish(self):
+        """Delete the checkpoint once the job's result is safely written"""
+        shutil.rmtree(self.job_dir, ignore_errors=True)
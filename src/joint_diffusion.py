@@ -0,0 +1,103 @@
+"""
+MultiDiffusion-style joint denoising of overlapping latent tiles
+"""
+import torch
+
+try:
+    from .tile_stitcher import TileStitcher
+except ImportError:
+    from tile_stitcher import TileStitcher
+
+
+class JointTileDenoiser:
+    """
+    Model function wrapper that denoises a large latent as overlapping windows
+
+    Installed with ModelPatcher.set_model_unet_function_wrapper, it is called
+    for every model evaluation of the sampler. Each call splits the full
+    latent into the planned windows, runs them through the model in batches,
+    and blends the predictions back together with the stitcher's blend
+    weights. All windows therefore see the same averaged latent at every step,
+    so seams are reconciled during sampling and small overlaps suffice.
+    """
+
+    def __init__(self, rects, overlap=8, tile_batch_size=1, inner_wrapper=None):
+        """
+        Args:
+            rects: (x, y, width, height) windows in latent cells; must form a
+                   rectilinear grid covering the latent
+            overlap: Blend width between windows, in latent cells
+            tile_batch_size: Maximum number of windows per model call
+            inner_wrapper: Previously installed model function wrapper to
+                           call for each batch of windows, if any
+        """
+        self.rects = list(rects)
+        self.overlap = overlap
+        self.tile_batch_size = max(1, tile_batch_size)
+        self.inner_wrapper = inner_wrapper
+
+        # Windows of the same size are batched together
+        self._groups = {}
+        for rect in self.rects:
+            self._groups.setdefault(rect[2:], []).append(rect)
+
+    def __call__(self, apply_model, args):
+        x = args["input"]
+        timestep = args["timestep"]
+        conditioning = args["c"]
+        batch, _, height, width = x.shape
+
+        stitcher = None
+        for rects in self._groups.values():
+            for start in range(0, len(rects), self.tile_batch_size):
+                chunk = rects[start:start + self.tile_batch_size]
+                output = self._apply_windows(apply_model, args, x, timestep, conditioning, chunk)
+
+                if stitcher is None:
+                    channels = output.shape[1]
+                    stitcher = TileStitcher((width, height), self.rects, overlap=self.overlap,
+                                            channels=batch * channels, device=x.device, dtype=x.dtype)
+
+                # Stitch channels-last with batch folded into channels
+                for k, (rx, ry, rw, rh) in enumerate(chunk):
+                    window = output[k * batch:(k + 1) * batch]
+                    stitcher.add(window.permute(2, 3, 0, 1).reshape(rh, rw, -1), rx, ry)
+
+        result = stitcher.result().reshape(height, width, batch, -1)
+        return result.permute(2, 3, 0, 1).contiguous()
+
+    def _apply_windows(self, apply_model, args, x, timestep, conditioning, rects):
+        """Run one batch of same-sized windows through the model"""
+        batch, _, height, width = x.shape
+        count = len(rects)
+
+        def crop(tensor):
+            return torch.cat([tensor[..., ry:ry + rh, rx:rx + rw] for rx, ry, rw, rh in rects])
+
+        window_conditioning = {}
+        for key, value in conditioning.items():
+            if isinstance(value, torch.Tensor) and value.ndim >= 4 and value.shape[-2:] == (height, width):
+                # Spatial conditioning (e.g. c_concat) is cropped like the latent
+                window_conditioning[key] = crop(value)
+            elif isinstance(value, torch.Tensor) and value.ndim > 0 and value.shape[0] == batch:
+                window_conditioning[key] = value.repeat(count, *([1] * (value.ndim - 1)))
+            else:
+                window_conditioning[key] = value
+
+        # Attention patches split the batch by cond_or_uncond; repeat it per window
+        options = window_conditioning.get("transformer_options")
+        if isinstance(options, dict) and "cond_or_uncond" in options:
+            window_conditioning["transformer_options"] = dict(
+                options, cond_or_uncond=list(options["cond_or_uncond"]) * count
+            )
+
+        window_x = crop(x)
+        window_timestep = timestep.repeat(count)
+
+        if self.inner_wrapper is not None:
+            window_args = dict(args, input=window_x, timestep=window_timestep, c=window_conditioning)
+            if "cond_or_uncond" in args:
+                window_args["cond_or_uncond"] = list(args["cond_or_uncond"]) * count
+            return self.inner_wrapper(apply_model, window_args)
+
+        return apply_model(window_x, window_timestep, **window_conditioning)
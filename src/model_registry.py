@@ -0,0 +1,206 @@
+"""
+Process-wide registry of shared models with idle offload
+"""
+import contextlib
+import math
+import threading
+import time
+
+import torch
+
+
+class ModelRegistry:
+    """
+    Hands out one shared instance per key (e.g. model name and precision)
+
+    Holders acquire() an instance and release() it when done; the registry
+    counts references. Instances must provide offload(), which moves their
+    weights off the compute device, and bring them back themselves on next
+    use. After idle_seconds without a touch(), an instance that is still
+    referenced is offloaded, and one nobody references is dropped. Each
+    touch() may ask for its own idle time, which applies to that touch
+    only; an instance is kept until the latest deadline any of them set, so
+    holders with different settings never cut each other's short. Under
+    memory pressure (less than min_free_bytes free on the CUDA device) every
+    instance not in use is offloaded at once. Instances inside use() are
+    never offloaded or dropped.
+    """
+
+    def __init__(self, idle_seconds=300.0, min_free_bytes=0):
+        """
+        Args:
+            idle_seconds: Default idle time before offloading or dropping
+                          an instance (0 = never)
+            min_free_bytes: Offload idle instances when the CUDA device has
+                            less free memory than this (0 = never)
+        """
+        self.idle_seconds = idle_seconds
+        self.min_free_bytes = min_free_bytes
+        self._entries = {}
+        self._lock = threading.RLock()
+        self._timer = None
+
+    def acquire(self, key, factory):
+        """
+        Return the shared instance for key, creating it with factory() if needed
+
+        Args:
+            key: Hashable identity of the model (name, precision, ...)
+            factory: Callable returning a new instance
+
+        Returns:
+            The shared instance; call release(key) when no longer needed
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {"instance": factory(), "refs": 0, "active": 0, "offloaded": False,
+                         "deadline": 0.0}
+                self._entries[key] = entry
+            entry["refs"] += 1
+            self._extend(entry)
+            entry["offloaded"] = False
+            self._schedule()
+            return entry["instance"]
+
+    def release(self, key):
+        """Drop one reference; the instance is dropped once idle and unreferenced"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry["refs"] = max(0, entry["refs"] - 1)
+            self._extend(entry)
+            self._schedule()
+
+    def touch(self, key, idle_seconds=None):
+        """
+        Mark an instance as in use now (it reloads itself if offloaded)
+
+        Args:
+            key: Key the instance was acquired with
+            idle_seconds: Keep the instance for at least this long from now
+                          (0 = until the next touch that asks for a time;
+                          None = the registry default)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if idle_seconds and entry["deadline"] == math.inf:
+                    # A keep-loaded touch lasts until a later touch sets a time
+                    entry["deadline"] = 0.0
+                self._extend(entry, idle_seconds)
+                entry["offloaded"] = False
+                self._schedule()
+
+    @contextlib.contextmanager
+    def use(self, key):
+        """
+        Mark an instance as running for the duration of the block
+
+        Instances wrap each forward in this, so the registry knows they are
+        back on their device and does not offload them mid-forward.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["active"] += 1
+                entry["offloaded"] = False
+        try:
+            yield
+        finally:
+            if entry is not None:
+                with self._lock:
+                    entry["active"] -= 1
+                    self._extend(entry)
+                    self._schedule()
+
+    def collect(self, now=None):
+        """
+        Offload or drop instances idle past their deadline
+
+        Called by the idle timer; safe to call at any time.
+
+        Returns:
+            Number of instances offloaded or dropped
+        """
+        now = time.monotonic() if now is None else now
+        count = 0
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry["active"] or now < entry["deadline"]:
+                    continue
+                if entry["refs"] == 0:
+                    print(f"[ModelRegistry] Dropping idle model {key}")
+                    del self._entries[key]
+                    count += 1
+                elif not entry["offloaded"]:
+                    print(f"[ModelRegistry] Offloading idle model {key}")
+                    entry["instance"].offload()
+                    entry["offloaded"] = True
+                    count += 1
+            self._schedule()
+        if count:
+            self._empty_cache()
+        return count
+
+    def check_memory(self):
+        """
+        Offload every instance when the CUDA device is short of free memory
+
+        Returns:
+            Number of instances offloaded
+        """
+        if not self.min_free_bytes or not torch.cuda.is_available():
+            return 0
+        free, _ = torch.cuda.mem_get_info()
+        if free >= self.min_free_bytes:
+            return 0
+
+        count = 0
+        with self._lock:
+            for key, entry in self._entries.items():
+                if not entry["offloaded"] and not entry["active"]:
+                    print(f"[ModelRegistry] Offloading {key} ({free / 1024 ** 3:.1f} GB free)")
+                    entry["instance"].offload()
+                    entry["offloaded"] = True
+                    count += 1
+        if count:
+            self._empty_cache()
+        return count
+
+    def stats(self):
+        """Reference count and offload state of every registered instance"""
+        with self._lock:
+            return {key: {"refs": entry["refs"], "offloaded": entry["offloaded"]}
+                    for key, entry in self._entries.items()}
+
+    def _schedule(self):
+        # One daemon timer, due when the longest-idle instance should be collected
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending = [entry["deadline"] for entry in self._entries.values()
+                   if (entry["refs"] == 0 or not entry["offloaded"])
+                   and not entry["active"] and entry["deadline"] != math.inf]
+        if not pending:
+            return
+        delay = max(0.0, min(pending) - time.monotonic())
+        self._timer = threading.Timer(delay, self.collect)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _extend(self, entry, idle_seconds=None):
+        # Push the deadline out by this idle window (default: the registry's), never pull it in
+        idle = self.idle_seconds if idle_seconds is None else idle_seconds
+        deadline = time.monotonic() + idle if idle else math.inf
+        entry["deadline"] = max(entry["deadline"], deadline)
+
+    @staticmethod
+    def _empty_cache():
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+# Shared by every node in the process; offloads idle models when under 2 GB of VRAM is free
+registry = ModelRegistry(min_free_bytes=2 * 1024 ** 3)
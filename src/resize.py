@@ -0,0 +1,136 @@
+"""
+Separable image resizing in torch, on the tensor's device
+"""
+import math
+from functools import lru_cache
+
+import torch
+
+
+def _lanczos4(x):
+    # sinc(x) * sinc(x / 4); weights are normalised afterwards like cv2's
+    x = x.double()
+    out = torch.ones_like(x)
+    nz = x.abs() > 1e-7
+    px = math.pi * x[nz]
+    out[nz] = 4.0 * torch.sin(px) * torch.sin(px / 4.0) / (px * px)
+    return out.masked_fill(x.abs() >= 4.0, 0.0)
+
+
+def _cubic(x, a=-0.75):
+    # Keys cubic convolution with a = -0.75 (cv2.INTER_CUBIC, torch bicubic)
+    x = x.double().abs()
+    near = ((a + 2.0) * x - (a + 3.0)) * x * x + 1.0
+    far = ((a * x - 5.0 * a) * x + 8.0 * a) * x - 4.0 * a
+    return torch.where(x <= 1.0, near, torch.where(x < 2.0, far, torch.zeros_like(x)))
+
+
+def _linear(x):
+    return (1.0 - x.double().abs()).clamp(min=0.0)
+
+
+# mode -> (kernel, support radius in source pixels)
+KERNELS = {
+    "lanczos4": (_lanczos4, 4.0),
+    "bicubic": (_cubic, 2.0),
+    "bilinear": (_linear, 1.0),
+}
+
+
+@lru_cache(maxsize=64)
+def _axis_weights(in_size, out_size, mode, antialias, start=0, count=None):
+    """
+    Source indices and weights for output positions start..start+count
+
+    Sample positions follow cv2/torch half-pixel centres. Taps beyond the
+    border are clamped to the edge pixel (replicate), as cv2.resize does;
+    antialiased taps beyond the border get no weight instead.
+
+    Returns:
+        (indices [count, taps] int64, weights [count, taps] float32), on CPU
+    """
+    kernel, support = KERNELS[mode]
+    scale = in_size / out_size
+    # Antialiasing stretches the kernel over the source pixels each output covers
+    stretch = scale if antialias and scale > 1.0 else 1.0
+    radius = support * stretch
+
+    if count is None:
+        count = out_size - start
+    centres = (torch.arange(start, start + count, dtype=torch.float64) + 0.5) * scale - 0.5
+    if stretch == 1.0:
+        # Fixed taps around floor(centre), as in cv2
+        first = torch.floor(centres) - (support - 1)
+        taps = int(2 * support)
+    else:
+        first = torch.floor(centres - radius) + 1
+        taps = int(math.ceil(2 * radius)) + 1
+
+    offsets = first[:, None] + torch.arange(taps, dtype=torch.float64)
+    weights = kernel((offsets - centres[:, None]) / stretch)
+    if stretch != 1.0:
+        # Antialiased taps outside the image are dropped (as PIL and torch do)
+        weights = weights.masked_fill((offsets < 0) | (offsets >= in_size), 0.0)
+    weights = weights / weights.sum(dim=1, keepdim=True)
+    indices = offsets.long().clamp_(0, in_size - 1)
+    return indices, weights.float()
+
+
+def _gather_axis(image, indices, weights, dim):
+    """Resample `image` along one dimension with a gather per kernel tap"""
+    indices = indices.to(image.device)
+    weights = weights.to(device=image.device, dtype=image.dtype)
+
+    # Gather whole contiguous slabs along the leading axis (memcpy-speed),
+    # rather than strided elements along an inner one
+    source = image.movedim(dim, 0).contiguous()
+    shape = (-1,) + (1,) * (source.ndim - 1)
+
+    out = None
+    for k in range(indices.shape[1]):
+        term = source.index_select(0, indices[:, k]).mul_(weights[:, k].reshape(shape))
+        out = term if out is None else out.add_(term)
+    return out.movedim(0, dim)
+
+
+def resize_image(image, size, mode="lanczos4", antialias=None, window=None):
+    """
+    Resize an [H, W, C] image tensor on its own device
+
+    Kernels match cv2 on the same float input: "lanczos4" is
+    cv2.INTER_LANCZOS4 (8 taps), "bicubic" is cv2.INTER_CUBIC (Keys,
+    a = -0.75) and "bilinear" is cv2.INTER_LINEAR. With antialias the
+    kernel is widened when downscaling (as in PIL or torch's antialias=True);
+    cv2 never does that, so it is off by default except for "bilinear".
+
+    Args:
+        image: Image tensor [H, W, C], float
+        size: Target (width, height)
+        mode: "lanczos4", "bicubic" or "bilinear"
+        antialias: Widen the kernel when downscaling (default: mode == "bilinear")
+        window: Optional (x, y, width, height) of the output to compute;
+                only that region is returned
+
+    Returns:
+        Resized [h, w, C] tensor (not clamped; lanczos and bicubic overshoot)
+    """
+    if mode not in KERNELS:
+        raise ValueError(f"Unknown resize mode '{mode}', expected one of {sorted(KERNELS)}")
+    if antialias is None:
+        antialias = mode == "bilinear"
+
+    out_w, out_h = size
+    x, y, w, h = window if window is not None else (0, 0, out_w, out_h)
+    image = image if image.is_floating_point() else image.float()
+
+    col_indices, col_weights = _axis_weights(image.shape[1], out_w, mode, antialias, x, w)
+    row_indices, row_weights = _axis_weights(image.shape[0], out_h, mode, antialias, y, h)
+
+    # Only read the source rows and columns the window depends on
+    c0, c1 = int(col_indices.min()), int(col_indices.max()) + 1
+    r0, r1 = int(row_indices.min()), int(row_indices.max()) + 1
+    image = image[r0:r1, c0:c1]
+
+    # Horizontal pass first (as cv2), then vertical
+    out = _gather_axis(image, col_indices - c0, col_weights, 1)
+    return _gather_axis(out, row_indices - r0, row_weights, 0).contiguous()
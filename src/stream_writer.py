@@ -0,0 +1,96 @@
+"""
+Streaming image writer for outputs too large to hold in memory
+"""
+import struct
+import zlib
+
+import numpy as np
+
+
+class PNGStreamWriter:
+    """
+    Writes an 8-bit PNG row band by row band
+
+    Rows are filtered and deflated as they arrive, so only the current band
+    is ever held in memory. Rows must be written top to bottom and the total
+    must equal the height given up front.
+    """
+
+    _COLOR_TYPES = {1: 0, 3: 2, 4: 6}  # channels -> PNG colour type
+
+    def __init__(self, path, width, height, channels=3, compress_level=6):
+        """
+        Args:
+            path: Output file path
+            width, height: Image size in pixels
+            channels: 1 (grey), 3 (RGB) or 4 (RGBA)
+            compress_level: zlib compression level (0-9)
+        """
+        if channels not in self._COLOR_TYPES:
+            raise ValueError(f"PNG output supports 1, 3 or 4 channels, got {channels}")
+
+        self.path = path
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.rows_written = 0
+
+        self._file = open(path, "wb")
+        self._compressor = zlib.compressobj(compress_level)
+        self._file.write(b"\x89PNG\r\n\x1a\n")
+        header = struct.pack(">IIBBBBB", width, height, 8, self._COLOR_TYPES[channels], 0, 0, 0)
+        self._write_chunk(b"IHDR", header)
+
+    def _write_chunk(self, chunk_type, data):
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+    def write_rows(self, rows):
+        """
+        Append a band of rows
+
+        Args:
+            rows: uint8 array of shape (num_rows, width, channels)
+        """
+        rows = np.asarray(rows, dtype=np.uint8)
+        if rows.shape[1:] != (self.width, self.channels):
+            raise ValueError(f"Expected rows of shape (n, {self.width}, {self.channels}), got {rows.shape}")
+        if self.rows_written + rows.shape[0] > self.height:
+            raise ValueError("More rows written than the image height")
+
+        # Every scanline starts with its filter type byte (0 = no filter)
+        scanlines = np.zeros((rows.shape[0], 1 + self.width * self.channels), dtype=np.uint8)
+        scanlines[:, 1:] = rows.reshape(rows.shape[0], -1)
+
+        data = self._compressor.compress(scanlines.tobytes())
+        if data:
+            self._write_chunk(b"IDAT", data)
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        """Finish the file; raises if not every row was written"""
+        if self._file.closed:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError(f"Only {self.rows_written} of {self.height} rows were written")
+            self._write_chunk(b"IDAT", self._compressor.flush())
+            self._write_chunk(b"IEND", b"")
+        finally:
+            self._file.close()
+
+    def abort(self):
+        """Close the file without finishing it"""
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
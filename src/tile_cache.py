@@ -0,0 +1,183 @@
+"""
+Persistent, content-addressed cache of sampled tiles
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+
+def _update_digest(digest, value, samples=64):
+    """Feed a (possibly nested) value into a hash; tensors contribute a strided sample"""
+    if isinstance(value, torch.Tensor):
+        digest.update(f"T{tuple(value.shape)}{value.dtype}".encode())
+        if value.device.type != "meta" and value.numel():
+            flat = value.detach().reshape(-1)
+            step = max(1, flat.numel() // samples)
+            digest.update(flat[::step][:samples].float().cpu().numpy().tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value, key=repr):
+            digest.update(repr(key).encode())
+            _update_digest(digest, value[key], samples)
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"L{len(value)}".encode())
+        for item in value:
+            _update_digest(digest, item, samples)
+    elif value is None or isinstance(value, (bool, int, float, str)):
+        digest.update(repr(value).encode())
+    else:
+        digest.update(type(value).__name__.encode())
+
+
+def tensor_digest(tensor, **params):
+    """
+    Hash of a tensor's exact contents plus keyword parameters
+
+    Args:
+        tensor: Tensor to hash (every value is hashed)
+        **params: Additional values, hashed by repr in name order
+
+    Returns:
+        Hex digest string
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    array = np.ascontiguousarray(tensor.detach().cpu().float().numpy())
+    digest.update(f"{array.shape}".encode())
+    digest.update(memoryview(array).cast("B"))
+    for name in sorted(params):
+        digest.update(f"{name}={params[name]!r};".encode())
+    return digest.hexdigest()
+
+
+def save_tensor(path, tensor):
+    """
+    Write a tensor to an .npy file atomically (float32)
+
+    The data goes to a temporary file in the same directory, which then
+    replaces `path`, so readers never see a partially written file.
+    """
+    array = np.ascontiguousarray(tensor.detach().cpu().float().numpy())
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def module_fingerprint(module, samples=64):
+    """
+    Cheap identity hash of a torch module's weights
+
+    Hashes the name, shape and dtype of every state dict entry plus a
+    strided sample of its values, so it is stable across restarts without
+    reading every weight.
+
+    Args:
+        module: torch.nn.Module (or None)
+        samples: Values sampled per tensor
+
+    Returns:
+        Hex digest string
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if module is not None:
+        digest.update(type(module).__name__.encode())
+        _update_digest(digest, dict(module.state_dict()), samples)
+    return digest.hexdigest()
+
+
+def value_fingerprint(value, samples=64):
+    """Identity hash of nested patches / options (see module_fingerprint)"""
+    digest = hashlib.blake2b(digest_size=16)
+    _update_digest(digest, value, samples)
+    return digest.hexdigest()
+
+
+class TileCache:
+    """
+    Disk LRU cache of sampled tiles
+
+    Each entry is an .npy file named by a hash of the input tile's pixels
+    and every parameter that affects sampling. Reads refresh a file's
+    modification time, and writes evict the least recently used files once
+    the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=4 * 1024 ** 3):
+        """
+        Args:
+            directory: Cache directory (created if missing)
+            max_bytes: Size cap for all cached tiles together
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, tile, **params):
+        """
+        Cache key for a tile
+
+        Args:
+            tile: Input tile tensor (pixels or latent)
+            **params: Everything else the sampled result depends on
+                      (model identity, sampler settings, seed, prompt, ...)
+
+        Returns:
+            Hex digest string
+        """
+        return tensor_digest(tile, **params)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key):
+        """Return the cached tile as a float32 tensor, or None on a miss"""
+        path = self._path(key)
+        try:
+            array = np.load(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return torch.from_numpy(array)
+
+    def put(self, key, tile):
+        """Store a sampled tile, then evict old entries beyond the size cap"""
+        save_tensor(self._path(key), tile)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".npy"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        # Least recently used first
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        """Hit and miss counts since the cache was created"""
+        return {"hits": self.hits, "misses": self.misses}
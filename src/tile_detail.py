@@ -0,0 +1,54 @@
+"""
+Detail scoring used to skip diffusion on flat tiles
+"""
+import torch
+import torch.nn.functional as F
+
+# ITU-R BT.601 luma weights
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)
+
+
+def tile_detail_score(tile, method="gradient", scale=1.0):
+    """
+    Score how much detail a tile contains
+
+    Scores are measured on luma and compensated for the upscale factor, so a
+    threshold means roughly the same thing at 2x and at 4x. Flat skies and
+    studio backdrops typically score below 0.01; textured content scores
+    well above 0.05.
+
+    Args:
+        tile: Image tensor [H, W, C], float, 0.0-1.0 (already upscaled)
+        method: "gradient" (mean absolute luma gradient) or
+                "variance" (mean local standard deviation of luma)
+        scale: Upscale factor the tile was resized by
+
+    Returns:
+        Detail score as a float (higher = more detail)
+    """
+    tile = tile.float()
+    if tile.shape[-1] >= 3:
+        weights = torch.tensor(LUMA_WEIGHTS, dtype=tile.dtype, device=tile.device)
+        luma = tile[..., :3] @ weights
+    else:
+        luma = tile[..., 0]
+
+    if method == "gradient":
+        if min(luma.shape) < 2:
+            return 0.0
+        dx = (luma[:, 1:] - luma[:, :-1]).abs().mean()
+        dy = (luma[1:, :] - luma[:-1, :]).abs().mean()
+        # Resampling spreads each source edge over `scale` pixels
+        return float((dx + dy) * scale)
+
+    if method == "variance":
+        # Blocks cover about 8x8 source pixels
+        block = max(2, int(round(8 * scale)))
+        block = min(block, *luma.shape)
+        # Centre first so E[x^2] - E[x]^2 does not cancel catastrophically
+        luma = (luma - luma.mean())[None, None]
+        mean = F.avg_pool2d(luma, block)
+        mean_sq = F.avg_pool2d(luma * luma, block)
+        return float((mean_sq - mean * mean).clamp_(min=0).sqrt_().mean())
+
+    raise ValueError(f"Unknown detail method '{method}', expected 'gradient' or 'variance'")
@@ -0,0 +1,112 @@
+"""
+Bounded producer/consumer pipeline around tile sampling
+"""
+import queue
+import threading
+
+_DONE = object()
+
+
+class TilePipeline:
+    """
+    Three-stage pipeline: prepare -> process -> finish
+
+    Work items are prepared on a prep thread, processed (sampled) on the
+    calling thread and finished (stitched, checkpointed) on a stitch thread.
+    Both queues hold at most `depth` items, so a slow stage applies
+    backpressure instead of letting prepared tiles pile up in memory. With
+    one thread per stage and FIFO queues, items are finished in exactly the
+    order they were prepared, so results do not depend on thread timing.
+    """
+
+    def __init__(self, depth=2):
+        """
+        Args:
+            depth: Maximum items waiting between two stages; 0 runs every
+                   stage serially on the calling thread
+        """
+        self.depth = depth
+
+    def run(self, items, process, finish):
+        """
+        Run the pipeline to completion
+
+        If a stage raises, the other stages stop and the exception is
+        re-raised here. Items already processed are still finished first, so
+        work that completed before a failure is not lost.
+
+        Args:
+            items: Iterable of work items, consumed on the prep thread (a
+                   generator does its preparation work there)
+            process: Callable item -> result, run on the calling thread
+            finish: Callable result -> None, run on the stitch thread
+        """
+        if self.depth <= 0:
+            for item in items:
+                finish(process(item))
+            return
+
+        prepared = queue.Queue(self.depth)
+        processed = queue.Queue(self.depth)
+        stop = threading.Event()
+        errors = []
+
+        def put(q, value):
+            # Give up once the pipeline is stopping, so no thread blocks forever
+            while not stop.is_set():
+                try:
+                    q.put(value, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return _DONE
+
+        def produce():
+            try:
+                for item in items:
+                    if not put(prepared, item):
+                        return
+            except BaseException as e:
+                errors.append(e)
+            put(prepared, _DONE)
+
+        def consume():
+            try:
+                while True:
+                    result = processed.get()
+                    if result is _DONE:
+                        return
+                    finish(result)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+        producer = threading.Thread(target=produce, name="tile-prep", daemon=True)
+        consumer = threading.Thread(target=consume, name="tile-stitch", daemon=True)
+        producer.start()
+        consumer.start()
+
+        try:
+            while True:
+                item = get(prepared)
+                if item is _DONE:
+                    break
+                if not put(processed, process(item)):
+                    break
+        finally:
+            # Let the stitch thread finish what was already processed
+            put(processed, _DONE)
+            consumer.join()
+            stop.set()
+            producer.join()
+
+        if errors:
+            raise errors[0]
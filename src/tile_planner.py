@@ -0,0 +1,105 @@
+"""
+Tile grid planning shared by tiling and progress estimation
+"""
+import math
+
+
+def plan_axis(length, tile_size, overlap, align=8):
+    """
+    Place the fewest tiles that cover one axis
+
+    The tile count is the minimum needed to cover `length` with at least
+    `overlap` between neighbours. The tile length is then shrunk to the
+    smallest multiple of `align` that still reaches that overlap, and the
+    tiles are spaced evenly, so no edge tile is pushed back onto its
+    neighbour.
+
+    Args:
+        length: Axis length in pixels
+        tile_size: Maximum tile length
+        overlap: Minimum overlap between neighbouring tiles
+        align: Tile lengths are rounded up to a multiple of this
+
+    Returns:
+        (starts, tile_length) with the sorted start position of every tile
+    """
+    if overlap >= tile_size:
+        raise ValueError(f"Tile overlap ({overlap}) must be smaller than tile_size ({tile_size})")
+    if length <= tile_size:
+        return [0], length
+
+    count = math.ceil((length - overlap) / (tile_size - overlap))
+    tile_length = math.ceil((length + (count - 1) * overlap) / count)
+    tile_length = min(tile_size, -(-tile_length // align) * align)
+
+    span = length - tile_length
+    starts = [round(i * span / (count - 1)) for i in range(count)]
+    return starts, tile_length
+
+
+def legacy_axis(length, tile_size, overlap):
+    """Tile starts of the fixed-stride grid (stride tile_size - overlap, last tile shifted back)"""
+    stride = tile_size - overlap
+    return sorted({max(0, min(start + tile_size, length) - tile_size) for start in range(0, length, stride)})
+
+
+class TileGrid:
+    """
+    Rectilinear tile grid over a width x height canvas
+
+    Every tile has the same size (tiles are only smaller than tile_size when
+    the canvas itself is), so all tiles can be sampled in one batch bucket.
+    """
+
+    def __init__(self, width, height, tile_size, overlap=64, align=8, square=False):
+        """
+        Args:
+            width, height: Canvas size
+            tile_size: Maximum tile side
+            overlap: Minimum overlap between neighbouring tiles
+            align: Tile sides are rounded up to a multiple of this
+            square: Keep tiles square (both sides use the larger length)
+        """
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.overlap = overlap
+
+        self.xs, self.tile_w = plan_axis(width, tile_size, overlap, align)
+        self.ys, self.tile_h = plan_axis(height, tile_size, overlap, align)
+
+        if square and len(self.xs) > 1 and len(self.ys) > 1:
+            side = max(self.tile_w, self.tile_h)
+            self.xs = self._respace(self.xs, width, side)
+            self.ys = self._respace(self.ys, height, side)
+            self.tile_w = self.tile_h = side
+
+    @staticmethod
+    def _respace(starts, length, tile_length):
+        span = length - tile_length
+        return [round(i * span / (len(starts) - 1)) for i in range(len(starts))]
+
+    def __len__(self):
+        return len(self.xs) * len(self.ys)
+
+    def rects(self):
+        """(x, y, width, height) of every tile, row by row"""
+        return [(x, y, self.tile_w, self.tile_h) for y in self.ys for x in self.xs]
+
+    @property
+    def pixels(self):
+        """Total pixels sent through diffusion"""
+        return len(self) * self.tile_w * self.tile_h
+
+    @property
+    def legacy_pixels(self):
+        """Pixels the fixed-stride grid would send through diffusion"""
+        columns = len(legacy_axis(self.width, self.tile_size, self.overlap))
+        rows = len(legacy_axis(self.height, self.tile_size, self.overlap))
+        return columns * rows * min(self.tile_size, self.width) * min(self.tile_size, self.height)
+
+    def report(self, unit=1):
+        """One-line summary of the plan compared with the fixed-stride grid"""
+        saved = 1.0 - self.pixels / self.legacy_pixels if self.legacy_pixels else 0.0
+        return (f"{len(self.xs)}x{len(self.ys)} tiles of {self.tile_w * unit}x{self.tile_h * unit}, "
+                f"{saved:.0%} fewer diffusion pixels than the fixed-stride grid")
@@ -0,0 +1,283 @@
+"""
+Incremental tile stitching into a preallocated canvas
+"""
+import math
+import os
+import tempfile
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+import torch
+
+try:
+    from .stream_writer import PNGStreamWriter
+except ImportError:
+    from stream_writer import PNGStreamWriter
+
+
+@lru_cache(maxsize=256)
+def blend_ramp(length, overlap, fade_start=True, fade_end=True):
+    """
+    1D blend weights for one tile edge-to-edge
+
+    Weights ramp up over `overlap` pixels on each side that has a neighbouring
+    tile and stay at 1.0 everywhere else. Sides on the image border get no
+    fade, so border pixels keep their full weight.
+
+    Results are cached by (length, overlap, edge flags) and shared between
+    callers, so they must not be modified in place.
+
+    Args:
+        length: Tile length along the axis
+        overlap: Fade width in pixels
+        fade_start: Fade in at the start (a neighbour precedes this tile)
+        fade_end: Fade out at the end (a neighbour follows this tile)
+
+    Returns:
+        Float32 tensor of shape (length,), values in (0, 1]
+    """
+    ramp = torch.ones(length, dtype=torch.float32)
+    fade = min(overlap, length)
+    if fade > 0:
+        # Strictly positive so every covered pixel keeps some weight
+        steps = torch.arange(1, fade + 1, dtype=torch.float32) / (fade + 1)
+        if fade_start:
+            ramp[:fade] *= steps
+        if fade_end:
+            ramp[-fade:] *= steps.flip(0)
+    return ramp
+
+
+class TileStitcher:
+    """
+    Stitches tiles into an output canvas as they arrive
+
+    The tiles must form a rectilinear grid (every row of tiles shares the same
+    column positions), which is what generate_tiles produces. Blend weights
+    are separable: each column and row interval gets a 1D profile, normalised
+    so the profiles along an axis sum to exactly 1.0. Their products therefore
+    sum to 1.0 at every pixel, so tiles can be accumulated straight into the
+    canvas without a separate weights plane or a final normalisation pass.
+
+    Pixels covered by a single tile are copied in directly; only the overlap
+    strips are multiplied by their blend weights.
+    """
+
+    def __init__(self, output_size, rects, overlap=64, channels=3, device=None,
+                 dtype=torch.float32, canvas=None):
+        """
+        Args:
+            output_size: (width, height) of the stitched image
+            rects: (x, y, width, height) of every tile that will be added
+            overlap: Fade width used between neighbouring tiles
+            channels: Number of channels in the canvas
+            device: Device for the canvas (default CPU)
+            dtype: Canvas dtype
+            canvas: Optional preallocated, zero-filled [H, W, C] tensor to
+                    stitch into instead of allocating one
+        """
+        self.width, self.height = output_size
+        self.overlap = overlap
+
+        if canvas is None:
+            canvas = torch.zeros((self.height, self.width, channels), dtype=dtype, device=device)
+        self.canvas = canvas
+
+        # Clip rects to the canvas and count duplicates
+        self._multiplicity = {}
+        for x, y, w, h in rects:
+            rect = (x, y, min(w, self.width - x), min(h, self.height - y))
+            self._multiplicity[rect] = self._multiplicity.get(rect, 0) + 1
+
+        columns = sorted({(x, w) for x, _, w, _ in self._multiplicity})
+        rows = sorted({(y, h) for _, y, _, h in self._multiplicity})
+        if len(self._multiplicity) != len(columns) * len(rows):
+            raise ValueError("TileStitcher requires tiles that form a rectilinear grid")
+
+        self._column_weights = self._axis_weights(columns, self.width)
+        self._row_weights = self._axis_weights(rows, self.height)
+        self.pending = len(rects)
+
+    def _axis_weights(self, intervals, size):
+        """Normalised 1D weights and full-weight span for each (start, length) interval"""
+        raw = {}
+        total = torch.zeros(size, dtype=torch.float32)
+        for start, length in intervals:
+            end = start + length
+            # A side fades only if another interval overlaps it
+            fade_start = any(s < start < s + l for s, l in intervals)
+            fade_end = any(s < end < s + l for s, l in intervals)
+            raw[(start, length)] = blend_ramp(length, self.overlap, fade_start, fade_end)
+            total[start:end] += raw[(start, length)]
+
+        weights = {}
+        for (start, length), ramp in raw.items():
+            profile = ramp / total[start:start + length]
+            # Positions owned by this interval alone have a weight of exactly 1.0
+            full = torch.nonzero(profile == 1.0).flatten()
+            span = (int(full[0]), int(full[-1]) + 1) if len(full) else (0, 0)
+            weights[(start, length)] = (profile.to(self.canvas.device), span)
+        return weights
+
+    def add(self, tile, x, y):
+        """
+        Blend one tile into the canvas
+
+        Args:
+            tile: [H, W, C] tensor (any dtype; cast to the canvas dtype)
+            x, y: Position of the tile's top-left corner in the canvas
+        """
+        tile = tile[:self.height - y, :self.width - x]
+        tile_h, tile_w = tile.shape[:2]
+        tile = tile.to(device=self.canvas.device, dtype=self.canvas.dtype)
+
+        wx, (x0, x1) = self._column_weights[(x, tile_w)]
+        wy, (y0, y1) = self._row_weights[(y, tile_h)]
+        multiplicity = self._multiplicity[(x, y, tile_w, tile_h)]
+        region = self.canvas[y:y + tile_h, x:x + tile_w]
+
+        if multiplicity == 1 and y1 > y0 and x1 > x0:
+            # Interior: this tile is the only contributor, copy it straight in
+            region[y0:y1, x0:x1] = tile[y0:y1, x0:x1]
+            strips = [
+                (slice(0, y0), slice(0, tile_w)),
+                (slice(y1, tile_h), slice(0, tile_w)),
+                (slice(y0, y1), slice(0, x0)),
+                (slice(y0, y1), slice(x1, tile_w)),
+            ]
+        else:
+            strips = [(slice(0, tile_h), slice(0, tile_w))]
+
+        for rows, cols in strips:
+            mask = wy[rows, None] * wx[None, cols]
+            if multiplicity > 1:
+                mask = mask / multiplicity
+            region[rows, cols] += tile[rows, cols] * mask.unsqueeze(-1)
+
+        self.pending -= 1
+
+    def result(self):
+        """Return the stitched [H, W, C] canvas"""
+        return self.canvas
+
+
+def scratch_memmap(shape, directory=None, dtype=np.float32):
+    """
+    Allocate a zero-filled, disk-backed array
+
+    The backing file is unlinked straight away where the OS allows it (POSIX),
+    so its space is released automatically once the mapping is dropped.
+
+    Args:
+        shape: Array shape
+        directory: Directory for the backing file (default: system temp dir)
+        dtype: Array dtype
+
+    Returns:
+        (array, path) where path is None if the file was already unlinked,
+        otherwise the file the caller must remove after dropping the array
+    """
+    fd, path = tempfile.mkstemp(suffix=".canvas", dir=directory)
+    os.close(fd)
+    array = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+    try:
+        os.unlink(path)
+        path = None
+    except OSError:
+        pass
+    return array, path
+
+
+class StreamingTileStitcher(TileStitcher):
+    """
+    Tile stitcher for outputs larger than RAM
+
+    The canvas is an np.memmap on disk. Whenever no pending tile can touch a
+    band of rows any more, that band is converted to uint8 and streamed to a
+    PNG file, so memory use is bounded by the page cache rather than by the
+    output size. A small preview is collected on the way.
+    """
+
+    def __init__(self, output_size, rects, output_path, overlap=64, channels=3,
+                 scratch_dir=None, preview_size=1024):
+        """
+        Args:
+            output_size: (width, height) of the stitched image
+            rects: (x, y, width, height) of every tile that will be added
+            output_path: PNG file to write
+            overlap: Fade width used between neighbouring tiles
+            channels: Number of channels
+            scratch_dir: Directory for the memmap canvas (default: next to output_path)
+            preview_size: Longest side of the preview image
+        """
+        width, height = output_size
+        if scratch_dir is None:
+            scratch_dir = os.path.dirname(os.path.abspath(output_path))
+
+        self.scratch_dir = scratch_dir
+        self._memmap, self._scratch_path = scratch_memmap((height, width, channels), scratch_dir)
+        super().__init__(output_size, rects, overlap=overlap, channels=channels,
+                         canvas=torch.from_numpy(self._memmap))
+
+        self.output_path = output_path
+        self.writer = PNGStreamWriter(output_path, width, height, channels)
+        self.rows_flushed = 0
+        self._pending_rows = Counter(y for _, y, _, _ in rects)
+        self._preview_stride = max(1, math.ceil(max(width, height) / preview_size))
+        self._preview_rows = []
+
+    def add(self, tile, x, y):
+        """Blend one tile, then flush every row band no pending tile can touch"""
+        super().add(tile, x, y)
+
+        self._pending_rows[y] -= 1
+        if self._pending_rows[y] == 0:
+            del self._pending_rows[y]
+
+        ready = min(self._pending_rows) if self._pending_rows else self.height
+        if ready > self.rows_flushed:
+            self._flush(ready)
+
+    def _flush(self, end):
+        band = self.canvas[self.rows_flushed:end]
+        band = (band.clamp(0.0, 1.0) * 255.0).round_().to(torch.uint8)
+
+        # Keep every preview_stride-th row and column for the preview
+        first = -self.rows_flushed % self._preview_stride
+        self._preview_rows.append(band[first::self._preview_stride, ::self._preview_stride].clone())
+
+        self.writer.write_rows(band.numpy())
+        self.rows_flushed = end
+
+    def preview(self):
+        """Downsampled [h, w, C] float preview of the rows flushed so far"""
+        if not self._preview_rows:
+            return torch.zeros((0, 0, self.canvas.shape[-1]))
+        return torch.cat(self._preview_rows, dim=0).float() / 255.0
+
+    def result(self):
+        """Streaming output lives on disk; the full canvas is not returned"""
+        raise RuntimeError(f"StreamingTileStitcher writes to {self.output_path}; use preview()")
+
+    def close(self):
+        """Finish the output file and release the canvas"""
+        try:
+            if self.pending:
+                raise RuntimeError(f"{self.pending} tiles were never added")
+            self.writer.close()
+        finally:
+            self._release()
+
+    def abort(self):
+        """Release the canvas and delete the unfinished output file"""
+        self.writer.abort()
+        self._release()
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+    def _release(self):
+        self.canvas = None
+        self._memmap = None
+        if self._scratch_path is not None and os.path.exists(self._scratch_path):
+            os.remove(self._scratch_path)
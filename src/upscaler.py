@@ -1,6 +1,8 @@
 """
 Basic upscaler with DINO guidance support
 """
+import math
+from functools import partial
 import torch
 import numpy as np
 from PIL import Image
@@ -8,43 +10,112 @@ import cv2
 from typing import Optional, Union
 
 try:
-    from .dino_extractor import DINOFeatureExtractor
+    from .tile_stitcher import TileStitcher, StreamingTileStitcher, blend_ramp
+    from .joint_diffusion import JointTileDenoiser
+    from .tile_detail import tile_detail_score
+    from .tile_planner import TileGrid
+    from .tile_cache import tensor_digest
+    from .job_manifest import JobManifest
+    from .tile_pipeline import TilePipeline
+    from .resize import resize_image
 except ImportError:
-    from dino_extractor import DINOFeatureExtractor
+    from tile_stitcher import TileStitcher, StreamingTileStitcher, blend_ramp
+    from joint_diffusion import JointTileDenoiser
+    from tile_detail import tile_detail_score
+    from tile_planner import TileGrid
+    from tile_cache import tensor_digest
+    from job_manifest import JobManifest
+    from tile_pipeline import TilePipeline
+    from resize import resize_image
+
+
+# cv2 interpolation flags and the matching torch kernels in resize.py
+RESIZE_MODES = {
+    cv2.INTER_LANCZOS4: "lanczos4",
+    cv2.INTER_CUBIC: "bicubic",
+    cv2.INTER_LINEAR: "bilinear",
+}
 
 
 class BasicUpscaler:
-    def __init__(self, comfyui_sampler=None, scale_factor=2.0, dino_extractor=None):
+    def __init__(self, comfyui_sampler=None, scale_factor=2.0, dino_extractor=None, tile_cache=None,
+                 pipeline_depth=2, resize_device=None, dino_resolution=None):
         self.scale_factor = scale_factor
         self.comfyui_sampler = comfyui_sampler
         self.dino_extractor = dino_extractor
+        self.tile_cache = tile_cache  # Optional TileCache of sampled tiles
+        self.pipeline_depth = pipeline_depth  # Batches queued between pipeline stages (0 = serial)
+        self.resize_device = resize_device  # Device for the initial resize (None = the image's device)
+        self.dino_resolution = dino_resolution  # Native-resolution DINO input size (None = 224px crop)
+        self.dino_pyramid = (224, 448, 672)  # DINO input sizes of the per-tile feature pyramid
+        self.dino_done_callback = None  # Called once a run's DINO extraction is over, before sampling
+        self.cpu_resize_bytes = 0  # Opt-in: resize CPU pixel-mode images in full up to this size (0 = always lazy)
+        self.last_run_stats = {}
     
     def upscale(self, image, dino_features=None, use_diffusion=False, **kwargs):
         """
         Upscale an image with optional DINO guidance
         
+        Tensor inputs stay tensors end to end: no PIL/numpy round-trips and
+        no uint8 quantisation between stages.
+        
         Args:
-            image: PIL Image or numpy array
+            image: PIL Image, numpy array, or ComfyUI image tensor
+                   ([H, W, C] or [B, H, W, C], float32, 0.0-1.0)
             dino_features: Optional DINO features for semantic guidance
             use_diffusion: Use diffusion model instead of bicubic
             **kwargs: Additional parameters (prompt, steps, sampler_name, etc.)
             
         Returns:
-            Upscaled PIL Image
+            Upscaled PIL Image, or a [B, H, W, C] float tensor if image was a tensor
         """
+        if isinstance(image, torch.Tensor):
+            return self.upscale_tensor(image, dino_features, use_diffusion, **kwargs)
+        
         if isinstance(image, Image.Image):
             image = np.array(image)
         
+        if use_diffusion:
+            # Run the tensor pipeline and convert back once at the end
+            image_tensor = torch.from_numpy(image).float() / 255.0
+            result = self.upscale_tensor(image_tensor, dino_features, use_diffusion, **kwargs)
+            return self._tensor_to_pil(result[0])
+        else:
+            # Fall back to bicubic
+            return self._upscale_bicubic(image)
+    
+    def upscale_tensor(self, image, dino_features=None, use_diffusion=False, **kwargs):
+        """
+        Upscale a ComfyUI image tensor without leaving tensor space
+        
+        Args:
+            image: Image tensor [H, W, C] or image batch [B, H, W, C],
+                   float32, 0.0-1.0
+            dino_features: Optional DINO features for semantic guidance
+            use_diffusion: Use diffusion model instead of bicubic
+            **kwargs: Additional parameters (prompt, steps, sampler_name, etc.)
+            
+        Returns:
+            Upscaled image tensor [B, H, W, C], float32, 0.0-1.0
+        """
+        if image.ndim == 3:
+            image = image.unsqueeze(0)
+        
         if use_diffusion:
             # Use ComfyUI sampler
             if self.comfyui_sampler is not None:
-                return self._upscale_with_comfyui(image, dino_features, **kwargs)
+                result = self._upscale_with_comfyui(image, dino_features, **kwargs)
             else:
                 print("[Upscaler] ERROR: No ComfyUI sampler available!")
                 raise ValueError("ComfyUI sampler is required for diffusion upscaling")
         else:
             # Fall back to bicubic
-            return self._upscale_bicubic(image)
+            h, w = image.shape[1:3]
+            new_size = (int(w * self.scale_factor), int(h * self.scale_factor))
+            result = torch.stack([self._resize_tensor(frame, new_size, interpolation=cv2.INTER_CUBIC)
+                                  for frame in image])
+        
+        return result
     
     def _upscale_bicubic(self, image):
         """Simple bicubic upscaling"""
@@ -53,126 +124,740 @@ class BasicUpscaler:
         upscaled = cv2.resize(image, new_size, interpolation=cv2.INTER_CUBIC)
         return Image.fromarray(upscaled)
     
+    def _resize_tensor(self, image, size, interpolation=cv2.INTER_LANCZOS4, out=None):
+        """
+        Resize an [H, W, C] float image tensor to size (width, height)
+        
+        CPU tensors are resized by cv2 through a zero-copy numpy view, so the
+        float data is never quantised. Tensors on other devices stay there
+        and go through the torch kernels in resize.py, which match cv2's
+        kernels, so results do not depend on the device.
+        
+        Args:
+            image: Image tensor [H, W, C], float, 0.0-1.0
+            size: Target (width, height)
+            interpolation: cv2 interpolation flag (LANCZOS4, CUBIC or LINEAR)
+            out: Optional preallocated float32 tensor [h, w, C] to resize into
+        """
+        if image.device.type == "cpu":
+            image_np = image.detach().contiguous().float().numpy()
+            if out is not None:
+                cv2.resize(image_np, size, dst=out.numpy(), interpolation=interpolation)
+                resized = out
+            else:
+                resized = torch.from_numpy(cv2.resize(image_np, size, interpolation=interpolation))
+            if resized.ndim == 2:
+                resized = resized.unsqueeze(-1)
+        else:
+            resized = resize_image(image.float(), size, mode=RESIZE_MODES[interpolation], antialias=False)
+            if out is not None:
+                resized = out.copy_(resized)
+        
+        # Lanczos and bicubic kernels overshoot slightly at hard edges
+        return resized.clamp_(0.0, 1.0)
+    
+    def _tensor_to_pil(self, image):
+        """Convert an [H, W, C] float tensor (0.0-1.0) to a PIL Image"""
+        image_np = (image.detach().cpu().numpy() * 255.0).round().astype(np.uint8)
+        return Image.fromarray(image_np)
+    
+    def upscale_to_file(self, image, output_path, **kwargs):
+        """
+        Headless entry point: diffusion-upscale straight into a PNG on disk
+        
+        The output is stitched into a disk-backed canvas and streamed to
+        output_path in row bands, so the output size is bounded by disk space
+        rather than RAM.
+        
+        Args:
+            image: PIL Image, numpy array, or image tensor
+            output_path: PNG file to write
+            **kwargs: Upscaling parameters as for upscale() (prompt, steps, ...)
+            
+        Returns:
+            output_path
+        """
+        self.upscale(image, use_diffusion=True, output_path=output_path, **kwargs)
+        return output_path
+    
     def _upscale_with_comfyui(self, image, dino_features=None, progress_callback=None, 
                               preview_callback=None, sampler_name="euler", scheduler="normal", 
                               steps=20, denoise=0.4, cfg=7.0, seed=0, prompt=None, 
-                              tile_size=1024, **kwargs):
-        """ComfyUI native upscaling with tiled processing"""
-        from PIL import Image
-        import cv2
+                              tile_size=1024, tile_batch_size=1, tile_overlap=64,
+                              tiling_mode="pixel", output_path=None, scratch_dir=None,
+                              detail_threshold=0.0, flat_tile_steps=0, detail_method="gradient",
+                              job_dir=None, **kwargs):
+        """
+        ComfyUI native upscaling with tiled processing
+        
+        Every image in the batch is tiled on the same grid, and tiles from
+        different images share sampler batches. Tile i of the whole batch
+        (counting through image 0 first) is sampled with seed + i, so the
+        first image gets the same seeds as when upscaled on its own.
+        
+        Args:
+            image: Image batch tensor [B, H, W, C], float32, 0.0-1.0
+            dino_features: Optional DINO features, [B, N, D] (or [N, D] for
+                           a single image)
+            tile_overlap: Overlap between neighbouring tiles, in pixels
+            tiling_mode: "pixel" samples pixel tiles, each with its own VAE
+                         encode/decode. "latent" VAE-encodes the whole image
+                         once, samples and blends latent tiles, then runs one
+                         tiled VAE decode. "joint" is like "latent" but
+                         denoises all tiles together, blending them in latent
+                         space at every step (MultiDiffusion), so much smaller
+                         overlaps hide seams.
+            output_path: If set, stream the result to this PNG file instead of
+                         keeping it in memory (see upscale_to_file); single
+                         images only
+            scratch_dir: Directory for disk-backed buffers in streaming mode
+                         (default: next to output_path)
+            detail_threshold: Tiles whose detail score (see tile_detail_score)
+                              is below this are treated as flat. 0 disables
+                              the pre-pass. Ignored in joint mode.
+            flat_tile_steps: Sampling steps for flat tiles; 0 skips sampling
+                             and keeps the Lanczos result
+            detail_method: "gradient" or "variance"
+            job_dir: If set, checkpoint every finished tile under this
+                     directory so an interrupted run of the same job resumes
+                     where it stopped (not in joint mode)
+            
+        Returns:
+            Upscaled image tensor [B, H, W, C], float32, 0.0-1.0. In streaming
+            mode this is a downsampled preview of the file written.
+        """
+        if tiling_mode not in ("pixel", "latent", "joint"):
+            raise ValueError(f"Unknown tiling_mode '{tiling_mode}', expected 'pixel', 'latent' or 'joint'")
+        if tiling_mode != "pixel" and output_path is not None:
+            raise ValueError("Streaming output (output_path) requires tiling_mode='pixel'")
+        if output_path is not None and image.shape[0] != 1:
+            raise ValueError(f"Streaming output (output_path) takes a single image, got a batch of {image.shape[0]}")
+        if dino_features is not None and dino_features.ndim == 2:
+            dino_features = dino_features.unsqueeze(0)
         
         # Calculate target size
-        h, w = image.shape[:2] if isinstance(image, np.ndarray) else (image.height, image.width)
+        frames, h, w, channels = image.shape
         target_h = int(h * self.scale_factor)
         target_w = int(w * self.scale_factor)
+        streaming = output_path is not None
         
-        # First, do a simple upscale to target resolution
-        if isinstance(image, Image.Image):
-            image_np = np.array(image)
+        sampling_kwargs = dict(
+            denoise=denoise,
+            steps=steps,
+            cfg=cfg,
+            sampler_name=sampler_name,
+            scheduler=scheduler,
+            positive_prompt=prompt,
+            negative_prompt="",
+            preview_callback=preview_callback
+        )
+        
+        detail_kwargs = dict(
+            detail_threshold=detail_threshold,
+            flat_tile_steps=flat_tile_steps,
+            detail_method=detail_method
+        )
+        
+        # The job key covers everything the output depends on
+        job_key = None
+        if job_dir and tiling_mode == "joint":
+            print("[Upscaler] job_dir is ignored in joint mode (tiles are not sampled separately)")
+        elif job_dir:
+            job_key = tensor_digest(
+                image, model=self.comfyui_sampler.fingerprint(), mode=tiling_mode,
+                scale_factor=self.scale_factor, seed=seed, tile_size=tile_size,
+                tile_overlap=tile_overlap, **detail_kwargs,
+                **{k: v for k, v in sampling_kwargs.items() if k != "preview_callback"}
+            )
+        
+        # Resizing on the compute device keeps the tiles there for sampling
+        resize_device = self.resize_device or image.device
+        
+        if tiling_mode != "pixel":
+            # The VAE encodes the whole image, so it is resized in full up front
+            upscaled_image = torch.empty((frames, target_h, target_w, channels), device=resize_device)
+            for b in range(frames):
+                self._resize_tensor(image[b].to(resize_device), (target_w, target_h),
+                                    interpolation=cv2.INTER_LANCZOS4, out=upscaled_image[b])
+            result = self._upscale_latent_tiles(
+                upscaled_image, image, dino_features, seed, tile_size, tile_overlap, tile_batch_size,
+                progress_callback, sampling_kwargs, joint=tiling_mode == "joint",
+                job_dir=job_dir, job_key=job_key, **detail_kwargs
+            )
+            return result.to(image.device)
+        
+        overlap = tile_overlap
+        sources = [image[b].to(resize_device).float() for b in range(frames)]
+        rects = self._plan_rects(target_w, target_h, tile_size, overlap)
+        intermediate_bytes = frames * target_h * target_w * channels * 4
+        if sources[0].device.type == "cpu" and intermediate_bytes <= self.cpu_resize_bytes:
+            # Opted in: one cv2 resize per image is faster than resampling the
+            # (overlapping) tiles one by one, at the cost of the full intermediate
+            upscaled = [self._resize_tensor(source, (target_w, target_h)) for source in sources]
+            tiles = [(full[y:y + th, x:x + tw], x, y) for full in upscaled for x, y, tw, th in rects]
         else:
-            image_np = image
-            
-        # Use lanczos for initial upscale (better than bicubic for photos)
-        upscaled_image = cv2.resize(image_np, (target_w, target_h), interpolation=cv2.INTER_LANCZOS4)
-        
-        # If the upscaled image is smaller than tile_size, process it as one tile
-        if target_h <= tile_size and target_w <= tile_size:
-            print(f"[Upscaler] Image {target_w}x{target_h} fits in one tile (tile_size={tile_size})")
-            result = self.comfyui_sampler.upscale(
-                upscaled_image,
-                scale_factor=1.0,  # Already at target size
-                denoise=denoise,
-                steps=steps,
-                cfg=cfg,
-                sampler_name=sampler_name,
-                scheduler=scheduler,
-                seed=seed,
-                positive_prompt=prompt,
-                negative_prompt="",
-                dino_features=dino_features,
-                preview_callback=preview_callback
+            # Tiles are resampled from the source on demand, so the
+            # target-size intermediate never exists as a whole
+            tiles = [(partial(self._resample_tile, source, (target_w, target_h), rect), rect[0], rect[1])
+                     for source in sources for rect in rects]
+        tile_frames = [b for b in range(frames) for _ in rects]
+        single_tile = len(rects) == 1
+        
+        # Processed tiles are blended into the canvas as soon as they are sampled
+        if streaming:
+            stitchers = [StreamingTileStitcher((target_w, target_h), rects, output_path,
+                                               overlap=overlap, channels=channels,
+                                               scratch_dir=scratch_dir)]
+        else:
+            canvas = torch.zeros((frames, target_h, target_w, channels), device=image.device)
+            stitchers = [TileStitcher((target_w, target_h), rects, overlap=overlap,
+                                      channels=channels, canvas=canvas[b])
+                         for b in range(frames)]
+        
+        tile_steps = self._plan_tile_steps([tile for tile, _, _ in tiles], steps, **detail_kwargs)
+        job = JobManifest(job_dir, job_key, rects * frames) if job_key else None
+        
+        tile_features = self._tile_dino_features(image, rects, (target_w, target_h), dino_features)
+        
+        ratio = getattr(self.comfyui_sampler, "downscale_ratio", 1)
+        
+        def sample_batch(batch, indices, batch_steps):
+            # The VAE crops to multiples of its downscale ratio; pad, then crop after decoding
+            tile_h, tile_w = batch.shape[1:3]
+            pad_h, pad_w = -tile_h % ratio, -tile_w % ratio
+            if pad_h or pad_w:
+                batch = torch.nn.functional.pad(
+                    batch.permute(0, 3, 1, 2), (0, pad_w, 0, pad_h), mode='replicate'
+                ).permute(0, 2, 3, 1)
+            # Process tiles through diffusion (no upscaling, just refinement)
+            sampled = self.comfyui_sampler.sample_tensors(
+                batch,
+                seeds=[seed + i for i in indices],  # Different seed per tile for variation
+                scale_factor=1.0,  # Already at target size, just refine
+                dino_features=tile_features[indices] if tile_features is not None else None,
+                **dict(sampling_kwargs, steps=batch_steps)
             )
-            if progress_callback:
-                try:
-                    progress_callback()
-                except Exception:
-                    raise
-            return result
-        
-        # Generate tiles with overlap
-        overlap = 64
-        tiles = self.generate_tiles(upscaled_image, tile_size=tile_size, overlap=overlap)
-        print(f"[Upscaler] Processing {len(tiles)} tiles of size {tile_size}x{tile_size}")
-        
-        # Process each tile
-        processed_tiles = []
-        for i, (tile, x, y) in enumerate(tiles):
-            print(f"[Upscaler] Processing tile {i+1}/{len(tiles)} at position ({x}, {y})")
+            return sampled[:, :tile_h, :tile_w]
+        
+        # Lazy tiles are scored once resampled for sampling, not resampled twice
+        deferred = None in tile_steps
+        try:
+            self._sample_tile_batches(tiles, stitchers, sample_batch, tile_batch_size,
+                                      progress_callback, tile_steps=tile_steps,
+                                      tile_key=self._make_tile_key(sampling_kwargs, seed, "pixel"),
+                                      job=job, tile_frames=tile_frames,
+                                      score_tile=partial(self._tile_step_count, steps=steps, **detail_kwargs))
+        except BaseException:
+            if streaming:
+                stitchers[0].abort()
+            raise
+        finally:
+            del tiles, sources
+        if deferred:
+            self._report_tile_steps(tile_steps, steps, **detail_kwargs)
+        
+        if streaming:
+            preview = stitchers[0].preview()
+            stitchers[0].close()
+            if job:
+                job.finish()
+            print(f"[Upscaler] Wrote {target_w}x{target_h} result to {output_path}")
+            return preview.unsqueeze(0).to(image.device)
+        
+        if not single_tile or frames > 1:
+            print(f"[Upscaler] Stitched {len(rects) * frames} tiles")
+        if job:
+            job.finish()
+        return canvas.clamp_(0.0, 1.0)
+    
+    def _upscale_latent_tiles(self, upscaled_image, source_image, dino_features, seed, tile_size, tile_overlap,
+                              tile_batch_size, progress_callback, sampling_kwargs, joint=False,
+                              detail_threshold=0.0, flat_tile_steps=0, detail_method="gradient",
+                              job_dir=None, job_key=None):
+        """
+        Latent-space tiling: encode once, sample latent tiles, decode once
+        
+        The whole upscaled batch goes through one tiled VAE encode. Overlapping
+        latent tiles are sampled and blended in latent space, and the blended
+        latents go through one tiled VAE decode. Overlaps are never encoded or
+        decoded twice, and seams are blended before decoding rather than after.
+        
+        Args:
+            upscaled_image: Image batch tensor [B, H, W, C] at target size
+            source_image: The batch before resizing (for per-tile DINO features)
+            joint: Denoise all tiles together (MultiDiffusion) instead of one
+                   after another; tiles are blended after every model call
+            detail_threshold, flat_tile_steps, detail_method: Flat tile
+                   handling, scored on each tile's pixel region (not joint)
+            job_dir, job_key: Checkpoint finished latent tiles (not joint)
             
-            # Process tile through diffusion (no upscaling, just refinement)
-            processed_tile_pil = self.comfyui_sampler.upscale(
-                tile,
-                scale_factor=1.0,  # Already at target size, just refine
-                denoise=denoise,
-                steps=steps,
-                cfg=cfg,
-                sampler_name=sampler_name,
-                scheduler=scheduler,
-                seed=seed + i,  # Different seed per tile for variation
-                positive_prompt=prompt,
-                negative_prompt="",
-                dino_features=None,  # TODO: Extract DINO features per tile
-                preview_callback=preview_callback
+        Returns:
+            Upscaled image tensor [B, H, W, C], float32, 0.0-1.0
+        """
+        frames, target_h, target_w = upscaled_image.shape[:3]
+        ratio = self.comfyui_sampler.downscale_ratio
+        
+        # The VAE works on multiples of its downscale ratio; pad, then crop after decoding
+        pad_h = -target_h % ratio
+        pad_w = -target_w % ratio
+        pixels = upscaled_image
+        if pad_h or pad_w:
+            pixels = torch.nn.functional.pad(
+                pixels.permute(0, 3, 1, 2), (0, pad_w, 0, pad_h), mode='replicate'
+            ).permute(0, 2, 3, 1)
+        
+        print(f"[Upscaler] Encoding {frames}x {target_w}x{target_h} image to latent (tiled VAE)")
+        latent = self.comfyui_sampler.encode_image_tiled(pixels, tile_size=tile_size, overlap=64)
+        del pixels
+        
+        # Tile the latents in channels-last layout so tiles are [h, w, C] views
+        latent_hwc = latent.movedim(1, -1)
+        latent_tile_size = max(1, tile_size // ratio)
+        latent_overlap = tile_overlap // ratio
+        tiles, tile_frames, rects = self._plan_batch_tiles(latent_hwc, latent_tile_size,
+                                                           latent_overlap, unit=ratio)
+        
+        if joint:
+            if detail_threshold > 0:
+                print("[Upscaler] detail_threshold is ignored in joint mode (all tiles are denoised together)")
+            self.last_run_stats = {"tiles": len(tiles), "sampled": len(tiles), "reduced": 0, "skipped": 0}
+            self._dino_done()
+            blended = self._sample_joint(latent, rects, latent_overlap, dino_features, seed,
+                                         tile_batch_size, progress_callback, sampling_kwargs)
+            del tiles, latent_hwc, latent
+            return self._decode_latent_canvas(blended, target_h, target_w, latent_tile_size, latent_overlap)
+        
+        canvas = torch.zeros_like(latent_hwc)
+        stitchers = [
+            TileStitcher((latent_hwc.shape[2], latent_hwc.shape[1]), rects,
+                         overlap=latent_overlap, canvas=canvas[b])
+            for b in range(frames)
+        ]
+        
+        # Score each latent tile on the pixels it covers
+        tile_steps = self._plan_tile_steps(
+            [upscaled_image[b, y * ratio:(y + th) * ratio, x * ratio:(x + tw) * ratio]
+             for b in range(frames) for x, y, tw, th in rects],
+            sampling_kwargs["steps"], detail_threshold, flat_tile_steps, detail_method
+        )
+        job = JobManifest(job_dir, job_key, rects * frames) if job_key else None
+        
+        tile_features = self._tile_dino_features(
+            source_image, [(x * ratio, y * ratio, tw * ratio, th * ratio) for x, y, tw, th in rects],
+            (target_w, target_h), dino_features
+        )
+        
+        def sample_batch(batch, indices, batch_steps):
+            samples = self.comfyui_sampler.sample_latents(
+                batch.movedim(-1, 1).contiguous(),
+                seeds=[seed + i for i in indices],  # Different seed per tile for variation
+                dino_features=tile_features[indices] if tile_features is not None else None,
+                **dict(sampling_kwargs, steps=batch_steps)
             )
+            return samples.movedim(1, -1)
+        
+        self._sample_tile_batches(tiles, stitchers, sample_batch, tile_batch_size,
+                                  progress_callback, tile_steps=tile_steps,
+                                  tile_key=self._make_tile_key(sampling_kwargs, seed, "latent"),
+                                  job=job, tile_frames=tile_frames)
+        del tiles, latent_hwc, latent
+        
+        blended = canvas.movedim(-1, 1)
+        result = self._decode_latent_canvas(blended, target_h, target_w, latent_tile_size, latent_overlap)
+        if job:
+            job.finish()
+        return result
+    
+    def _sample_joint(self, latent, rects, latent_overlap, dino_features, seed, tile_batch_size,
+                      progress_callback, sampling_kwargs):
+        """Denoise all latent tiles together in one sampler run (MultiDiffusion)"""
+        frames = latent.shape[0]
+        print(f"[Upscaler] Jointly denoising {len(rects)} latent tiles x {frames} image(s)")
+        total = len(rects) * frames
+        reported = [0]
+        
+        def step_callback(step, total_steps):
+            # Report progress in tiles, spread over the sampling steps
+            done = total * (step + 1) // total_steps
+            while progress_callback and reported[0] < done:
+                reported[0] += 1
+                progress_callback()
+        
+        return self.comfyui_sampler.sample_latents(
+            latent,
+            seeds=[seed + b for b in range(frames)],
+            dino_features=dino_features,
+            model_wrapper=JointTileDenoiser(rects, overlap=latent_overlap,
+                                            tile_batch_size=tile_batch_size),
+            step_callback=step_callback,
+            **sampling_kwargs
+        )
+    
+    def _decode_latent_canvas(self, latent, target_h, target_w, latent_tile_size, latent_overlap):
+        """Decode blended [B, C, h, w] latents once and crop away VAE padding"""
+        print("[Upscaler] Decoding blended latent (tiled VAE)")
+        result = self.comfyui_sampler.decode_latent_tiled(
+            latent, tile_size=latent_tile_size, overlap=max(latent_overlap, 1)
+        )
+        return result[:, :target_h, :target_w]
+    
+    def _dino_done(self):
+        if self.dino_done_callback is not None:
+            self.dino_done_callback()
+    
+    def _tile_dino_features(self, image, rects, size, dino_features):
+        """DINO features for every tile (see _extract_tile_features); then DINO work is over"""
+        try:
+            return self._extract_tile_features(image, rects, size, dino_features)
+        finally:
+            self._dino_done()
+    
+    def _extract_tile_features(self, image, rects, size, dino_features):
+        """
+        DINO patch features for every tile of the batch
+        
+        Each image's feature pyramid is extracted once (a few forwards, see
+        DINOFeatureExtractor.extract_pyramid), and every tile's features are
+        cropped from it at the source region under the tile. A single tile
+        just uses the whole-image features. Nothing is extracted for a
+        sampler that does not condition on DINO features.
+        
+        Args:
+            image: Source image batch [B, H, W, C]
+            rects: Tile rects in target pixels, the same for every image
+            size: Target (width, height) the rects refer to
+            dino_features: Whole-image features [B, N, D], or None when DINO
+                           guidance is off
+            
+        Returns:
+            Tensor [B * num_tiles, N, D] in tile order, or None
+        """
+        if dino_features is None or not getattr(self.comfyui_sampler, "conditions_on_dino", False):
+            return None
+        if len(rects) == 1:
+            return dino_features  # one tile per image
+        if self.dino_extractor is None:
+            return None
+        
+        frames, h, w = image.shape[:3]
+        sx, sy = w / size[0], h / size[1]
+        source_rects = [(x * sx, y * sy, tw * sx, th * sy) for x, y, tw, th in rects]
+        resolutions = self.dino_pyramid
+        if self.dino_resolution:
+            resolutions = (self.dino_resolution // 2, self.dino_resolution)
+        
+        features = []
+        for b in range(frames):
+            pyramid = self.dino_extractor.extract_pyramid(image[b], resolutions)
+            # All tiles share the first tile's grid so they stack
+            grid_size = pyramid.grid_size(source_rects[0])
+            features.extend(pyramid.crop(rect, grid_size) for rect in source_rects)
+        features = torch.stack(features)
+        print(f"[Upscaler] Cropped DINO features for {features.shape[0]} tiles "
+              f"({features.shape[1]}x{features.shape[2]} patches each) from "
+              f"{len(resolutions)}-level feature pyramids")
+        return features.flatten(1, 2)
+    
+    def _plan_batch_tiles(self, images, tile_size, overlap, unit=1):
+        """
+        Tile every image of a [B, H, W, C] batch on the same grid
+        
+        Returns:
+            (tiles, tile_frames, rects): (tile, x, y) views for every image in
+            turn, the batch index of each tile, and the grid's rects
+        """
+        rects = self._plan_rects(images.shape[2], images.shape[1], tile_size, overlap, unit=unit)
+        
+        tiles = []
+        tile_frames = []
+        for b in range(images.shape[0]):
+            for x, y, w, h in rects:
+                tiles.append((images[b, y:y + h, x:x + w], x, y))
+                tile_frames.append(b)
+        return tiles, tile_frames, rects
+    
+    def _plan_rects(self, w, h, tile_size, overlap, unit=1):
+        """(x, y, width, height) of every tile of a w x h canvas, one if it fits"""
+        if h <= tile_size and w <= tile_size:
+            print(f"[Upscaler] Image {w * unit}x{h * unit} fits in one tile (tile_size={tile_size * unit})")
+            return [(0, 0, w, h)]
+        
+        # Tile sides stay multiples of 8 pixels (one latent cell)
+        grid = TileGrid(w, h, tile_size, overlap, align=max(1, 8 // unit))
+        print(f"[Upscaler] Processing {grid.report(unit)}")
+        return grid.rects()
+    
+    def _resample_tile(self, source, size, rect):
+        """
+        Lanczos-resize only the tile `rect` of the target-size image
+        
+        Reads just the source window (plus kernel support) the tile depends
+        on, and matches the same region of a full cv2 resize. On the CPU the
+        window is resized by cv2 where the size ratio allows (see
+        _cv2_window), which is ~10x faster there than the torch kernels used
+        on other devices.
+        
+        Args:
+            source: Source image tensor [H, W, C]
+            size: Target image (width, height)
+            rect: (x, y, width, height) of the tile in the target image
+        """
+        in_size = (source.shape[1], source.shape[0])
+        if source.device.type != "cpu" or not self._cv2_windows_align(in_size, size):
+            return resize_image(source, size, mode="lanczos4", antialias=False, window=rect).clamp_(0.0, 1.0)
+        
+        x, y, w, h = rect
+        sx0, sx1, ox0, ox1 = self._cv2_window(source.shape[1], size[0], x, w)
+        sy0, sy1, oy0, oy1 = self._cv2_window(source.shape[0], size[1], y, h)
+        window = self._resize_tensor(source[sy0:sy1, sx0:sx1], (ox1 - ox0, oy1 - oy0))
+        return window[y - oy0:y - oy0 + h, x - ox0:x - ox0 + w]
+    
+    # Source pixels a Lanczos-4 tap reaches beyond the output pixel's centre, plus rounding
+    LANCZOS_SUPPORT = 5
+    
+    @staticmethod
+    def _cv2_window(in_size, out_size, start, length):
+        """
+        Source window whose cv2 resize reproduces output pixels start..start+length
+        
+        cv2.resize maps output pixels onto the source by the window's size
+        ratio, so the window must span a whole number of ratio periods
+        (in_size / gcd(in_size, out_size) source pixels) for its samples to
+        land where the full resize's do. It is widened by the kernel support.
+        
+        Returns:
+            (source start, source end, output start, output end)
+        """
+        period = in_size // math.gcd(in_size, out_size)
+        first = math.floor(start * in_size / out_size) - BasicUpscaler.LANCZOS_SUPPORT
+        last = math.ceil((start + length) * in_size / out_size) + BasicUpscaler.LANCZOS_SUPPORT
+        first = max(0, first // period * period)
+        last = min(in_size, -(-last // period) * period)
+        return first, last, first * out_size // in_size, last * out_size // in_size
+    
+    @staticmethod
+    def _cv2_windows_align(in_size, out_size):
+        """Whether cv2 windows of an (width, height) image are much smaller than the image"""
+        return all(in_dim // math.gcd(in_dim, out_dim) * 4 <= in_dim
+                   for in_dim, out_dim in zip(in_size, out_size))
+    
+    def _plan_tile_steps(self, regions, steps, detail_threshold=0.0, flat_tile_steps=0,
+                         detail_method="gradient"):
+        """
+        Pick a step count for every tile from its detail score
+        
+        Flat tiles (score below detail_threshold) get flat_tile_steps, where 0
+        means the tile is not sampled at all. The counts are recorded in
+        self.last_run_stats and reported. Lazy tiles are not resampled just
+        to be scored: their count is left as None for _sample_tile_batches
+        to fill in once it resamples them, and reported afterwards with
+        _report_tile_steps.
+        
+        Args:
+            regions: Pixel region of each tile, [h, w, C] tensors or
+                     callables that resample it (see _resample_tile)
+            steps: Step count for detailed tiles
+            
+        Returns:
+            List with the step count for each tile (0 = skip sampling,
+            None = score when resampled)
+        """
+        self.last_run_stats = {}
+        tile_steps = [
+            None if detail_threshold > 0 and callable(region) else
+            self._tile_step_count(region, steps, detail_threshold, flat_tile_steps, detail_method)
+            for region in regions
+        ]
+        if None not in tile_steps:
+            self._report_tile_steps(tile_steps, steps, detail_threshold, flat_tile_steps, detail_method)
+        return tile_steps
+    
+    def _tile_step_count(self, region, steps, detail_threshold=0.0, flat_tile_steps=0,
+                         detail_method="gradient"):
+        """Step count for one [h, w, C] tile region (see _plan_tile_steps)"""
+        if detail_threshold > 0 and tile_detail_score(region, detail_method, self.scale_factor) < detail_threshold:
+            return min(max(0, flat_tile_steps), steps)
+        return steps
+    
+    def _report_tile_steps(self, tile_steps, steps, detail_threshold=0.0, flat_tile_steps=0,
+                           detail_method="gradient"):
+        """Record and print how many tiles the detail pre-pass skipped or reduced"""
+        flat_steps = min(max(0, flat_tile_steps), steps)
+        # Tiles never scored (finished in a resumed job) count as sampled
+        flat = sum(1 for s in tile_steps if s is not None and s != steps)
+        skipped = tile_steps.count(0) if flat_steps == 0 else 0
+        self.last_run_stats.update(
+            tiles=len(tile_steps),
+            sampled=len(tile_steps) - flat,
+            reduced=flat - skipped,
+            skipped=skipped,
+        )
+        if detail_threshold > 0:
+            print(f"[Upscaler] Detail pre-pass ({detail_method}, threshold {detail_threshold}): "
+                  f"{skipped}/{len(tile_steps)} flat tiles skipped, "
+                  f"{flat - skipped} reduced to {flat_steps} steps")
+    
+    def _make_tile_key(self, sampling_kwargs, seed, mode):
+        """
+        Build the tile cache key function for one run, or None without a cache
+        
+        Keys cover the tile contents, the model/VAE/CLIP identity, the
+        tiling mode and every sampling setting, including the per-tile seed
+        and step count.
+        """
+        if self.tile_cache is None:
+            return None
+        
+        params = {k: v for k, v in sampling_kwargs.items() if k != "preview_callback"}
+        params["model"] = self.comfyui_sampler.fingerprint()
+        params["mode"] = mode
+        
+        def tile_key(i, tile, steps):
+            return self.tile_cache.key(tile, **dict(params, seed=seed + i, steps=steps))
+        
+        return tile_key
+    
+    def _sample_tile_batches(self, tiles, stitchers, sample_batch, tile_batch_size,
+                             progress_callback=None, tile_steps=None, tile_key=None, job=None,
+                             tile_frames=None, score_tile=None):
+        """
+        Sample tiles in batches and blend each result into the stitcher
+        
+        Edge tiles can be smaller than tile_size, so tiles are bucketed by
+        shape (and step count) and each bucket is sampled as one batch once
+        it is full. Tiles with a step count of 0 are stitched unchanged, and
+        tiles found in the tile cache or already completed in a resumed job
+        are stitched without sampling. Lazy tiles are resampled on the prep
+        thread only when needed, and are dropped once their batch is sampled.
+        
+        Runs as a TilePipeline: batches are assembled (and cache lookups
+        done) on a prep thread while the previous batch samples, and results
+        are stitched, cached and checkpointed on a stitch thread. Sampling
+        stays on the calling thread, and tiles are stitched in the same
+        order as when run serially.
+        
+        Args:
+            tiles: List of (tile, x, y) tuples, tiles as [h, w, C] tensors or
+                   callables that produce them (see _resample_tile)
+            stitchers: One TileStitcher per image receiving its sampled tiles
+            sample_batch: Callable (batch [N, h, w, C], tile indices, steps) -> [N, h, w, C]
+            tile_batch_size: Maximum number of tiles per batch
+            progress_callback: Optional callback invoked once per finished tile
+            tile_steps: Optional step count per tile (see _plan_tile_steps);
+                        None entries are filled in with score_tile(tile)
+                        once the tile is resampled
+            tile_key: Optional callable (tile index, tile, steps) -> cache key
+                      (see _make_tile_key); requires self.tile_cache
+            job: Optional JobManifest; finished tiles are checkpointed to it
+            tile_frames: Image index of each tile (default: all image 0)
+            score_tile: Callable tile -> step count for deferred tiles
+        """
+        keys = {}
+        counts = {"hits": 0, "misses": 0}
+        
+        if job is not None and job.resumed:
+            print(f"[Upscaler] Resuming job: {job.resumed}/{len(tiles)} tiles already done")
+        
+        def prepare():
+            """Yield (indices, tiles, steps) work items; steps is None for finished tiles"""
+            buckets = {}
+            for i, (tile, x, y) in enumerate(tiles):
+                steps = tile_steps[i] if tile_steps is not None else None
+                if job is not None and i in job.completed:
+                    yield [i], [job.load_tile(i)], None
+                    continue
+                if callable(tile):
+                    tile = tile()
+                if steps is None and score_tile is not None:
+                    steps = tile_steps[i] = score_tile(tile)
+                if steps == 0:
+                    # Flat tile: keep the resized pixels as they are
+                    yield [i], [tile], None
+                    continue
+                
+                if tile_key is not None:
+                    cache_key = tile_key(i, tile, steps)
+                    cached = self.tile_cache.get(cache_key)
+                    if cached is not None:
+                        counts["hits"] += 1
+                        yield [i], [cached], None
+                        continue
+                    counts["misses"] += 1
+                    keys[i] = cache_key
+                
+                key = (tile.shape, steps)
+                indices, bucket = buckets.setdefault(key, ([], []))
+                indices.append(i)
+                bucket.append(tile)
+                if len(bucket) >= tile_batch_size:
+                    yield indices, torch.stack(bucket), steps
+                    buckets[key] = ([], [])
             
-            # Convert back to numpy
-            processed_tile = np.array(processed_tile_pil)
-            processed_tiles.append((processed_tile, x, y))
+            # Flush partially filled buckets (usually the ragged edge tiles)
+            for (_, steps), (indices, bucket) in buckets.items():
+                if bucket:
+                    yield indices, torch.stack(bucket), steps
+        
+        def process(item):
+            indices, batch, steps = item
+            if steps is None:
+                return indices, batch, False
             
-            # Update progress
-            if progress_callback:
-                try:
-                    progress_callback()
-                except Exception:
-                    raise
+            for i in indices:
+                _, x, y = tiles[i]
+                print(f"[Upscaler] Processing tile {i+1}/{len(tiles)} at position ({x}, {y})")
+            return indices, sample_batch(batch, indices, steps), True
+        
+        def finish(result):
+            indices, processed_batch, sampled = result
+            for j, i in enumerate(indices):
+                if i in keys:
+                    self.tile_cache.put(keys.pop(i), processed_batch[j])
+                if sampled and job is not None:
+                    job.record(i, processed_batch[j])
+                _, x, y = tiles[i]
+                stitchers[tile_frames[i] if tile_frames else 0].add(processed_batch[j], x, y)
+                
+                # Update progress
+                if progress_callback:
+                    try:
+                        progress_callback()
+                    except Exception:
+                        raise
         
-        # Stitch tiles back together
-        print(f"[Upscaler] Stitching {len(processed_tiles)} tiles")
-        result_pil = self.stitch_tiles(processed_tiles, (target_w, target_h), 
-                                       tile_size=tile_size, overlap=overlap)
+        TilePipeline(self.pipeline_depth).run(prepare(), process, finish)
         
-        return result_pil
+        if tile_key is not None:
+            self.last_run_stats.update(cache_hits=counts["hits"], cache_misses=counts["misses"])
+            print(f"[Upscaler] Tile cache: {counts['hits']} hits, {counts['misses']} misses")
     
-    def generate_tiles(self, image, tile_size=512, overlap=64):
+    def generate_tiles(self, image, tile_size=512, overlap=64, align=8):
         """
         Generate overlapping tiles from an image
         
+        The grid comes from TileGrid: the fewest tiles that cover the image
+        with at least `overlap` between neighbours, shrunk to the smallest
+        size that still does and spaced evenly.
+        
         Args:
-            image: PIL Image or numpy array
-            tile_size: Size of each tile (default 512)
-            overlap: Pixel overlap between tiles (default 64)
+            image: PIL Image, numpy array or [H, W, C] tensor
+            tile_size: Maximum size of each tile (default 512)
+            overlap: Minimum pixel overlap between tiles (default 64)
+            align: Tile sides are rounded up to a multiple of this
             
         Returns:
-            List of (tile, x, y) tuples
+            List of (tile, x, y) tuples; tiles are views into image
         """
         if isinstance(image, Image.Image):
             image = np.array(image)
         
         h, w = image.shape[:2]
-        stride = tile_size - overlap
-        tiles = []
+        grid = TileGrid(w, h, tile_size, overlap, align=align)
         
-        for y in range(0, h, stride):
-            for x in range(0, w, stride):
-                y_end = min(y + tile_size, h)
-                x_end = min(x + tile_size, w)
-                
-                # Adjust start if we're at the edge
-                y_start = max(0, y_end - tile_size)
-                x_start = max(0, x_end - tile_size)
-                
-                tile = image[y_start:y_end, x_start:x_end]
-                tiles.append((tile, x_start, y_start))
+        tiles = []
+        for x_start, y_start, tile_w, tile_h in grid.rects():
+            tile = image[y_start:y_start + tile_h, x_start:x_start + tile_w]
+            tiles.append((tile, x_start, y_start))
         
         return tiles
     
@@ -181,68 +866,67 @@ class BasicUpscaler:
         Stitch tiles back into a single image with blending
         
         Args:
-            tiles: List of (tile, x, y) tuples
+            tiles: List of (tile, x, y) tuples; tiles are uint8 numpy arrays,
+                   or float tensors [H, W, C] in the 0.0-1.0 range
             output_size: (width, height) of final image
             tile_size: Size of each tile
             overlap: Pixel overlap between tiles
             
         Returns:
-            Stitched PIL Image
+            Stitched PIL Image, or an [H, W, C] float tensor for tensor tiles
         """
-        w, h = output_size
-        result = np.zeros((h, w, 3), dtype=np.float32)
-        weights = np.zeros((h, w), dtype=np.float32)
-        
-        for i, (tile, x, y) in enumerate(tiles):
-            tile_h, tile_w = tile.shape[:2]
-            
-            # Ensure tile doesn't exceed canvas boundaries
-            max_h = min(tile_h, h - y)
-            max_w = min(tile_w, w - x)
-            
-            # Crop tile if it exceeds boundaries
-            if max_h < tile_h or max_w < tile_w:
-                tile = tile[:max_h, :max_w]
-                tile_h, tile_w = tile.shape[:2]
-            
-            # Create blend mask matching the exact (possibly cropped) tile dimensions
-            mask = self._create_blend_mask(tile_h, tile_w, overlap)
-            
-            # Convert to proper shape for broadcasting
-            mask_3d = mask[:, :, np.newaxis]
-            
-            # Apply mask
-            result[y:y+tile_h, x:x+tile_w] += tile * mask_3d
-            weights[y:y+tile_h, x:x+tile_w] += mask
-        
-        # Normalize by weights
-        weights = np.maximum(weights, 1e-8)
-        result = result / weights[:, :, np.newaxis]
-        result = np.clip(result, 0, 255).astype(np.uint8)
+        is_tensor = bool(tiles) and isinstance(tiles[0][0], torch.Tensor)
+        if not is_tensor:
+            tiles = [(torch.from_numpy(np.ascontiguousarray(tile)), x, y) for tile, x, y in tiles]
+        try:
+            stitcher = TileStitcher(
+                output_size,
+                [(x, y, tile.shape[1], tile.shape[0]) for tile, x, y in tiles],
+                overlap=overlap,
+                channels=tiles[0][0].shape[-1] if tiles else 3,
+                device=tiles[0][0].device if is_tensor else None
+            )
+        except ValueError:
+            # Tiles off a rectilinear grid: blend with a weights plane instead
+            result = self._stitch_off_grid(tiles, output_size, overlap)
+        else:
+            for tile, x, y in tiles:
+                stitcher.add(tile, x, y)
+            result = stitcher.result()
+        if is_tensor:
+            return result.clamp_(0.0, 1.0)
         
+        result = result.clamp_(0, 255).round_().to(torch.uint8).numpy()
         return Image.fromarray(result)
     
-    def _create_blend_mask(self, height, width, overlap):
-        """Create a blending mask for smooth tile transitions"""
-        mask = np.ones((height, width), dtype=np.float32)
+    def _stitch_off_grid(self, tiles, output_size, overlap):
+        """Weighted-average blend of arbitrarily placed [H, W, C] tensor tiles"""
+        width, height = output_size
+        device = tiles[0][0].device
+        canvas = torch.zeros((height, width, tiles[0][0].shape[-1]), device=device)
+        weights = torch.zeros((height, width, 1), device=device)
+        for tile, x, y in tiles:
+            tile = tile[:height - y, :width - x].to(device=device, dtype=torch.float32)
+            tile_h, tile_w = tile.shape[:2]
+            # Fade only the sides that face into the image
+            edges = (y > 0, y + tile_h < height, x > 0, x + tile_w < width)
+            mask = torch.from_numpy(self._create_blend_mask(tile_h, tile_w, overlap, edges)).to(device)
+            canvas[y:y + tile_h, x:x + tile_w] += tile * mask[..., None]
+            weights[y:y + tile_h, x:x + tile_w] += mask[..., None]
+        return canvas / weights.clamp_(min=1e-8)
+    
+    def _create_blend_mask(self, height, width, overlap, edges=(True, True, True, True)):
+        """
+        Create a blending mask for smooth tile transitions
         
-        if overlap > 0:
-            # Calculate fade region size (use smaller of overlap or available space)
-            fade_h = min(overlap, height)
-            fade_w = min(overlap, width)
-            
-            if fade_h > 0:
-                fade = np.linspace(0, 1, fade_h)
-                # Fade in from top
-                mask[:fade_h, :] *= fade[:, np.newaxis]
-                # Fade out to bottom
-                mask[-fade_h:, :] *= fade[::-1, np.newaxis]
+        Args:
+            height, width: Mask size
+            overlap: Fade width in pixels
+            edges: Which sides fade, as (top, bottom, left, right)
             
-            if fade_w > 0:
-                fade = np.linspace(0, 1, fade_w)
-                # Fade in from left
-                mask[:, :fade_w] *= fade[np.newaxis, :]
-                # Fade out to right
-                mask[:, -fade_w:] *= fade[np.newaxis, ::-1]
-        
-        return mask
+        Returns:
+            Float32 numpy array of shape (height, width)
+        """
+        top, bottom, left, right = edges
+        mask = blend_ramp(height, overlap, top, bottom)[:, None] * blend_ramp(width, overlap, left, right)[None, :]
+        return mask.numpy()
@@ -0,0 +1,128 @@
+"""
+Tests for prompt conditioning reuse in the ComfyUI sampler wrapper
+"""
+import sys
+from pathlib import Path
+
+import torch
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from comfyui_sampler import ComfyUISamplerWrapper, ConditioningCache, conditioning_cache
+
+
+class FakeClip:
+    """Stand-in for a ComfyUI CLIP that counts encodes"""
+    
+    def __init__(self):
+        self.encodes = 0
+    
+    def tokenize(self, text):
+        return text
+    
+    def encode_from_tokens_scheduled(self, tokens):
+        self.encodes += 1
+        return [[torch.full((1, 77, 768), float(len(tokens))), {}]]
+
+
+def test_prompts_encoded_once_across_tiles_and_wrappers():
+    """Test that an 80-tile job encodes each prompt once"""
+    conditioning_cache.clear()
+    clip = FakeClip()
+    
+    for _ in range(2):
+        # A wrapper per node execution, sharing the module-level cache
+        wrapper = ComfyUISamplerWrapper(model=None, vae=None, clip=clip)
+        for _ in range(80):
+            positive, negative = wrapper._prepare_conditioning(None, None, "a castle", "")
+    
+    assert clip.encodes == 2
+    assert positive[0][0][0, 0, 0] == len("a castle")
+    assert negative[0][0][0, 0, 0] == 0
+
+
+def test_cache_keyed_by_clip_identity():
+    """Test that another CLIP encodes the same prompt again"""
+    cache = ConditioningCache()
+    first, second = FakeClip(), FakeClip()
+    
+    assert cache.get(first, "prompt") is cache.get(first, "prompt")
+    cache.get(second, "prompt")
+    assert (first.encodes, second.encodes) == (1, 1)
+    
+    # A freed CLIP's entry is not handed to a new object reusing its id()
+    key = (id(second), "prompt")
+    del second
+    assert cache._entries[key][0]() is None
+
+
+def test_cache_lru_limit():
+    """Test that the least recently used prompts are dropped"""
+    cache = ConditioningCache(max_entries=2)
+    clip = FakeClip()
+    
+    cache.get(clip, "a")
+    cache.get(clip, "b")
+    cache.get(clip, "a")
+    cache.get(clip, "c")
+    assert cache.stats() == {"hits": 1, "misses": 3, "entries": 2}
+    
+    # "b" was evicted, "a" was not
+    cache.get(clip, "a")
+    cache.get(clip, "b")
+    assert clip.encodes == 4
+
+
+def test_empty_conditioning_shared_without_clip():
+    """Test that the zero conditioning is allocated once"""
+    wrapper = ComfyUISamplerWrapper(model=None, vae=None)
+    positive, negative = wrapper._prepare_conditioning(None, None, "ignored", "")
+    
+    assert positive is negative
+    assert positive[0][0].shape == (1, 77, 768)
+    assert wrapper._prepare_conditioning(None, None, None, None)[0] is positive
+
+
+def test_stochastic_samplers_detected():
+    """Test that samplers drawing per-step noise are told apart from deterministic ones"""
+    for name in ("euler_ancestral", "euler_a", "dpmpp_2s_a", "dpmpp_2m_sde", "dpmpp_sde_gpu", "ddpm", "lcm"):
+        assert ComfyUISamplerWrapper.is_stochastic_sampler(name), name
+    for name in ("euler", "heun", "dpmpp_2m", "ddim", "uni_pc", "uni_pc_bh2", "lms"):
+        assert not ComfyUISamplerWrapper.is_stochastic_sampler(name), name
+
+
+def test_stochastic_samplers_sampled_one_by_one():
+    """Test that a batch for an ancestral sampler is split into single-latent calls"""
+    wrapper = ComfyUISamplerWrapper(model=None, vae=None)
+    calls, steps = [], []
+    
+    def sample_single(latent, seeds, step_callback=None, **kwargs):
+        calls.append((latent.shape[0], seeds))
+        for step in range(2):
+            step_callback(step, 2)
+        return latent + seeds[0]
+    
+    wrapper.sample_latents = sample_single
+    latent = torch.zeros(3, 4, 8, 8)
+    result = ComfyUISamplerWrapper.sample_latents(
+        wrapper, latent, [5, 6, 7], sampler_name="euler_ancestral",
+        step_callback=lambda step, total: steps.append((step, total))
+    )
+    
+    assert calls == [(1, [5]), (1, [6]), (1, [7])]
+    assert result[:, 0, 0, 0].tolist() == [5, 6, 7]
+    assert steps == [(step, 6) for step in range(6)]
+
+
+def test_preview_decodes_first_latent_only():
+    """Test that previews of a batched tile decode a single latent"""
+    wrapper = ComfyUISamplerWrapper(model=None, vae=None)
+    decoded, previews = [], []
+    wrapper.decode_latent = lambda latent: decoded.append(latent.shape) or latent
+    callback = wrapper._make_sampler_callback(previews.append)
+    
+    callback(0, torch.zeros(4, 4, 16, 16), None, 10)
+    
+    assert decoded == [(1, 4, 16, 16)]
+    assert len(previews) == 1
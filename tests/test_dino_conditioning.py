@@ -129,5 +129,149 @@ def test_spatial_alignment_non_square():
         adapter.align_spatial_dimensions(dino_features, (16, 16))
 
 
+
+def test_spatial_alignment_rectangular_grid():
+    """Test that rectangular grids align given their shape"""
+    adapter = DINOConditioningAdapter(device="cpu")
+    
+    # A 2:1 image at native resolution: 18x37 patches
+    dino_features = torch.randn(18 * 37, 768)
+    aligned = adapter.align_spatial_dimensions(dino_features, (32, 64), source_shape=(18, 37))
+    assert aligned.shape == (32 * 64, 768)
+    
+    # A patch grid carries its own shape
+    grid = dino_features.reshape(18, 37, 768)
+    assert torch.equal(adapter.align_spatial_dimensions(grid, (32, 64)), aligned)
+    
+    with pytest.raises(ValueError, match="does not match"):
+        adapter.align_spatial_dimensions(dino_features, (32, 64), source_shape=(16, 16))
+
+
+def test_pool_tokens():
+    """Test that every pooling method bounds the token count"""
+    adapter = DINOConditioningAdapter(device="cpu")
+    dino_features = torch.randn(18 * 37, 768)
+    
+    for method in ("avg", "kmeans", "topk"):
+        pooled = adapter.pool_tokens(dino_features, 64, method, source_shape=(18, 37))
+        assert pooled.shape[0] <= 64 and pooled.shape[1] == 768
+    
+    # Average pooling keeps the grid's aspect ratio
+    assert adapter.pool_tokens(dino_features, 64, "avg", source_shape=(18, 37)).shape == (5 * 12, 768)
+    
+    # Top-k keeps patches unchanged, in grid order
+    kept = adapter.pool_tokens(dino_features, 10, "topk")
+    rows = [int((dino_features == row).all(dim=1).nonzero()) for row in kept]
+    assert rows == sorted(rows)
+    
+    # Fewer patches than tokens pass through
+    assert torch.equal(adapter.pool_tokens(dino_features, 1000), dino_features)
+    
+    with pytest.raises(ValueError, match="Unknown pooling"):
+        adapter.pool_tokens(dino_features, 64, "max")
+
+
+def test_kmeans_pooling_finds_clusters():
+    """Test that k-means centroids recover well separated clusters"""
+    adapter = DINOConditioningAdapter(device="cpu")
+    centres = torch.randn(4, 768) * 10
+    dino_features = centres.repeat_interleave(64, dim=0) + torch.randn(256, 768) * 0.01
+    
+    centroids = adapter.pool_tokens(dino_features, 4, "kmeans")
+    assert torch.allclose(centroids, centres, atol=0.01)
+
+
+def test_prepare_conditioning_max_tokens():
+    """Test that max_tokens bounds the conditioning sequence length"""
+    adapter = DINOConditioningAdapter(device="cpu")
+    dino_features = torch.randn(37 * 37, 768)
+    text_embeddings = torch.randn(1, 77, 4096)
+    
+    combined = adapter.prepare_conditioning_embeddings(dino_features, text_embeddings,
+                                                       max_tokens=256)
+    assert combined.shape == (1, 77 + 256, 4096)
+    assert adapter.last_sequence_length == 256
+    
+    adapter.prepare_conditioning_embeddings(dino_features)
+    assert adapter.last_sequence_length == 37 * 37
+
+
+def test_align_and_project_batched():
+    """Test that the batched path matches aligning and projecting each map"""
+    adapter = DINOConditioningAdapter(device="cpu")
+    dino_features = torch.randn(3, 18 * 37, 768)
+    
+    projected = adapter.align_and_project(dino_features, (32, 64), 0.7, source_shape=(18, 37))
+    assert projected.shape == (3, 32 * 64, 4096)
+    for i in range(3):
+        aligned = adapter.align_spatial_dimensions(dino_features[i], (32, 64), source_shape=(18, 37))
+        expected = adapter.project_features(aligned, 0.7)
+        assert torch.allclose(projected[i], expected, atol=1e-5)
+    
+    # Patch grids carry their own shape; a single map keeps its shape
+    grids = dino_features.reshape(3, 18, 37, 768)
+    assert torch.allclose(adapter.align_and_project(grids, (32, 64), 0.7), projected, atol=1e-6)
+    single = adapter.align_and_project(dino_features[0], None, 0.7)
+    assert single.shape == (18 * 37, 4096)
+
+
+def test_align_and_project_memoised():
+    """Test that projections are reused for the same features and strength"""
+    adapter = DINOConditioningAdapter(device="cpu")
+    dino_features = torch.randn(2, 256, 768)
+    
+    first = adapter.align_and_project(dino_features, (8, 8), 0.5)
+    assert adapter.align_and_project(dino_features, (8, 8), 0.5) is first
+    
+    # A different strength, target shape or equal-valued tensor is projected again
+    assert adapter.align_and_project(dino_features, (8, 8), 0.6) is not first
+    assert adapter.align_and_project(dino_features, (16, 16), 0.5) is not first
+    assert adapter.align_and_project(dino_features.clone(), (8, 8), 0.5) is not first
+    
+    # So are features modified in place
+    dino_features.mul_(2)
+    again = adapter.align_and_project(dino_features, (8, 8), 0.5)
+    assert again is not first
+    assert not torch.allclose(again, first)
+    
+    # The cache is bounded
+    adapter.projection_cache_size = 2
+    kept = [torch.randn(256, 768) for _ in range(4)]
+    for features in kept:
+        adapter.align_and_project(features)
+    assert len(adapter._projection_cache) == 2
+
+
+def test_align_and_project_inference_tensors():
+    """Test that features created under inference mode are projected and memoised"""
+    adapter = DINOConditioningAdapter(device="cpu")
+    with torch.inference_mode():
+        dino_features = torch.randn(18 * 37, 768)
+    
+    first = adapter.prepare_conditioning_embeddings(dino_features, target_shape=(32, 64),
+                                                    source_shape=(18, 37))
+    again = adapter.prepare_conditioning_embeddings(dino_features, target_shape=(32, 64),
+                                                    source_shape=(18, 37))
+    assert first.shape == (1, 32 * 64, 4096)
+    assert torch.equal(again, first)
+    assert len(adapter._projection_cache) == 1
+
+
+def test_prepare_conditioning_grid_memoised():
+    """Test that patch grid inputs are memoised and freed features forgotten"""
+    adapter = DINOConditioningAdapter(device="cpu")
+    grid = torch.randn(18, 37, 768)
+    
+    first = adapter.prepare_conditioning_embeddings(grid, target_shape=(32, 64))
+    again = adapter.prepare_conditioning_embeddings(grid, target_shape=(32, 64))
+    assert first.shape == (1, 32 * 64, 4096)
+    assert again.data_ptr() == first.data_ptr()
+    assert len(adapter._projection_cache) == 1
+    
+    # Entries go away with their features
+    del grid
+    assert len(adapter._projection_cache) == 0
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
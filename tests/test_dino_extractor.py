@@ -9,6 +9,8 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
 
 from dino_extractor import DINOFeatureExtractor
+from feature_cache import FeatureCache
+from dino_conditioning import DINOConditioningAdapter
 
 
 @pytest.fixture
@@ -73,3 +75,132 @@ def test_feature_shape_matches_grid(extractor, sample_image):
     
     expected_patches = grid_size[0] * grid_size[1]
     assert features.shape[0] == expected_patches
+
+
+def test_extract_features_batch(extractor):
+    """Test that batched extraction matches one-by-one extraction"""
+    images = torch.rand(3, 224, 224, 3)
+    
+    features = extractor.extract_features_batch(images, batch_size=2)
+    
+    assert features.shape[0] == 3
+    assert torch.allclose(features[1], extractor.extract_features(images[1]), atol=1e-4)
+
+
+def test_extract_tile_features(extractor):
+    """Test that tiles are extracted in batches as per-tile patch grids"""
+    image = torch.rand(300, 400, 3)
+    rects = [(0, 0, 200, 200), (200, 0, 200, 200), (0, 100, 200, 200)]
+    
+    features = extractor.extract_tile_features(image, rects, batch_size=2)
+    
+    assert features.shape == (3, 16, 16, 768)
+    expected = extractor.extract_features(image[0:200, 200:400])
+    assert torch.allclose(features[1].reshape(-1, 768), expected, atol=1e-4)
+
+
+def test_feature_cache_skips_model(extractor):
+    """Test that repeated images are served from the feature cache"""
+    extractor.feature_cache = FeatureCache()
+    images = torch.rand(2, 224, 224, 3)
+    
+    first = extractor.extract_features_batch(images)
+    second = extractor.extract_features_batch(images[[1, 0]])
+    
+    assert torch.equal(second, first[[1, 0]])
+    assert extractor.feature_cache.stats()["memory_hits"] == 2
+
+
+@pytest.mark.parametrize("precision,min_similarity", [
+    ("fp16", 0.99),
+    ("bf16", 0.98),
+    ("int8", 0.95),
+])
+def test_reduced_precision_parity(extractor, precision, min_similarity):
+    """Test that reduced-precision features stay close to fp32 (cosine similarity)"""
+    images = torch.rand(2, 224, 224, 3)
+    reduced = DINOFeatureExtractor(precision=precision)
+    
+    expected = extractor.extract_features_batch(images).cpu()
+    features = reduced.extract_features_batch(images).cpu()
+    
+    similarity = torch.nn.functional.cosine_similarity(features, expected, dim=-1)
+    print(f"{precision}: cosine similarity vs fp32 mean {similarity.mean():.5f}, "
+          f"min {similarity.min():.5f}")
+    assert features.dtype == torch.float32
+    assert similarity.mean() >= min_similarity
+
+
+def test_unknown_precision_rejected():
+    """Test that an unknown precision fails before loading the model"""
+    with pytest.raises(ValueError, match="precision"):
+        DINOFeatureExtractor(precision="fp8")
+
+
+def test_extract_features_native(extractor):
+    """Test native-resolution extraction of a wide image in one forward"""
+    image = torch.rand(200, 400, 3)
+    
+    features, grid_size = extractor.extract_features_native(image, resolution=518)
+    
+    # 400 -> 518 px (37 patches), 200 -> 259 px (18 patches), nothing cropped
+    assert grid_size == (18, 37)
+    assert features.shape == (18 * 37, 768)
+
+
+def test_extract_pyramid(extractor):
+    """Test that a pyramid's crop of the whole image matches its finest grid"""
+    image = torch.rand(200, 400, 3)
+    
+    pyramid = extractor.extract_pyramid(image, resolutions=(224, 448))
+    
+    assert [level.shape[:2] for level in pyramid.levels] == [(8, 16), (16, 32)]
+    assert pyramid.crop((0, 0, 400, 200)).shape == (16, 32, 768)
+
+
+@pytest.mark.parametrize("shape", [(224, 224), (300, 400), (500, 260)])
+def test_device_preprocess_matches_hf_processor(extractor, shape):
+    """Test that torch preprocessing matches BitImageProcessor with DINOv2's settings"""
+    from transformers import BitImageProcessor
+    processor = BitImageProcessor(
+        do_resize=True, size={"shortest_edge": 256}, resample=Image.BICUBIC,
+        do_center_crop=True, crop_size={"height": 224, "width": 224},
+        do_rescale=True, rescale_factor=1 / 255, do_normalize=True,
+        image_mean=[0.485, 0.456, 0.406], image_std=[0.229, 0.224, 0.225],
+    )
+    image = np.array(Image.fromarray(
+        np.random.RandomState(0).randint(0, 255, shape + (3,), dtype=np.uint8)
+    ).resize((shape[1] // 8, shape[0] // 8)).resize((shape[1], shape[0]), Image.BICUBIC))
+    
+    expected = processor(images=[image], return_tensors="pt")["pixel_values"]
+    pixel_values = extractor._preprocess([extractor._to_tensor(image)]).cpu()
+    
+    # PIL resizes uint8 pixels, so differences stay within a couple of levels
+    assert pixel_values.shape == expected.shape
+    assert (pixel_values - expected).abs().max() < 0.05
+    
+    features = extractor.model(pixel_values=pixel_values.to(extractor.device)).last_hidden_state
+    reference = extractor.model(pixel_values=expected.to(extractor.device)).last_hidden_state
+    similarity = torch.nn.functional.cosine_similarity(features, reference, dim=-1)
+    assert similarity.min() > 0.999
+
+
+def test_extractor_output_conditions_adapter(extractor):
+    """Test that extractor output (inference tensors) feeds the conditioning adapter"""
+    adapter = DINOConditioningAdapter(dino_dim=extractor.model.config.hidden_size,
+                                      device="cpu")
+    image = np.random.RandomState(0).randint(0, 255, (224, 448, 3), dtype=np.uint8)
+    
+    features = extractor.extract_features(image)
+    first = adapter.prepare_conditioning_embeddings(features, target_shape=(8, 8))
+    assert first.shape == (1, 64, adapter.flux_dim)
+    assert torch.equal(adapter.prepare_conditioning_embeddings(features, target_shape=(8, 8)), first)
+    
+    native, grid_size = extractor.extract_features_native(image, resolution=224)
+    aligned = adapter.prepare_conditioning_embeddings(native, target_shape=(8, 16),
+                                                      source_shape=grid_size)
+    assert aligned.shape == (1, 128, adapter.flux_dim)
+    
+    grids = extractor.extract_features_batch([image, image], grid=True)
+    projected = adapter.align_and_project(grids, (8, 8))
+    assert projected.shape == (2, 64, adapter.flux_dim)
@@ -0,0 +1,75 @@
+"""
+Tests for the DINO feature cache
+"""
+import torch
+import sys
+from pathlib import Path
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from feature_cache import FeatureCache
+
+
+def test_memory_lru_evicts_oldest():
+    """Test that the in-memory level keeps the most recently used entries"""
+    features = torch.rand(256, 768)  # 384 KiB in fp16
+    cache = FeatureCache(memory_bytes=features.nbytes)
+    
+    cache.put("a", features)
+    cache.put("b", features)
+    cache.get("a")
+    cache.put("c", features)
+    
+    assert cache.get("b") is None
+    assert torch.equal(cache.get("a"), features.half().float())
+    assert cache.get("c") is not None
+
+
+def test_entries_own_their_storage():
+    """Test that an entry cut from a batch does not keep the whole batch alive"""
+    batch = torch.rand(8, 256, 768)
+    cache = FeatureCache()
+    
+    stored = cache.put("a", batch[0])
+    
+    assert torch.equal(stored, batch[0].half().float())
+    assert cache._memory_size == 256 * 768 * 2
+    assert cache._memory["a"].untyped_storage().nbytes() == 256 * 768 * 2
+
+
+def test_memory_and_disk_hits_agree(tmp_path):
+    """Test that a hit returns the same values from either level"""
+    features = torch.randn(256, 768)
+    stored = FeatureCache(str(tmp_path)).put("key", features)
+    
+    from_disk = FeatureCache(str(tmp_path)).get("key")
+    
+    assert torch.equal(from_disk, stored)
+
+
+def test_disk_level_survives_restart(tmp_path):
+    """Test that a new cache on the same directory serves fp16 features from disk"""
+    features = torch.randn(16, 16, 768)
+    FeatureCache(str(tmp_path)).put("key", features)
+    
+    cache = FeatureCache(str(tmp_path))
+    restored = cache.get("key")
+    
+    assert restored.dtype == torch.float32
+    assert torch.allclose(restored, features, atol=1e-2, rtol=1e-3)
+    assert [p.suffix for p in tmp_path.iterdir()] == [".npz"]
+    
+    cache.get("key")  # now from memory
+    cache.get("other")
+    assert cache.stats() == {"memory_hits": 1, "disk_hits": 1, "misses": 1,
+                             "hit_rate": 2 / 3}
+
+
+def test_disk_size_cap_evicts(tmp_path):
+    """Test that the disk store is trimmed to its size cap"""
+    cache = FeatureCache(str(tmp_path), disk_bytes=600 * 1024)
+    for key in "abc":
+        cache.put(key, torch.rand(256, 768))  # ~384 KiB each in fp16
+    
+    assert len(list(tmp_path.iterdir())) == 1
@@ -0,0 +1,42 @@
+"""
+Tests for the per-tile DINO feature pyramid
+"""
+import torch
+import sys
+from pathlib import Path
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from feature_pyramid import FeaturePyramid
+
+
+def test_crop_of_whole_image_returns_level():
+    """Test that cropping the full image at the level's own grid returns the grid"""
+    level = torch.randn(6, 8, 16)
+    pyramid = FeaturePyramid([level], (60, 80))
+    
+    assert pyramid.grid_size((0, 0, 80, 60)) == (6, 8)
+    assert torch.allclose(pyramid.crop((0, 0, 80, 60)), level, atol=1e-5)
+
+
+def test_crop_follows_pixel_coordinates():
+    """Test that a region aligned to patch cells crops exactly those cells"""
+    level = torch.randn(6, 8, 16)
+    pyramid = FeaturePyramid([level], (60, 80))
+    
+    crop = pyramid.crop((20, 10, 40, 30))
+    
+    assert torch.allclose(crop, level[1:4, 2:6], atol=1e-5)
+
+
+def test_levels_are_averaged():
+    """Test that coarse and fine levels contribute equally"""
+    coarse = torch.full((3, 4, 2), 1.0)
+    fine = torch.full((6, 8, 2), 3.0)
+    pyramid = FeaturePyramid([coarse, fine], (60, 80))
+    
+    crop = pyramid.crop((5, 5, 33, 21), grid_size=(2, 3))
+    
+    assert crop.shape == (2, 3, 2)
+    assert torch.allclose(crop, torch.full_like(crop, 2.0))
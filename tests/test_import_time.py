@@ -0,0 +1,21 @@
+"""
+Tests that importing the node stays cheap
+"""
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+
+def test_node_import_defers_heavy_dependencies():
+    """Test that loading nodes.py and building INPUT_TYPES skips cv2, transformers and comfy.sample"""
+    code = (
+        "import sys, nodes\n"
+        "nodes.DINOUpscale.INPUT_TYPES()\n"
+        "print(sorted(m for m in ('cv2', 'transformers', 'comfy.sample') if m in sys.modules))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True,
+                            text=True, check=True)
+    
+    assert result.stdout.strip().splitlines()[-1] == "[]"
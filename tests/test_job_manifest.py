@@ -0,0 +1,44 @@
+"""
+Tests for resumable job checkpoints
+"""
+import torch
+import sys
+from pathlib import Path
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from job_manifest import JobManifest
+
+
+RECTS = [(0, 0, 64, 64), (48, 0, 64, 64)]
+
+
+def test_completed_tiles_survive_reopen(tmp_path):
+    """Test that recorded tiles are restored when the same job is reopened"""
+    tile = torch.rand(64, 64, 3)
+    JobManifest(str(tmp_path), "a" * 40, RECTS).record(1, tile)
+    
+    job = JobManifest(str(tmp_path), "a" * 40, RECTS)
+    
+    assert job.completed == {1}
+    assert torch.equal(job.load_tile(1), tile)
+
+
+def test_changed_plan_discards_checkpoint(tmp_path):
+    """Test that a checkpoint is not reused for a different tile plan"""
+    JobManifest(str(tmp_path), "a" * 40, RECTS).record(0, torch.rand(64, 64, 3))
+    
+    job = JobManifest(str(tmp_path), "a" * 40, RECTS[:1])
+    
+    assert job.completed == set()
+
+
+def test_finish_removes_job_directory(tmp_path):
+    """Test that finishing a job deletes its checkpoint files"""
+    job = JobManifest(str(tmp_path), "b" * 40, RECTS)
+    job.record(0, torch.rand(64, 64, 3))
+    
+    job.finish()
+    
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,116 @@
+"""
+Tests for the shared model registry
+"""
+import time
+import sys
+from pathlib import Path
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from model_registry import ModelRegistry
+
+
+class FakeModel:
+    """Stand-in for a shared extractor that records offloads"""
+    
+    def __init__(self):
+        self.offloads = 0
+    
+    def offload(self):
+        self.offloads += 1
+
+
+def test_one_instance_per_key():
+    """Test that holders of the same key share one instance"""
+    registry = ModelRegistry(idle_seconds=0)
+    created = []
+    
+    def factory():
+        created.append(FakeModel())
+        return created[-1]
+    
+    first = registry.acquire(("dino", "fp32"), factory)
+    second = registry.acquire(("dino", "fp32"), factory)
+    other = registry.acquire(("dino", "int8"), factory)
+    
+    assert first is second and first is not other
+    assert len(created) == 2
+    assert registry.stats()[("dino", "fp32")] == {"refs": 2, "offloaded": False}
+
+
+def test_idle_models_offloaded_or_dropped():
+    """Test that idle referenced models are offloaded and unreferenced ones dropped"""
+    registry = ModelRegistry(idle_seconds=60)
+    held = registry.acquire("held", FakeModel)
+    registry.acquire("released", FakeModel)
+    registry.release("released")
+    
+    assert registry.collect() == 0  # not idle yet
+    assert registry.collect(now=time.monotonic() + 61) == 2
+    
+    assert held.offloads == 1
+    assert list(registry.stats()) == ["held"]
+    assert registry.stats()["held"]["offloaded"]
+    
+    # Offloaded once; using it again makes it eligible for the next idle period
+    assert registry.collect(now=time.monotonic() + 61) == 0
+    registry.touch("held")
+    assert not registry.stats()["held"]["offloaded"]
+
+
+def test_idle_timer_offloads():
+    """Test that the background timer offloads without further calls"""
+    registry = ModelRegistry(idle_seconds=0.05)
+    model = registry.acquire("dino", FakeModel)
+    
+    deadline = time.monotonic() + 5
+    while not model.offloads and time.monotonic() < deadline:
+        time.sleep(0.01)
+    
+    assert model.offloads == 1
+
+
+def test_models_in_use_not_offloaded():
+    """Test that a running model is neither offloaded nor dropped, and use() reloads it"""
+    registry = ModelRegistry(idle_seconds=60)
+    model = registry.acquire("dino", FakeModel)
+    registry.collect(now=time.monotonic() + 61)
+    assert registry.stats()["dino"]["offloaded"]
+    
+    with registry.use("dino"):
+        # A forward moves the model back, which the registry now knows
+        assert not registry.stats()["dino"]["offloaded"]
+        registry.release("dino")
+        assert registry.collect(now=time.monotonic() + 61) == 0
+    
+    assert model.offloads == 1
+    assert registry.collect(now=time.monotonic() + 61) == 1
+    assert registry.stats() == {}
+
+
+def test_idle_time_per_touch():
+    """Test that a shorter idle time asked for later does not cut an earlier one short"""
+    registry = ModelRegistry(idle_seconds=10)
+    model = registry.acquire("dino", FakeModel)
+    registry.touch("dino", idle_seconds=600)
+    registry.touch("dino", idle_seconds=30)
+    
+    assert registry.collect(now=time.monotonic() + 61) == 0
+    assert registry.collect(now=time.monotonic() + 601) == 1
+    assert model.offloads == 1
+    assert registry.idle_seconds == 10  # the registry default is left alone
+
+
+
+def test_keep_loaded_touch_not_sticky():
+    """Test that touching with 0 keeps a model only until a later touch sets a time"""
+    registry = ModelRegistry(idle_seconds=10)
+    model = registry.acquire("dino", FakeModel)
+    registry.touch("dino", idle_seconds=0)
+    
+    assert registry.collect(now=time.monotonic() + 3600) == 0
+    
+    registry.touch("dino", idle_seconds=30)
+    assert registry.collect(now=time.monotonic() + 31) == 1
+    assert model.offloads == 1
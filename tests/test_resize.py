@@ -0,0 +1,51 @@
+"""
+Tests for the torch resize kernels
+"""
+import cv2
+import pytest
+import torch
+import sys
+from pathlib import Path
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from resize import resize_image
+
+
+@pytest.mark.parametrize("mode,flag", [
+    ("lanczos4", cv2.INTER_LANCZOS4),
+    ("bicubic", cv2.INTER_CUBIC),
+    ("bilinear", cv2.INTER_LINEAR),
+])
+@pytest.mark.parametrize("size", [(106, 74), (159, 111), (30, 20)])
+def test_matches_cv2(mode, flag, size):
+    """Test kernel parity with cv2.resize on float input"""
+    image = torch.rand(37, 53, 3)
+    expected = torch.from_numpy(cv2.resize(image.numpy(), size, interpolation=flag))
+    
+    result = resize_image(image, size, mode, antialias=False)
+    
+    assert result.shape == expected.shape
+    assert torch.allclose(result, expected, atol=1e-5)
+
+
+def test_window_matches_full_resize():
+    """Test that resizing a window equals cropping the full resize"""
+    image = torch.rand(37, 53, 3)
+    full = resize_image(image, (159, 111))
+    
+    window = resize_image(image, (159, 111), window=(100, 50, 59, 61))
+    
+    assert torch.allclose(window, full[50:111, 100:159], atol=1e-6)
+
+
+def test_antialiased_bilinear_matches_torch():
+    """Test that antialiased downscaling matches torch's antialias=True"""
+    image = torch.rand(37, 53, 3)
+    expected = torch.nn.functional.interpolate(
+        image.permute(2, 0, 1)[None], size=(20, 30), mode="bilinear",
+        antialias=True, align_corners=False
+    )[0].permute(1, 2, 0)
+    
+    assert torch.allclose(resize_image(image, (30, 20), "bilinear"), expected, atol=1e-5)
@@ -0,0 +1,31 @@
+"""Tests for streaming image output"""
+import pytest
+import numpy as np
+from PIL import Image
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from stream_writer import PNGStreamWriter
+
+
+def test_png_round_trip(tmp_path):
+    """Test that a PNG written in bands decodes to the original pixels"""
+    image = np.random.randint(0, 255, (97, 130, 3), dtype=np.uint8)
+    path = tmp_path / "out.png"
+    
+    with PNGStreamWriter(str(path), 130, 97) as writer:
+        for start in range(0, 97, 20):
+            writer.write_rows(image[start:start + 20])
+    
+    assert np.array_equal(np.array(Image.open(path)), image)
+
+
+def test_incomplete_png_raises(tmp_path):
+    """Test that closing before all rows are written is an error"""
+    writer = PNGStreamWriter(str(tmp_path / "out.png"), 16, 16)
+    writer.write_rows(np.zeros((8, 16, 3), dtype=np.uint8))
+    
+    with pytest.raises(ValueError, match="rows were written"):
+        writer.close()
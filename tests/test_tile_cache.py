@@ -0,0 +1,63 @@
+"""
+Tests for the on-disk tile cache
+"""
+import os
+import time
+import torch
+import sys
+from pathlib import Path
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from tile_cache import TileCache, module_fingerprint
+
+
+def test_keys_depend_on_pixels_and_params(tmp_path):
+    """Test that keys change with tile contents and with any parameter"""
+    cache = TileCache(str(tmp_path))
+    tile = torch.rand(16, 16, 3)
+    
+    key = cache.key(tile, seed=1, steps=20)
+    assert key == cache.key(tile.clone(), steps=20, seed=1)
+    assert key != cache.key(tile, seed=2, steps=20)
+    assert key != cache.key(tile + 1e-3, seed=1, steps=20)
+
+
+def test_round_trip_counts_hits_and_misses(tmp_path):
+    """Test that stored tiles come back exactly and lookups are counted"""
+    cache = TileCache(str(tmp_path))
+    tile = torch.rand(16, 16, 3)
+    
+    assert cache.get("missing") is None
+    cache.put("abc", tile)
+    assert torch.equal(cache.get("abc"), tile)
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+def test_size_cap_evicts_least_recently_used(tmp_path):
+    """Test that the oldest unused entries are evicted past the size cap"""
+    tile = torch.rand(32, 32, 3)
+    entry_size = tile.numel() * 4 + 128  # float32 payload + .npy header
+    cache = TileCache(str(tmp_path), max_bytes=2 * entry_size)
+    
+    cache.put("a", tile)
+    cache.put("b", tile)
+    past = time.time() - 60
+    os.utime(tmp_path / "a.npy", (past, past))
+    os.utime(tmp_path / "b.npy", (past - 60, past - 60))
+    cache.get("b")  # refresh b, leaving a as least recently used
+    cache.put("c", tile)
+    
+    assert sorted(os.listdir(tmp_path)) == ["b.npy", "c.npy"]
+
+
+def test_module_fingerprint_tracks_weights():
+    """Test that the fingerprint changes when weights change"""
+    module = torch.nn.Linear(4, 4)
+    before = module_fingerprint(module)
+    assert before == module_fingerprint(module)
+    
+    with torch.no_grad():
+        module.weight.add_(1.0)
+    assert module_fingerprint(module) != before
@@ -0,0 +1,42 @@
+"""
+Tests for tile detail scoring
+"""
+import pytest
+import torch
+import sys
+from pathlib import Path
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from tile_detail import tile_detail_score
+
+
+@pytest.mark.parametrize("method", ["gradient", "variance"])
+def test_flat_tile_scores_below_textured_tile(method):
+    """Test that a flat tile scores lower than a noisy one"""
+    flat = torch.full((64, 64, 3), 0.4)
+    textured = torch.rand(64, 64, 3)
+    
+    assert tile_detail_score(flat, method) == pytest.approx(0.0, abs=1e-6)
+    assert tile_detail_score(textured, method) > 0.05
+
+
+def test_gradient_score_compensates_for_scale():
+    """Test that an edge scores about the same at 2x and 4x"""
+    edge = torch.zeros(32, 32, 3)
+    edge[:, 16:] = 1.0
+    upscaled = [
+        torch.nn.functional.interpolate(edge.movedim(-1, 0)[None], scale_factor=s,
+                                        mode="bilinear")[0].movedim(0, -1)
+        for s in (2, 4)
+    ]
+    
+    scores = [tile_detail_score(tile, scale=s) for tile, s in zip(upscaled, (2, 4))]
+    assert scores[0] == pytest.approx(scores[1], rel=0.1)
+
+
+def test_unknown_method_raises():
+    """Test that an unknown scoring method is rejected"""
+    with pytest.raises(ValueError, match="Unknown detail method"):
+        tile_detail_score(torch.zeros(8, 8, 3), method="entropy")
@@ -0,0 +1,81 @@
+"""
+Tests for the prep/sample/stitch pipeline
+"""
+import threading
+import time
+import pytest
+import sys
+from pathlib import Path
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from tile_pipeline import TilePipeline
+
+
+@pytest.mark.parametrize("depth", [0, 1, 3])
+def test_items_finish_in_order(depth):
+    """Test that results are finished in preparation order at any depth"""
+    finished = []
+    
+    def finish(result):
+        time.sleep(0.001 * (result % 3))  # uneven stitch times
+        finished.append(result)
+    
+    TilePipeline(depth).run(iter(range(20)), lambda item: item * 10, finish)
+    
+    assert finished == [i * 10 for i in range(20)]
+
+
+def test_stages_run_on_their_own_threads():
+    """Test that only processing runs on the calling thread"""
+    threads = {}
+    
+    def items():
+        threads["prep"] = threading.current_thread()
+        yield 1
+    
+    def process(item):
+        threads["process"] = threading.current_thread()
+        return item
+    
+    def finish(result):
+        threads["finish"] = threading.current_thread()
+    
+    TilePipeline(2).run(items(), process, finish)
+    
+    assert threads["process"] is threading.current_thread()
+    assert threads["prep"] is not threads["process"]
+    assert threads["finish"] is not threads["process"]
+
+
+def test_processing_error_finishes_earlier_items():
+    """Test that a failure re-raises after already processed items are finished"""
+    finished = []
+    
+    def process(item):
+        if item == 3:
+            raise RuntimeError("sampler failed")
+        return item
+    
+    with pytest.raises(RuntimeError, match="sampler failed"):
+        TilePipeline(2).run(iter(range(10)), process, finished.append)
+    
+    assert finished == [0, 1, 2]
+
+
+@pytest.mark.parametrize("stage", ["prep", "finish"])
+def test_background_errors_propagate(stage):
+    """Test that exceptions on the prep or stitch thread reach the caller"""
+    def items():
+        yield 0
+        if stage == "prep":
+            raise ValueError("prep failed")
+        yield 1
+    
+    def finish(result):
+        if stage == "finish":
+            raise ValueError("finish failed")
+    
+    with pytest.raises(ValueError, match=f"{stage} failed"):
+        TilePipeline(2).run(items(), lambda item: item, finish)
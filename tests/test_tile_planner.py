@@ -0,0 +1,49 @@
+"""
+Tests for the tile grid planner
+"""
+import pytest
+import sys
+from pathlib import Path
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from tile_planner import TileGrid, legacy_axis, plan_axis
+
+
+@pytest.mark.parametrize("length", [300, 1024, 1100, 2048, 3001])
+def test_axis_plan_covers_with_minimum_overlap(length):
+    """Test that planned tiles cover the axis with at least the requested overlap"""
+    starts, tile_length = plan_axis(length, 512, 64)
+    
+    assert starts[0] == 0
+    assert starts[-1] + tile_length == length
+    assert tile_length <= 512 and (tile_length % 8 == 0 or len(starts) == 1)
+    for a, b in zip(starts, starts[1:]):
+        assert tile_length - (b - a) >= 64
+
+
+def test_grid_never_uses_more_pixels_than_legacy():
+    """Test that the planned grid beats or matches the fixed-stride grid"""
+    for width, height in [(1100, 700), (2048, 2048), (4096, 1536), (600, 600)]:
+        grid = TileGrid(width, height, 1024, 64)
+        assert grid.pixels <= grid.legacy_pixels
+    
+    # 1100px with 1024 tiles: the legacy grid adds a second tile 76px from the first
+    assert len(legacy_axis(1100, 1024, 64)) == 2
+    assert TileGrid(1100, 1100, 1024, 64).tile_w == 584
+
+
+def test_square_option_keeps_tiles_square():
+    """Test that square=True gives square tiles covering the canvas"""
+    grid = TileGrid(3000, 1100, 1024, 64, square=True)
+    
+    assert grid.tile_w == grid.tile_h
+    assert grid.xs[-1] + grid.tile_w == 3000
+    assert grid.ys[-1] + grid.tile_h == 1100
+
+
+def test_overlap_must_be_smaller_than_tile():
+    """Test that an overlap as large as the tile is rejected"""
+    with pytest.raises(ValueError, match="overlap"):
+        plan_axis(1000, 64, 64)
@@ -0,0 +1,98 @@
+"""Tests for incremental tile stitching"""
+import pytest
+import numpy as np
+import torch
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from tile_stitcher import TileStitcher, blend_ramp
+
+
+def grid_rects(width, height, tile_size, stride):
+    """Rectilinear grid of (x, y, w, h) rects covering width x height"""
+    xs = sorted({min(x, width - tile_size) for x in range(0, width, stride)})
+    ys = sorted({min(y, height - tile_size) for y in range(0, height, stride)})
+    return [(x, y, tile_size, tile_size) for y in ys for x in xs]
+
+
+def test_blend_ramp_edges():
+    """Test that ramps only fade on sides with a neighbour"""
+    ramp = blend_ramp(64, 16, fade_start=True, fade_end=False)
+    
+    assert ramp.shape == (64,)
+    assert ramp[0] < ramp[15] < 1.0
+    assert torch.all(ramp[16:] == 1.0)
+    assert torch.all(blend_ramp(64, 16, False, False) == 1.0)
+
+
+def test_blend_ramp_is_cached():
+    """Test that identical requests share one cached ramp"""
+    assert blend_ramp(128, 32, True, True) is blend_ramp(128, 32, True, True)
+
+
+def test_constant_tiles_reconstruct_exactly():
+    """Test that weights form a partition of unity across overlaps"""
+    rects = grid_rects(300, 200, tile_size=128, stride=96)
+    stitcher = TileStitcher((300, 200), rects, overlap=32)
+    
+    for x, y, w, h in rects:
+        stitcher.add(torch.full((h, w, 3), 0.5), x, y)
+    
+    result = stitcher.result()
+    assert result.shape == (200, 300, 3)
+    assert torch.allclose(result, torch.full_like(result, 0.5), atol=1e-6)
+    assert stitcher.pending == 0
+
+
+def test_reconstructs_source_image():
+    """Test that tiles cut from one image stitch back to that image"""
+    image = torch.rand(250, 330, 3)
+    rects = grid_rects(330, 250, tile_size=128, stride=100)
+    stitcher = TileStitcher((330, 250), rects, overlap=28)
+    
+    for x, y, w, h in rects:
+        stitcher.add(image[y:y + h, x:x + w], x, y)
+    
+    assert torch.allclose(stitcher.result(), image, atol=1e-5)
+
+
+def test_interior_is_copied_unweighted():
+    """Test that pixels owned by a single tile are copied verbatim"""
+    rects = [(0, 0, 128, 128), (96, 0, 128, 128)]
+    stitcher = TileStitcher((224, 128), rects, overlap=32)
+    left = torch.rand(128, 128, 3)
+    
+    stitcher.add(left, 0, 0)
+    
+    # Columns 0-95 belong to the left tile only, including the image border
+    assert torch.equal(stitcher.result()[:, :96], left[:, :96])
+
+
+def test_non_grid_tiles_rejected():
+    """Test that tiles outside a rectilinear grid raise an error"""
+    rects = [(0, 0, 64, 64), (32, 32, 64, 64)]
+    
+    with pytest.raises(ValueError, match="rectilinear grid"):
+        TileStitcher((96, 96), rects, overlap=16)
+
+
+def test_streaming_stitcher_matches_in_memory(tmp_path):
+    """Test that streamed output equals the in-memory stitch"""
+    from PIL import Image
+    from tile_stitcher import StreamingTileStitcher
+    
+    image = torch.rand(250, 330, 3)
+    rects = grid_rects(330, 250, tile_size=128, stride=100)
+    path = tmp_path / "out.png"
+    stitcher = StreamingTileStitcher((330, 250), rects, str(path), overlap=28, preview_size=64)
+    
+    for x, y, w, h in rects:
+        stitcher.add(image[y:y + h, x:x + w], x, y)
+    preview = stitcher.preview()
+    stitcher.close()
+    
+    written = torch.from_numpy(np.array(Image.open(path))).float() / 255.0
+    assert torch.allclose(written, image, atol=1 / 255)
+    assert max(preview.shape[:2]) <= 64
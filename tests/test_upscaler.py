@@ -1,6 +1,8 @@
 """Tests for upscaling functionality"""
 import pytest
 import numpy as np
+import cv2
+import torch
 from PIL import Image
 import sys
 from pathlib import Path
@@ -8,6 +10,8 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
 
 from upscaler import BasicUpscaler
+from tile_cache import TileCache
+from feature_pyramid import FeaturePyramid
 
 
 @pytest.fixture
@@ -85,6 +89,20 @@ def test_stitch_tiles(upscaler):
     assert result.size == (224, 128)
 
 
+def test_stitch_tiles_off_grid(upscaler):
+    """Test that tiles that do not form a grid are still blended"""
+    tiles = [
+        (np.full((128, 128, 3), 100, dtype=np.uint8), 0, 0),
+        (np.full((128, 128, 3), 100, dtype=np.uint8), 96, 0),
+        (np.full((96, 128, 3), 100, dtype=np.uint8), 48, 96),
+    ]
+    
+    result = upscaler.stitch_tiles(tiles, output_size=(224, 192), tile_size=128, overlap=32)
+    
+    assert result.size == (224, 192)
+    assert np.asarray(result)[:128, :].min() == 100
+
+
 def test_blend_mask_creation(upscaler):
     """Test blend mask for smooth transitions"""
     mask = upscaler._create_blend_mask(height=128, width=128, overlap=32)
@@ -106,3 +124,364 @@ def test_upscale_with_dino_features(upscaler, sample_image):
     # Should still work even with features (they're not used yet in POC)
     assert result.size[0] == sample_image.size[0] * 2
     assert result.size[1] == sample_image.size[1] * 2
+
+
+class FakeSampler:
+    """Stand-in for ComfyUISamplerWrapper that returns tiles unchanged"""
+    
+    def __init__(self):
+        self.calls = []
+    
+    downscale_ratio = 8
+    
+    def fingerprint(self):
+        return "fake-model"
+    
+    def sample_tensors(self, image_tensor, seeds, **kwargs):
+        self.calls.append(([tuple(image.shape) for image in image_tensor], list(seeds)))
+        return image_tensor.clone()
+    
+    def sample_latents(self, latent, seeds, model_wrapper=None, step_callback=None, **kwargs):
+        self.calls.append(([tuple(sample.shape) for sample in latent], list(seeds)))
+        if model_wrapper is not None:
+            args = {"input": latent, "timestep": torch.ones(latent.shape[0]), "c": {}}
+            latent = model_wrapper(lambda x, t: x, args)
+            for step in range(4):
+                step_callback(step, 4)
+        return latent.clone()
+    
+    def encode_image_tiled(self, image_tensor, tile_size=512, overlap=64):
+        return torch.nn.functional.avg_pool2d(image_tensor.movedim(-1, 1), 8)
+    
+    def decode_latent_tiled(self, latent, tile_size=64, overlap=16):
+        return torch.nn.functional.interpolate(latent, scale_factor=8).movedim(1, -1)
+
+
+def test_batched_tile_sampling():
+    """Test that same-sized tiles are sampled together with per-tile seeds"""
+    sampler = FakeSampler()
+    upscaler = BasicUpscaler(comfyui_sampler=sampler, scale_factor=2.0)
+    image = np.random.randint(0, 255, (150, 150, 3), dtype=np.uint8)
+    
+    result = upscaler.upscale(image, use_diffusion=True, tile_size=128,
+                              tile_batch_size=4, seed=10)
+    
+    assert result.size == (300, 300)
+    seeds = [seed for _, batch_seeds in sampler.calls for seed in batch_seeds]
+    assert sorted(seeds) == list(range(10, 10 + len(seeds)))
+    for shapes, batch_seeds in sampler.calls:
+        assert len(batch_seeds) <= 4
+        assert len(set(shapes)) == 1
+
+
+def test_tensor_pipeline_stays_in_tensor_space():
+    """Test that tensor input returns an unquantised [1, H, W, C] float tensor"""
+    upscaler = BasicUpscaler(comfyui_sampler=FakeSampler(), scale_factor=2.0)
+    image = torch.rand(1, 100, 140, 3)
+    
+    result = upscaler.upscale(image, use_diffusion=True, tile_size=128)
+    
+    assert isinstance(result, torch.Tensor)
+    assert result.shape == (1, 200, 280, 3)
+    assert result.dtype == torch.float32
+    assert 0.0 <= result.min() and result.max() <= 1.0
+    # Values between the uint8 levels survive, so nothing was quantised
+    assert not torch.allclose(result, (result * 255).round() / 255)
+
+
+@pytest.mark.parametrize("cpu_resize_bytes", [2 * 1024 ** 3, 0])
+@pytest.mark.parametrize("shape,scale", [((100, 140), 2.0), ((101, 141), 1.5)])
+def test_pixel_tiles_resampled_from_source(cpu_resize_bytes, shape, scale):
+    """Test that pixel tiles, resized in full or lazily, reproduce a full Lanczos resize"""
+    upscaler = BasicUpscaler(comfyui_sampler=FakeSampler(), scale_factor=scale)
+    upscaler.cpu_resize_bytes = cpu_resize_bytes
+    image = torch.rand(1, *shape, 3)
+    size = (int(shape[1] * scale), int(shape[0] * scale))
+    expected = torch.from_numpy(
+        cv2.resize(image[0].numpy(), size, interpolation=cv2.INTER_LANCZOS4)
+    ).clamp(0.0, 1.0)
+    
+    result = upscaler.upscale(image, use_diffusion=True, tile_size=128)
+    
+    assert torch.allclose(result[0], expected, atol=1e-5)
+
+
+class CroppingSampler(FakeSampler):
+    """FakeSampler whose VAE round trip crops to multiples of 8, like the real one"""
+    
+    def sample_tensors(self, image_tensor, seeds, **kwargs):
+        height, width = image_tensor.shape[1:3]
+        return super().sample_tensors(image_tensor, seeds)[:, :height // 8 * 8, :width // 8 * 8]
+
+
+@pytest.mark.parametrize("shape,tile_size", [((101, 150), 512), ((300, 301), 1024), ((301, 300), 128)])
+def test_pixel_tiles_padded_to_downscale_ratio(shape, tile_size):
+    """Test that tiles off the VAE's 8px grid come back at their full size"""
+    sampler = CroppingSampler()
+    upscaler = BasicUpscaler(comfyui_sampler=sampler, scale_factor=2.0)
+    image = torch.rand(1, *shape, 3)
+    
+    result = upscaler.upscale(image, use_diffusion=True, tile_size=tile_size)
+    
+    assert result.shape == (1, shape[0] * 2, shape[1] * 2, 3)
+    assert all(h % 8 == 0 and w % 8 == 0 for shapes, _ in sampler.calls for h, w, _ in shapes)
+
+
+def test_single_unaligned_tile_returned_whole():
+    """Test that an image fitting one tile comes back as that tile, unaligned sizes included"""
+    sampler = CroppingSampler()
+    upscaler = BasicUpscaler(comfyui_sampler=sampler, scale_factor=2.0)
+    image = torch.rand(1, 75, 50, 3)
+    expected = upscaler._resize_tensor(image[0], (100, 150)).clamp(0.0, 1.0)
+    
+    result = upscaler.upscale(image, use_diffusion=True, tile_size=512)
+    
+    assert len(sampler.calls) == 1
+    assert torch.allclose(result[0], expected, atol=1e-6)
+
+
+def test_cv2_windows_match_full_resize():
+    """Test that cv2 resizes of aligned source windows match a full resize"""
+    upscaler = BasicUpscaler()
+    source = torch.rand(200, 300, 3)
+    full = upscaler._resize_tensor(source, (450, 300))
+    assert upscaler._cv2_windows_align((300, 200), (450, 300))
+    
+    for rect in upscaler._plan_rects(450, 300, 128, 32):
+        x, y, w, h = rect
+        tile = upscaler._resample_tile(source, (450, 300), rect)
+        assert torch.allclose(tile, full[y:y + h, x:x + w], atol=1e-4)
+
+
+def test_upscale_to_file_streams_png(tmp_path):
+    """Test that the headless streaming entry point writes the full result"""
+    upscaler = BasicUpscaler(comfyui_sampler=FakeSampler(), scale_factor=2.0)
+    image = torch.rand(1, 100, 140, 3)
+    expected = upscaler.upscale(image, use_diffusion=True, tile_size=128)[0]
+    
+    path = upscaler.upscale_to_file(image, str(tmp_path / "out.png"), tile_size=128)
+    
+    written = torch.from_numpy(np.array(Image.open(path))).float() / 255.0
+    assert written.shape == (200, 280, 3)
+    assert torch.allclose(written, expected, atol=1 / 255)
+    assert list(tmp_path.iterdir()) == [tmp_path / "out.png"]
+
+
+def test_latent_tiling_mode():
+    """Test that latent mode encodes once, samples latent tiles and crops padding"""
+    sampler = FakeSampler()
+    upscaler = BasicUpscaler(comfyui_sampler=sampler, scale_factor=2.0)
+    image = torch.full((1, 150, 101, 3), 0.25)
+    
+    result = upscaler.upscale(image, use_diffusion=True, tile_size=128,
+                              tiling_mode="latent", tile_batch_size=2)
+    
+    assert result.shape == (1, 300, 202, 3)
+    assert torch.allclose(result, torch.full_like(result, 0.25), atol=1e-5)
+    # Tiles are sampled as latents: 128px tiles are 16x16 latent cells
+    assert all(max(shape[1:]) <= 16 for shapes, _ in sampler.calls for shape in shapes)
+
+
+def test_joint_tiling_mode():
+    """Test that joint mode samples the whole latent once with a tile wrapper"""
+    sampler = FakeSampler()
+    upscaler = BasicUpscaler(comfyui_sampler=sampler, scale_factor=2.0)
+    image = torch.full((1, 150, 101, 3), 0.75)
+    progress = []
+    
+    result = upscaler.upscale(image, use_diffusion=True, tile_size=128, tile_overlap=16,
+                              tiling_mode="joint", progress_callback=lambda: progress.append(1))
+    
+    assert result.shape == (1, 300, 202, 3)
+    assert torch.allclose(result, torch.full_like(result, 0.75), atol=1e-5)
+    assert sampler.calls == [([(3, 38, 26)], [0])]
+    assert len(progress) == 6  # one update per latent tile, spread over the steps
+
+
+@pytest.mark.parametrize("cpu_resize_bytes", [2 * 1024 ** 3, 0])
+def test_flat_tiles_skip_sampling(cpu_resize_bytes):
+    """Test that tiles below detail_threshold keep the resized pixels"""
+    sampler = FakeSampler()
+    upscaler = BasicUpscaler(comfyui_sampler=sampler, scale_factor=2.0)
+    upscaler.cpu_resize_bytes = cpu_resize_bytes
+    resampled = []
+    resample_tile = upscaler._resample_tile
+    upscaler._resample_tile = lambda *args: resampled.append(args[2]) or resample_tile(*args)
+    image = torch.full((1, 150, 150, 3), 0.5)
+    image[:, :, 100:] = torch.rand(1, 150, 50, 3)  # detail on the right only
+    
+    result = upscaler.upscale(image, use_diffusion=True, tile_size=128, seed=0,
+                              detail_threshold=0.02)
+    
+    stats = upscaler.last_run_stats
+    assert result.shape == (1, 300, 300, 3)
+    assert stats["skipped"] > 0 and stats["sampled"] > 0
+    assert stats["skipped"] + stats["sampled"] == stats["tiles"]
+    assert len(sampler.calls) == stats["sampled"]
+    # Lazy tiles are resampled once, for scoring and sampling alike
+    assert len(resampled) == (stats["tiles"] if not cpu_resize_bytes else 0)
+
+
+def test_tile_cache_reuses_sampled_tiles(tmp_path):
+    """Test that a re-run with the same inputs is served from the tile cache"""
+    sampler = FakeSampler()
+    upscaler = BasicUpscaler(comfyui_sampler=sampler, scale_factor=2.0,
+                             tile_cache=TileCache(str(tmp_path)))
+    image = torch.rand(1, 150, 150, 3)
+    
+    first = upscaler.upscale(image, use_diffusion=True, tile_size=128, seed=3)
+    tiles = len(sampler.calls)
+    second = upscaler.upscale(image, use_diffusion=True, tile_size=128, seed=3)
+    
+    assert len(sampler.calls) == tiles  # nothing was sampled again
+    assert upscaler.last_run_stats["cache_hits"] == tiles
+    assert torch.equal(first, second)
+    
+    # A different seed changes every key
+    upscaler.upscale(image, use_diffusion=True, tile_size=128, seed=4)
+    assert upscaler.last_run_stats["cache_misses"] == tiles
+
+
+def test_interrupted_job_resumes(tmp_path):
+    """Test that a re-run after a failure only samples the unfinished tiles"""
+    class FailingSampler(FakeSampler):
+        def sample_tensors(self, image_tensor, seeds, **kwargs):
+            if len(self.calls) == 3:
+                raise RuntimeError("out of memory")
+            return super().sample_tensors(image_tensor, seeds, **kwargs)
+    
+    image = torch.rand(1, 150, 150, 3)
+    expected = BasicUpscaler(comfyui_sampler=FakeSampler(), scale_factor=2.0).upscale(
+        image, use_diffusion=True, tile_size=128)
+    
+    with pytest.raises(RuntimeError, match="out of memory"):
+        BasicUpscaler(comfyui_sampler=FailingSampler(), scale_factor=2.0).upscale(
+            image, use_diffusion=True, tile_size=128, job_dir=str(tmp_path))
+    
+    sampler = FakeSampler()
+    result = BasicUpscaler(comfyui_sampler=sampler, scale_factor=2.0).upscale(
+        image, use_diffusion=True, tile_size=128, job_dir=str(tmp_path))
+    
+    assert len(sampler.calls) == 16 - 3  # 4x4 tiles, 3 finished before the failure
+    assert torch.equal(result, expected)
+    assert list(tmp_path.iterdir()) == []  # checkpoint removed after success
+
+
+def test_pipelined_sampling_matches_serial():
+    """Test that the threaded pipeline gives exactly the serial result"""
+    image = torch.rand(1, 150, 150, 3)
+    results = [
+        BasicUpscaler(comfyui_sampler=FakeSampler(), scale_factor=2.0, pipeline_depth=depth).upscale(
+            image, use_diffusion=True, tile_size=128, tile_batch_size=3)
+        for depth in (0, 2)
+    ]
+    
+    assert torch.equal(results[0], results[1])
+
+
+def test_image_batch_shares_sampler_batches():
+    """Test that every image in a batch is upscaled and tiles are batched across images"""
+    sampler = FakeSampler()
+    upscaler = BasicUpscaler(comfyui_sampler=sampler, scale_factor=2.0)
+    images = torch.rand(3, 100, 140, 3)
+    
+    result = upscaler.upscale(images, use_diffusion=True, tile_size=128,
+                              tile_batch_size=8, seed=5)
+    
+    assert result.shape == (3, 200, 280, 3)
+    # 4x3 tiles per image: 36 tiles in batches of 8, not 3 batches of 12 with leftovers
+    assert [len(seeds) for _, seeds in sampler.calls] == [8, 8, 8, 8, 4]
+    assert [s for _, seeds in sampler.calls for s in seeds] == list(range(5, 5 + 36))
+    single = BasicUpscaler(comfyui_sampler=FakeSampler(), scale_factor=2.0).upscale(
+        images[1], use_diffusion=True, tile_size=128)
+    assert torch.equal(result[1], single[0])
+
+
+class FakeExtractor:
+    """Stand-in for DINOFeatureExtractor: a one-level pyramid of 10px cells holding the image"""
+    
+    def __init__(self):
+        self.calls = []
+    
+    def extract_pyramid(self, image, resolutions=(224,)):
+        self.calls.append(tuple(resolutions))
+        cells = torch.nn.functional.avg_pool2d(image.movedim(-1, 0)[None], 10)[0].mean(0)
+        return FeaturePyramid([cells[..., None].expand(-1, -1, 4)], tuple(image.shape[:2]))
+
+
+@pytest.mark.parametrize("tiling_mode", ["pixel", "latent"])
+def test_per_tile_dino_features(tiling_mode):
+    """Test that every tile is sampled with the features of its own source region"""
+    class RecordingSampler(FakeSampler):
+        conditions_on_dino = True
+        
+        def __init__(self):
+            super().__init__()
+            self.features = []
+        
+        def sample_tensors(self, image_tensor, seeds, dino_features=None, **kwargs):
+            self.features.append(dino_features)
+            return super().sample_tensors(image_tensor, seeds, **kwargs)
+        
+        def sample_latents(self, latent, seeds, dino_features=None, **kwargs):
+            self.features.append(dino_features)
+            return super().sample_latents(latent, seeds, **kwargs)
+    
+    sampler = RecordingSampler()
+    extractor = FakeExtractor()
+    upscaler = BasicUpscaler(comfyui_sampler=sampler, scale_factor=2.0, dino_extractor=extractor)
+    images = torch.zeros(2, 100, 140, 3)
+    images[1, :, 70:] = 1.0  # right half of the second image is white
+    
+    upscaler.upscale(images, use_diffusion=True, tile_size=128, tile_batch_size=4,
+                     tiling_mode=tiling_mode, dino_features=torch.zeros(2, 4, 4))
+    
+    # One pyramid per image, cropped for all of its 12 tiles
+    assert len(extractor.calls) == 2
+    features = torch.cat(sampler.features)
+    assert features.shape[0] == 24 and features.shape[2] == 4
+    assert torch.all(features[:12] == 0.0)
+    assert features[12:].max() == 1.0 and features[12:].min() == 0.0
+    
+    # Samplers that ignore DINO features get none, and no pyramid is extracted
+    RecordingSampler.conditions_on_dino = False
+    sampler.features.clear()
+    upscaler.upscale(images, use_diffusion=True, tile_size=128, tile_batch_size=4,
+                     tiling_mode=tiling_mode, dino_features=torch.zeros(2, 4, 4))
+    assert len(extractor.calls) == 2
+    assert all(f is None for f in sampler.features)
+
+
+def test_dino_done_before_sampling():
+    """Test that the DINO-done callback runs once, after extraction and before sampling"""
+    class RecordingSampler(FakeSampler):
+        conditions_on_dino = True
+    
+    events = []
+    sampler = RecordingSampler()
+    sample_tensors = sampler.sample_tensors
+    sampler.sample_tensors = lambda *args, **kwargs: events.append("sample") or sample_tensors(*args, **kwargs)
+    extractor = FakeExtractor()
+    extract_pyramid = extractor.extract_pyramid
+    extractor.extract_pyramid = lambda *args: events.append("dino") or extract_pyramid(*args)
+    
+    upscaler = BasicUpscaler(comfyui_sampler=sampler, scale_factor=2.0, dino_extractor=extractor)
+    upscaler.dino_done_callback = lambda: events.append("done")
+    upscaler.upscale(torch.zeros(1, 100, 140, 3), use_diffusion=True, tile_size=128,
+                     tile_batch_size=4, dino_features=torch.zeros(1, 4, 4))
+    
+    assert events[:2] == ["dino", "done"]
+    assert events.count("done") == 1 and set(events[2:]) == {"sample"}
+
+
+@pytest.mark.parametrize("tiling_mode", ["latent", "joint"])
+def test_image_batch_in_latent_modes(tiling_mode):
+    """Test that latent and joint modes upscale every image in the batch"""
+    upscaler = BasicUpscaler(comfyui_sampler=FakeSampler(), scale_factor=2.0)
+    images = torch.stack([torch.full((150, 101, 3), value) for value in (0.2, 0.6)])
+    
+    result = upscaler.upscale(images, use_diffusion=True, tile_size=128, tiling_mode=tiling_mode)
+    
+    assert result.shape == (2, 300, 202, 3)
+    assert torch.allclose(result[0], torch.full_like(result[0], 0.2), atol=1e-5)
+    assert torch.allclose(result[1], torch.full_like(result[1], 0.6), atol=1e-5)